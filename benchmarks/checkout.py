@@ -0,0 +1,167 @@
+"""Flash-sale benchmark for /checkout: many buyers racing for one hot product.
+
+Sets the stock of one product, lets `--concurrency` keep-alive clients
+spread over several gunicorn worker processes buy it until it sells out
+(or `--duration` ends), then checks the database: stock never goes
+negative and the quantities in Order_Item add up exactly to the stock
+that was taken.
+
+    python -m benchmarks.checkout --preset small --stock 5000 --concurrency 64 --workers 4
+    python -m benchmarks.checkout --quantity 3 --extra-lines 2
+"""
+import argparse
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks.http_load import (Client, copy_database, dataset_counts, git_commit,
+                                  prepare_dataset, save_results, session_tokens, start_server)
+from minishop.database.generator import PRESETS, merchant_count
+
+HOT_PRODUCT_ID = 1
+
+
+def _serve_gunicorn(db_path, host, port, workers, threads):
+    from minishop.backend.wsgi import serve
+    serve(db_path, host, port, workers=workers, threads=threads, max_requests=0)
+
+
+def set_stock(db_path, product_id, stock):
+    conn = sqlite3.connect(db_path)
+    with conn:
+        conn.execute("UPDATE Product SET stock = ?, status = 'active' WHERE product_id = ?",
+                     (stock, product_id))
+        # 其余商品库存充足且在售, 409 只会来自热门商品售罄
+        conn.execute("UPDATE Product SET stock = max(stock, 1000000), status = 'active' "
+                     "WHERE product_id != ?", (product_id,))
+        max_order_id = conn.execute('SELECT coalesce(max(order_id), 0) FROM Order_Table').fetchone()[0]
+    conn.close()
+    return max_order_id
+
+
+def audit(db_path, product_id, initial_stock, first_order_id):
+    conn = sqlite3.connect(db_path)
+    stock = conn.execute('SELECT stock FROM Product WHERE product_id = ?', (product_id,)).fetchone()[0]
+    sold, orders = conn.execute(
+        'SELECT coalesce(sum(quantity), 0), count(*) FROM Order_Item '
+        'WHERE product_id = ? AND order_id > ?', (product_id, first_order_id)).fetchone()
+    conn.close()
+    return {'initial_stock': initial_stock, 'final_stock': stock, 'sold': sold,
+            'orders_with_product': orders,
+            'oversold': max(0, sold - initial_stock),
+            'consistent': stock >= 0 and stock + sold == initial_stock}
+
+
+def run_flash_sale(base_url, counts, args, tokens):
+    buyers = range(merchant_count(counts) + 1, counts['users'] + 1)
+    lock = threading.Lock()
+    statuses = {}
+    latencies = []
+    sold_out = threading.Event()
+    start = time.monotonic()
+    stop_at = start + args.duration
+
+    def worker(index):
+        client = Client(base_url)
+        buyer = buyers[index % len(buyers)]
+        token = tokens.issue(buyer)[0]
+        # 附带的冷门商品各自库存充足, 用来覆盖多行订单的整体回滚
+        extra = [{'product_id': HOT_PRODUCT_ID + 1 + (index + i) % (counts['products'] - 1),
+                  'quantity': 1} for i in range(args.extra_lines)]
+        body = {'user_id': buyer, 'items': [{'product_id': HOT_PRODUCT_ID,
+                                             'quantity': args.quantity}] + extra}
+        while not sold_out.is_set() and time.monotonic() < stop_at:
+            sent = time.monotonic()
+            try:
+                status = client.request('POST', '/checkout', body, token)
+            except Exception:
+                status = None
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    latencies.append(time.monotonic() - sent)
+            if status == 409:
+                sold_out.set()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    return {
+        'seconds': elapsed,
+        'orders': statuses.get(200, 0),
+        'orders_per_second': statuses.get(200, 0) / elapsed,
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stock', type=int, default=2000, help='stock of the hot product')
+    parser.add_argument('--quantity', type=int, default=1, help='hot units per order')
+    parser.add_argument('--extra-lines', type=int, default=0,
+                        help='other products added to every order')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=16, help='threads per worker')
+    parser.add_argument('--duration', type=float, default=60.0, help='upper bound in seconds')
+    parser.add_argument('--output', type=str, default=None, help='JSON results file')
+    args = parser.parse_args()
+
+    tokens = session_tokens()
+    source = prepare_dataset(args.preset, args.scale, args.seed)
+    counts = dataset_counts(source)
+    workdir = tempfile.mkdtemp()
+    process = None
+    try:
+        db_path = copy_database(source, workdir)
+        first_order_id = set_stock(db_path, HOT_PRODUCT_ID, args.stock)
+        process, base_url = start_server(db_path, target=_serve_gunicorn,
+                                         extra_args=(args.workers, args.threads))
+        print(f'[INFO]{args.concurrency} buyers, {args.workers}x{args.threads} server threads, '
+              f'{args.stock} units of product {HOT_PRODUCT_ID}')
+        result = run_flash_sale(base_url, counts, args, tokens)
+        process.terminate()
+        process.join()
+        process = None
+        result['audit'] = audit(db_path, HOT_PRODUCT_ID, args.stock, first_order_id)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    audit_result = result['audit']
+    print(f"orders      {result['orders']} in {result['seconds']:.2f}s "
+          f"({result['orders_per_second']:.1f} orders/s), p50 {result['p50_ms'] or 0:.1f}ms "
+          f"p99 {result['p99_ms'] or 0:.1f}ms")
+    print(f"statuses    {result['statuses']}")
+    print(f"stock       {audit_result['initial_stock']} -> {audit_result['final_stock']}, "
+          f"sold {audit_result['sold']}, oversold {audit_result['oversold']}")
+
+    save_results({
+        'commit': git_commit(),
+        'dataset': {'preset': args.preset, 'scale': args.scale, 'seed': args.seed, 'counts': counts},
+        'flash_sale': {key: getattr(args, key) for key in
+                       ('stock', 'quantity', 'extra_lines', 'concurrency', 'workers', 'threads')},
+        'result': result,
+    }, args.output)
+    if not audit_result['consistent'] or result['orders'] * args.quantity != audit_result['sold']:
+        print('[FAIL]stock and orders do not add up')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,494 @@
+"""End-to-end HTTP benchmark for the Server resources.
+
+Builds (or reuses) a generated dataset, copies it so writes do not leak
+between runs, starts Server on it in a child process and drives a weighted
+mix of endpoint traffic, either closed-loop at a fixed concurrency or
+open-loop at a fixed arrival rate. Reports p50/p95/p99 latency, req/s and
+error rate per endpoint and writes everything to a JSON file.
+
+    python -m benchmarks.http_load --preset small --concurrency 32 --duration 30
+    python -m benchmarks.http_load --rate 500 --mix product=6,search=2,purchase=2
+    python -m benchmarks.http_load --url http://127.0.0.1:8000 --counts-from data/bench.db
+    python -m benchmarks.http_load --compare benchmarks/results/<baseline>.json
+
+In open-loop mode latency is measured from each request's scheduled send
+time, so queueing behind a slow server is not hidden.
+
+User-scoped requests carry a session token minted with $MINISHOP_SECRET_KEY
+(set to a benchmark key when unset), so a --url server must run with the
+same key.
+"""
+import argparse
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from minishop.backend.auth import SessionTokens
+from minishop.database.generator import (PRESETS, BRANDS, NOUNS, generate,
+                                         merchant_count, user_password, password_hash)
+
+DEFAULT_MIX = dict(login=1, search=3, product=5, purchase=2, profile=2, review=1, reply=1)
+DATASET_DIR = os.path.join(os.path.dirname(__file__), 'datasets')
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+BENCHMARK_SECRET_KEY = 'minishop-benchmark'
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def dataset_counts(db_path):
+    conn = sqlite3.connect(db_path)
+    counts = {}
+    for name, table in (('users', 'User'), ('products', 'Product'), ('reviews', 'Review'),
+                        ('orders', 'Order_Table'), ('stores', 'Store'), ('categories', 'Category')):
+        counts[name] = conn.execute(f'SELECT max(rowid) FROM {table}').fetchone()[0] or 0
+    conn.close()
+    return counts
+
+
+def prepare_dataset(preset, scale, seed):
+    """Return the path of a cached generated dataset, generating it on first use."""
+    os.makedirs(DATASET_DIR, exist_ok=True)
+    path = os.path.join(DATASET_DIR, f'{preset}-x{scale:g}-seed{seed}.db')
+    if not os.path.exists(path):
+        counts = {name: max(1, int(count * scale)) for name, count in PRESETS[preset].items()}
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        generate(tmp_path, counts, seed)
+        os.replace(tmp_path, path)
+    return path
+
+
+def copy_database(src, workdir):
+    dst = os.path.join(workdir, 'bench.db')
+    src_conn, dst_conn = sqlite3.connect(src), sqlite3.connect(dst)
+    src_conn.backup(dst_conn)
+    src_conn.close()
+    dst_conn.close()
+    return dst
+
+
+def session_tokens():
+    """SessionTokens signing like the servers started from here: they inherit
+    $MINISHOP_SECRET_KEY, set to BENCHMARK_SECRET_KEY when unset."""
+    os.environ.setdefault('MINISHOP_SECRET_KEY', BENCHMARK_SECRET_KEY)
+    return SessionTokens(None, os.environ['MINISHOP_SECRET_KEY'])
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _serve(db_path, host, port):
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    from minishop.backend.server import Server
+    Server(db_path).run(host=host, port=port)
+
+
+def start_server(db_path, host='127.0.0.1', port=None, target=_serve, extra_args=()):
+    """Run `target(db_path, host, port, *extra_args)` in a child process; return (process, base url)."""
+    port = port or free_port()
+    process = multiprocessing.Process(target=target, args=(db_path, host, port, *extra_args),
+                                      daemon=True)
+    process.start()
+    wait_until_ready(host, port)
+    return process, f'http://{host}:{port}'
+
+
+def wait_until_ready(host, port, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'server on {host}:{port} did not start within {timeout}s')
+
+
+class RequestFactory:
+    """Builds random (endpoint, method, path, body, token) requests against a
+    generated dataset at `db_path`; token is that of the user the request acts as."""
+
+    def __init__(self, counts, mix, db_path, seed=0, tokens=None):
+        self.counts = counts
+        self.merchants = merchant_count(counts)
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.seed = seed
+        self.db_path = db_path
+        self.local = threading.local()
+        self.tokens = tokens or session_tokens()
+        self.issued = {}
+        unknown = set(self.names) - set(DEFAULT_MIX)
+        if unknown:
+            raise ValueError(f'unknown endpoints in mix: {sorted(unknown)}')
+
+    def rng(self, worker):
+        return random.Random(f'{self.seed}:{worker}')
+
+    def customer(self, rng):
+        return rng.randint(self.merchants + 1, self.counts['users'])
+
+    def token(self, user_id):
+        if user_id not in self.issued:
+            self.issued[user_id] = self.tokens.issue(user_id)[0]
+        return self.issued[user_id]
+
+    def store_owner(self, review_id):
+        """Owner of the store selling the reviewed product, the only merchant allowed to reply."""
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = sqlite3.connect(self.db_path)
+        row = self.local.conn.execute(
+            'SELECT owner_id FROM Review JOIN Product USING (product_id) '
+            'JOIN Store USING (store_id) WHERE review_id = ?', (review_id,)).fetchone()
+        return row and row[0]
+
+    def build(self, rng):
+        endpoint = rng.choices(self.names, self.weights)[0]
+        method, path, body, *user_id = getattr(self, endpoint)(rng)
+        token = self.token(user_id[0]) if user_id and user_id[0] is not None else None
+        return endpoint, method, path, body, token
+
+    def login(self, rng):
+        user_id = rng.randint(1, self.counts['users'])
+        return 'POST', '/login', {'username': f'user{user_id}',
+                                  'password_hash': password_hash(user_password(user_id))}
+
+    def search(self, rng):
+        field = rng.choice(['name', 'name', 'description', 'category'])
+        query = rng.choice(BRANDS) + rng.choice(NOUNS) if field != 'category' else rng.choice(
+            ['电子产品', '休闲运动', '食品', '服装', '医药', '生活家居'])
+        return 'POST', '/search', {'query': query, 'field': field}
+
+    def product(self, rng):
+        return 'GET', f'/product/{rng.randint(1, self.counts["products"])}', None
+
+    def purchase(self, rng):
+        user_id = self.customer(rng)
+        return 'GET', f'/purchase/{user_id}', None, user_id
+
+    def profile(self, rng):
+        user_id = rng.randint(1, self.counts["users"])
+        return 'GET', f'/profile/{user_id}', None, user_id
+
+    def review(self, rng):
+        user_id = self.customer(rng)
+        return 'POST', '/review/0', {'user_id': user_id,
+                                     'product_id': rng.randint(1, self.counts['products']),
+                                     'comment': '压测评价', 'rating': rng.randint(1, 5)}, user_id
+
+    def reply(self, rng):
+        review_id = rng.randint(1, max(1, self.counts['reviews']))
+        return 'POST', '/reply/0', {'review_id': review_id, 'reply': '感谢支持'}, \
+            self.store_owner(review_id)
+
+
+class Client:
+    """One keep-alive HTTP connection; reconnects after errors."""
+
+    def __init__(self, base_url, timeout=30.0):
+        parts = urlsplit(base_url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None, token=None):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, endpoint, latency, status):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append((latency, status))
+
+
+# 没有购物记录的用户 /purchase 返回 404 属于正常应答
+EXPECTED_STATUSES = {'purchase': (200, 404)}
+
+
+def is_error(status, endpoint):
+    return status not in EXPECTED_STATUSES.get(endpoint, (200,))
+
+
+def run_closed_loop(base_url, factory, concurrency, duration, warmup):
+    recorder = Recorder()
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    def worker(index):
+        rng = factory.rng(index)
+        client = Client(base_url)
+        while True:
+            # 令牌与店主在计时之前准备好
+            endpoint, method, path, body, token = factory.build(rng)
+            now = time.monotonic()
+            if now >= stop_at:
+                return
+            try:
+                status = client.request(method, path, body, token)
+            except Exception:
+                status = None
+            finished = time.monotonic()
+            if now >= measure_from:
+                recorder.record(endpoint, finished - now, status)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, duration
+
+
+def run_open_loop(base_url, factory, rate, duration, warmup, max_workers):
+    """Send requests at `rate` per second regardless of how fast the server answers."""
+    recorder = Recorder()
+    pending = queue.Queue()
+    rng = factory.rng('scheduler')
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    def worker(index):
+        client = Client(base_url)
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            scheduled, (endpoint, method, path, body, token) = item
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = client.request(method, path, body, token)
+            except Exception:
+                status = None
+            if scheduled >= measure_from:
+                recorder.record(endpoint, time.monotonic() - scheduled, status)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    # 泊松到达: 指数分布的请求间隔
+    scheduled = start
+    while scheduled < stop_at:
+        scheduled += rng.expovariate(rate)
+        pending.put((scheduled, factory.build(rng)))
+        ahead = scheduled - time.monotonic() - 1.0
+        if ahead > 0:
+            time.sleep(ahead)
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return recorder, duration
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # nearest-rank
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def summarize(recorder, duration):
+    results = {}
+    everything = []
+    errors_total = 0
+    for endpoint, samples in sorted(recorder.samples.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        errors = sum(1 for _, status in samples if is_error(status, endpoint))
+        errors_total += errors
+        everything.extend(latencies)
+        results[endpoint] = summary_row(latencies, errors, duration)
+    everything.sort()
+    results['all'] = summary_row(everything, errors_total, duration)
+    return results
+
+
+def summary_row(latencies, errors, duration):
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': errors / count if count else 0.0,
+        'req_per_s': count / duration if duration else 0.0,
+        'mean_ms': 1000 * sum(latencies) / count if count else None,
+        'p50_ms': _ms(percentile(latencies, 0.50)),
+        'p95_ms': _ms(percentile(latencies, 0.95)),
+        'p99_ms': _ms(percentile(latencies, 0.99)),
+    }
+
+
+def _ms(value):
+    return None if value is None else 1000 * value
+
+
+def print_table(results, baseline=None):
+    header = f'{"endpoint":<10}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>9}'
+    print(header)
+    print('-' * len(header))
+    for endpoint, row in results.items():
+        line = (f'{endpoint:<10}{row["req_per_s"]:>10.1f}{_fmt(row["p50_ms"])}'
+                f'{_fmt(row["p95_ms"])}{_fmt(row["p99_ms"])}{row["error_rate"]:>8.1%}')
+        if baseline and endpoint in baseline:
+            old = baseline[endpoint]
+            line += f'   req/s {_delta(row["req_per_s"], old["req_per_s"])}' \
+                    f'  p99 {_delta(row["p99_ms"], old["p99_ms"])}'
+        print(line)
+
+
+def _fmt(value):
+    return f'{value:>10.2f}' if value is not None else f'{"-":>10}'
+
+
+def _delta(new, old):
+    if not new or not old:
+        return '   n/a'
+    return f'{(new - old) / old:+6.1%}'
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(report, output):
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f'{stamp}-{report["commit"]}.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'[INFO]results written to {output}')
+    return output
+
+
+def add_load_arguments(parser):
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='endpoint weights, e.g. product=5,search=3,login=1')
+    parser.add_argument('--concurrency', type=int, default=16, help='closed-loop clients')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='open-loop arrival rate in req/s (overrides --concurrency)')
+    parser.add_argument('--max-workers', type=int, default=256,
+                        help='client threads available to the open-loop mode')
+    parser.add_argument('--duration', type=float, default=30.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5.0, help='unmeasured seconds first')
+
+
+def run_load(args, base_url, counts, db_path):
+    factory = RequestFactory(counts, args.mix, db_path, args.seed)
+    if args.rate:
+        print(f'[INFO]open loop at {args.rate:g} req/s for {args.duration:g}s against {base_url}')
+        recorder, duration = run_open_loop(base_url, factory, args.rate, args.duration,
+                                           args.warmup, args.max_workers)
+    else:
+        print(f'[INFO]{args.concurrency} clients for {args.duration:g}s against {base_url}')
+        recorder, duration = run_closed_loop(base_url, factory, args.concurrency,
+                                             args.duration, args.warmup)
+    return summarize(recorder, duration)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_load_arguments(parser)
+    parser.add_argument('--url', type=str, default=None,
+                        help='benchmark an already running server instead of starting one')
+    parser.add_argument('--counts-from', type=str, default=None,
+                        help='database the --url server uses, to draw valid ids from')
+    parser.add_argument('--output', type=str, default=None, help='JSON results file')
+    parser.add_argument('--compare', type=str, default=None, help='baseline JSON results file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    process = None
+    try:
+        if args.url:
+            base_url = args.url
+            source = args.counts_from or prepare_dataset(args.preset, args.scale, args.seed)
+            counts = dataset_counts(source)
+        else:
+            session_tokens()
+            source = prepare_dataset(args.preset, args.scale, args.seed)
+            db_path = copy_database(source, workdir)
+            counts = dataset_counts(db_path)
+            process, base_url = start_server(db_path)
+
+        results = run_load(args, base_url, counts, source)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_table(results, baseline)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'dataset': {'preset': args.preset, 'scale': args.scale, 'seed': args.seed, 'counts': counts},
+        'load': {'mode': 'open' if args.rate else 'closed', 'rate': args.rate,
+                 'concurrency': args.concurrency, 'duration': args.duration,
+                 'warmup': args.warmup, 'mix': args.mix},
+        'server': args.url or 'Server (flask development server)',
+        'results': results,
+    }
+    save_results(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Rows/sec of the legacy to_dict, the compiled to_dict and column-tuple rows.
+
+    python -m benchmarks.serializer --rows 50000
+"""
+import argparse
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from minishop.database.entities import Base, Product, Review
+
+
+def legacy_to_dict(obj):
+    # SerializerMixin.to_dict before the serializers were compiled
+    ret = {}
+    for c in obj.__table__.columns:
+        if isinstance(getattr(obj, c.name), datetime):
+            ret[c.name] = getattr(obj, c.name).strftime("%Y-%m-%d %H:%M:%S")
+        elif isinstance(getattr(obj, c.name), Decimal):
+            ret[c.name] = float(getattr(obj, c.name))
+        else:
+            ret[c.name] = getattr(obj, c.name)
+    return ret
+
+
+def populate(session, rows):
+    now = datetime(2025, 4, 1, 12, 0, 0)
+    session.bulk_insert_mappings(Product, [
+        dict(product_id=i, store_id=1, product_name=f'product {i}',
+             product_description=f'description of product {i}',
+             price=Decimal('19.90'), stock=100, created_at=now, status='active')
+        for i in range(1, rows + 1)])
+    session.bulk_insert_mappings(Review, [
+        dict(review_id=i, user_id=1, product_id=i, comment=f'comment {i}', rating=i % 5 + 1,
+             comment_time=now, reply='thanks', reply_time=now)
+        for i in range(1, rows + 1)])
+    session.commit()
+
+
+def measure(label, rows, func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print(f'{label:<44}{rows / best:>14,.0f} rows/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50000, help='rows per entity')
+    parser.add_argument('--repeat', type=int, default=5, help='best of N runs')
+    args = parser.parse_args()
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    populate(session, args.rows)
+
+    for entity in (Product, Review):
+        name = entity.__name__
+        objects = session.query(entity).all()
+        tuples = session.query(*entity.serializer_columns).all()
+        print(f'== {name} ({args.rows} rows)')
+        measure('serialize only: legacy to_dict', args.rows,
+                lambda: [legacy_to_dict(o) for o in objects], args.repeat)
+        measure('serialize only: compiled to_dict', args.rows,
+                lambda: [o.to_dict() for o in objects], args.repeat)
+        measure('serialize only: compiled row_to_dict', args.rows,
+                lambda: [entity.row_to_dict(r) for r in tuples], args.repeat)
+
+        def legacy_end_to_end():
+            session.expunge_all()
+            [legacy_to_dict(o) for o in session.query(entity).all()]
+
+        def compiled_end_to_end():
+            [entity.row_to_dict(r) for r in session.query(*entity.serializer_columns).all()]
+
+        measure('query + serialize: ORM objects, legacy', args.rows,
+                legacy_end_to_end, args.repeat)
+        measure('query + serialize: column tuples, compiled', args.rows,
+                compiled_end_to_end, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
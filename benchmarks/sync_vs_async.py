@@ -0,0 +1,78 @@
+"""Compare the sync (gunicorn gthread) and async (uvicorn) servers at high concurrency.
+
+Both servers run as a single process on their own copy of the same
+dataset and receive the same request mix from the same number of
+keep-alive clients.
+
+    python -m benchmarks.sync_vs_async --preset small --concurrency 512 --duration 30
+    python -m benchmarks.sync_vs_async --rate 2000 --threads 64
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+
+from benchmarks.http_load import (add_load_arguments, copy_database, dataset_counts,
+                                  prepare_dataset, print_table, run_load, save_results,
+                                  session_tokens, start_server, git_commit, parse_mix)
+
+READ_MIX = 'search=3,product=5,purchase=2,profile=2'
+
+
+def _serve_sync(db_path, host, port, threads):
+    from minishop.backend.wsgi import serve
+    serve(db_path, host, port, workers=1, threads=threads, max_requests=0)
+
+
+def _serve_async(db_path, host, port):
+    import uvicorn
+    os.environ['MINISHOP_DB'] = db_path
+    uvicorn.run('minishop.backend.asgi:create_app', factory=True, host=host, port=port,
+                log_level='warning')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_load_arguments(parser)
+    parser.set_defaults(concurrency=512, mix=parse_mix(READ_MIX))
+    parser.add_argument('--threads', type=int, default=32, help='threads of the sync worker')
+    parser.add_argument('--output', type=str, default=None, help='JSON results file')
+    args = parser.parse_args()
+
+    session_tokens()
+    source = prepare_dataset(args.preset, args.scale, args.seed)
+    counts = dataset_counts(source)
+    servers = (('sync', _serve_sync, (args.threads,)), ('async', _serve_async, ()))
+
+    results = {}
+    for name, target, extra_args in servers:
+        workdir = tempfile.mkdtemp()
+        process = None
+        try:
+            db_path = copy_database(source, workdir)
+            process, base_url = start_server(db_path, target=target, extra_args=extra_args)
+            print(f'[INFO]{name} server')
+            results[name] = run_load(args, base_url, counts, source)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.join()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for name in results:
+        print(f'== {name}' + (' (delta vs sync)' if name != 'sync' else ''))
+        print_table(results[name], results['sync'] if name != 'sync' else None)
+
+    save_results({
+        'commit': git_commit(),
+        'dataset': {'preset': args.preset, 'scale': args.scale, 'seed': args.seed, 'counts': counts},
+        'load': {'mode': 'open' if args.rate else 'closed', 'rate': args.rate,
+                 'concurrency': args.concurrency, 'duration': args.duration, 'mix': args.mix},
+        'sync_threads': args.threads,
+        'results': results,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,473 @@
+"""ASGI flavour of Server on AsyncDatabase: same routes, same JSON contracts.
+
+    python -m minishop.backend.asgi --db data/e_commerce.db --port 5000
+    uvicorn --factory minishop.backend.asgi:create_app      # db from $MINISHOP_DB
+
+Requests waiting on SQLite are suspended coroutines instead of blocked
+threads, so one process can hold thousands of slow connections open.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+from minishop.backend.auth import AuthError, AsyncSessionTokens, bearer_token
+from minishop.backend.metrics import Metrics
+from minishop.backend.shipping import AsyncShippingHub
+from minishop.backend.server import (PRODUCT_CACHE_CONTROL, PROFILE_CACHE_CONTROL,
+                                     RELATED_CACHE_CONTROL, json_dumps, not_modified,
+                                     validator_headers)
+from minishop.database.async_orm import AsyncDatabase
+from minishop.database.orm import (CheckoutError, PURCHASE_PAGE_SIZE, MAX_PURCHASE_PAGE_SIZE,
+                                   REVIEW_PAGE_SIZE, MAX_REVIEW_PAGE_SIZE, CATEGORY_PAGE_SIZE,
+                                   MAX_CATEGORY_PAGE_SIZE, SUGGEST_LIMIT, MAX_SUGGEST_LIMIT,
+                                   MAX_BATCH_REVIEW_LIMIT)
+from minishop.database.analytics import SALES_LIMIT
+from minishop.database.recommend import RELATED_LIMIT, MAX_RELATED_LIMIT
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization'),
+]
+
+
+def compile_route(rule):
+    """'/profile/<int:user_id>' -> regex with an int-converted named group"""
+    pattern = re.sub(r'<int:(\w+)>', r'(?P<\1>\\d+)', rule)
+    return re.compile(f'^{pattern}$')
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.endpoint = 'unmatched'
+        self.args = {key: values[0] for key, values in
+                     parse_qs(scope['query_string'].decode('latin-1')).items()}
+        self.headers = {name.decode('latin-1'): value.decode('latin-1')
+                        for name, value in scope['headers']}
+        self.body = body
+
+    @property
+    def json(self):
+        return json.loads(self.body) if self.body else None
+
+    def arg(self, name, default=None, type=str):
+        if name not in self.args:
+            return default
+        try:
+            return type(self.args[name])
+        except ValueError:
+            return default
+
+
+class AsyncServer:
+    def __init__(self, db_url='data/test.db', allow_anonymous=False, slow_request_threshold=0.5,
+                 metrics_dir=None):
+        self.db = AsyncDatabase(db_url)
+        self.auth = AsyncSessionTokens(self.db, required=not allow_anonymous)
+        self.shipping = AsyncShippingHub(self.db)
+        # 与 Server 相同的 /metrics, 但不统计各请求的 SQL; 多个 worker 经 metrics_dir 汇总
+        self.instrumentation = Metrics(slow_request_threshold, metrics_dir)
+        self.instrumentation.instrument_async(self.db)
+        self.instrumentation.instrument_shipping(self.shipping)
+        self.routes = [(rule, compile_route(rule), methods) for rule, methods in (
+            ('/login', {'POST': self.login}),
+            ('/logout', {'POST': self.logout}),
+            ('/search', {'POST': self.search}),
+            ('/suggest', {'GET': self.suggest}),
+            ('/category', {'GET': self.category}),
+            ('/profile/<int:user_id>', {'GET': self.get_profile,
+                                        'POST': self.update_profile}),
+            ('/purchase/<int:user_id>', {'GET': self.purchase}),
+            ('/product/<int:product_id>', {'GET': self.product}),
+            ('/product/<int:product_id>/related', {'GET': self.related}),
+            ('/products', {'POST': self.products}),
+            ('/review/<int:review_id>', {'GET': self.delete_review,
+                                         'POST': self.add_review}),
+            ('/reply/<int:review_id>', {'GET': self.delete_reply,
+                                        'POST': self.add_reply}),
+            ('/checkout', {'POST': self.checkout}),
+            ('/merchant/<int:user_id>/sales', {'GET': self.merchant_sales}),
+            ('/shipping/stream/<int:user_id>', {'GET': self.shipping_stream}),
+            ('/shipping/events', {'POST': self.shipping_events}),
+            ('/metrics', {'GET': self.metrics}),
+        )]
+
+    async def authorize(self, request, user_id=None, user_type=None, query_token=False,
+                        required=False):
+        """`server.authorize` for ASGI requests; raises AuthError instead of aborting."""
+        token = bearer_token(request.headers.get('authorization'))
+        if token is None and query_token:
+            token = request.arg('access_token') or None
+        if token is None:
+            if self.auth.required or required:
+                raise AuthError('Authentication required')
+            return None
+        identity = await self.auth.authenticate(token)
+        if user_id is not None and identity['user_id'] != user_id:
+            raise AuthError('Token does not belong to this user', 403)
+        if user_type is not None and identity['user_type'] != user_type:
+            raise AuthError(f'Only a {user_type} can do this', 403)
+        return identity
+
+    @staticmethod
+    def not_modified(request, headers):
+        return not_modified(headers, request.headers.get('if-none-match'),
+                            request.headers.get('if-modified-since'))
+
+    async def login(self, request):
+        data = request.json
+        session = await self.auth.login(data['username'], data['password_hash'])
+        if session is not None:
+            return session, 200
+        return {"error": "Invalid username or password"}, 401
+
+    async def logout(self, request):
+        if await self.authorize(request) is None:
+            raise AuthError('Authentication required')
+        if await self.auth.logout(bearer_token(request.headers.get('authorization'))):
+            return True, 200
+        return {"error": "Failed to revoke session"}, 500
+
+    async def search(self, request):
+        data = request.json
+        try:
+            return await self.db.search_for_product(
+                data['query'], data['field'], data.get('sort', 'relevance')), 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+    async def suggest(self, request):
+        prefix = request.arg('q', '').strip()
+        limit = request.arg('limit', SUGGEST_LIMIT, int)
+        limit = max(1, min(limit, MAX_SUGGEST_LIMIT))
+        if not prefix:
+            return {"products": [], "categories": []}, 200
+        return await self.db.suggest(prefix, limit), 200
+
+    async def category(self, request):
+        limit = request.arg('limit', CATEGORY_PAGE_SIZE, int)
+        limit = max(1, min(limit, MAX_CATEGORY_PAGE_SIZE))
+        categories, products, next_after_product_id = await self.db.get_category_products(
+            request.arg('query', ''), request.arg('after_product_id', None, int), limit)
+        if categories:
+            return {"categories": categories, "products": products,
+                    "next_after_product_id": next_after_product_id}, 200
+        return {"error": "Category not found"}, 404
+
+    async def get_profile(self, request, user_id):
+        await self.authorize(request, user_id)
+        version = await self.db.get_version('user', user_id)
+        headers = validator_headers('u', user_id, version, PROFILE_CACHE_CONTROL)
+        headers['Vary'] = 'Authorization'
+        if self.not_modified(request, headers):
+            return None, 304, headers
+        user = await self.db.get_user(user_id, version and version[0])
+        if user is not None:
+            return user, 200, headers
+        return {"error": "User not found"}, 404
+
+    async def update_profile(self, request, user_id):
+        await self.authorize(request, user_id, required=True)
+        if await self.db.update_user(user_id, **request.json):
+            return True, 200
+        return {"error": "User not found"}, 404
+
+    async def purchase(self, request, user_id):
+        await self.authorize(request, user_id)
+        limit = request.arg('limit', PURCHASE_PAGE_SIZE, int)
+        limit = max(1, min(limit, MAX_PURCHASE_PAGE_SIZE))
+        orders, trackings, next_before_order_id = await self.db.get_purchase_history(
+            user_id, request.arg('before_order_id', None, int), limit)
+        if orders:
+            return {"orders": orders, "trackings": trackings,
+                    "next_before_order_id": next_before_order_id}, 200
+        return {"error": "No purchase history found"}, 404
+
+    async def product(self, request, product_id):
+        review_limit = request.arg('review_limit', REVIEW_PAGE_SIZE, int)
+        review_limit = max(1, min(review_limit, MAX_REVIEW_PAGE_SIZE))
+        version = await self.db.get_version('product', product_id)
+        headers = validator_headers('p', product_id, version, PRODUCT_CACHE_CONTROL)
+        if self.not_modified(request, headers):
+            return None, 304, headers
+        try:
+            product, reviews, seller_id, next_review_cursor = await self.db.get_product(
+                product_id, request.arg('review_sort', 'newest'),
+                request.arg('review_cursor'), review_limit, version and version[0])
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        if product is not None:
+            return {"product": product, "reviews": reviews, "seller_id": seller_id,
+                    "next_review_cursor": next_review_cursor}, 200, headers
+        return {"error": "Product not found"}, 404
+
+    async def related(self, request, product_id):
+        limit = max(1, min(request.arg('limit', RELATED_LIMIT, int), MAX_RELATED_LIMIT))
+        related = await self.db.get_related_products(product_id, limit)
+        if related is not None:
+            return ({"product_id": product_id, "related": related}, 200,
+                    {'Cache-Control': RELATED_CACHE_CONTROL})
+        return {"error": "Recommendations are not built"}, 503
+
+    async def products(self, request):
+        data = request.json
+        review_limit = data.get('review_limit', 0)
+        if type(review_limit) is not int:
+            return {"error": "review_limit must be an integer"}, 400
+        review_limit = max(0, min(review_limit, MAX_BATCH_REVIEW_LIMIT))
+        try:
+            return await self.db.get_products(data.get('product_ids'),
+                                              data.get('review_sort', 'newest'), review_limit), 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+    async def delete_review(self, request, review_id):
+        identity = await self.authorize(request, required=True)
+        owners = await self.db.get_review_owners(review_id)
+        if owners is None:
+            return {"error": "Review not found"}, 404
+        if owners.user_id != identity['user_id']:
+            raise AuthError('Only the author can delete this review', 403)
+        if await self.db.delete_review(review_id):
+            return True, 200
+        return {"error": "Review not found"}, 404
+
+    async def add_review(self, request, review_id):
+        review = request.json
+        await self.authorize(request, review.get('user_id'), required=True)
+        if await self.db.add_review(review):
+            return True, 200
+        return {"error": "Failed to add review"}, 400
+
+    async def delete_reply(self, request, review_id):
+        identity = await self.authorize(request, user_type='merchant', required=True)
+        owners = await self.db.get_review_owners(review_id)
+        if owners is None:
+            return {"error": "Review not found"}, 404
+        if owners.owner_id != identity['user_id']:
+            raise AuthError('Only the store owner can reply to this review', 403)
+        if await self.db.delete_reply(review_id):
+            return True, 200
+        return {"error": "Review not found"}, 404
+
+    async def add_reply(self, request, review_id):
+        reply = request.json
+        identity = await self.authorize(request, user_type='merchant', required=True)
+        owners = await self.db.get_review_owners(reply.get('review_id'))
+        if owners is None:
+            return {"error": "Review not found"}, 404
+        if owners.owner_id != identity['user_id']:
+            raise AuthError('Only the store owner can reply to this review', 403)
+        if await self.db.add_reply(reply):
+            return True, 200
+        return {"error": "Failed to add review"}, 400
+
+    async def checkout(self, request):
+        data = request.json
+        await self.authorize(request, data.get('user_id'), required=True)
+        try:
+            order = await self.db.checkout(data['user_id'], data['items'],
+                                           data.get('payment_method'))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except CheckoutError as e:
+            return {"error": str(e), "product_id": e.product_id, "available": e.available}, 409
+        if order is not None:
+            return order, 200
+        return {"error": "Failed to place order"}, 400
+
+    async def merchant_sales(self, request, user_id):
+        await self.authorize(request, user_id, user_type='merchant')
+        try:
+            report = await self.db.get_merchant_sales(
+                user_id, request.arg('from'), request.arg('to'), request.arg('group_by', 'day'),
+                request.arg('limit', SALES_LIMIT, int), request.arg('store_id', None, int))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        if report is not None:
+            return report, 200
+        return {"error": "Sales reporting is not set up"}, 503
+
+    async def shipping_stream(self, request, user_id):
+        await self.authorize(request, user_id, query_token=True)
+        last_event_id = request.headers.get('last-event-id') or request.arg('last_event_id')
+        try:
+            last_event_id = int(last_event_id) if last_event_id else None
+        except ValueError:
+            last_event_id = None
+        chunks = self.shipping.stream(user_id, request.arg('shipping_id', None, int), last_event_id)
+        return chunks, 200, {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'}
+
+    async def shipping_events(self, request):
+        data = request.json
+        identity = await self.authorize(request, user_type='merchant', required=True)
+        try:
+            result = await self.db.add_shipping_events(data.get('events'), identity['user_id'])
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        if result is None:
+            return {"error": "Failed to record shipping events"}, 500
+        self.shipping.notify()
+        return result, 200
+
+    async def metrics(self, request):
+        """Prometheus metrics, see metrics.py"""
+        return self.instrumentation.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    async def dispatch(self, request):
+        if request.method == 'OPTIONS':
+            return None, 200
+        for rule, pattern, methods in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            request.endpoint = rule
+            handler = methods.get(request.method)
+            if handler is None:
+                return {"message": "The method is not allowed for the requested URL."}, 405
+            kwargs = {name: int(value) for name, value in match.groupdict().items()}
+            try:
+                return await handler(request, **kwargs)
+            except json.JSONDecodeError:
+                return {"message": "Failed to decode JSON object"}, 400
+            except AuthError as e:
+                return {"error": str(e)}, e.status
+            except Exception as e:
+                print(f"An unexpected error occurred: {e}")
+                return {"message": "Internal Server Error"}, 500
+        return {"message": "The requested URL was not found on the server."}, 404
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        # 处理函数返回 (data, status) 或 (data, status, 额外响应头); data 为异步迭代器时按流发送,
+        # 为 str 时按额外响应头中的 Content-Type 原样发送
+        start = time.perf_counter()
+        request = Request(scope, body)
+        data, status, *extra = await self.dispatch(request)
+        if hasattr(data, '__aiter__'):
+            await self.send_stream(data, status, extra[0], receive, send)
+        else:
+            if isinstance(data, str):
+                payload = data
+                headers = []
+            else:
+                payload = b'' if data is None else json_dumps(data)
+                headers = [(b'content-type', b'application/json')]
+            if isinstance(payload, str):
+                payload = payload.encode('utf-8')
+            headers += [(b'content-length', str(len(payload)).encode())] + CORS_HEADERS
+            for extra_headers in extra:
+                headers += [(name.lower().encode(), value.encode())
+                            for name, value in extra_headers.items()]
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': payload})
+        self.instrumentation.observe(request.endpoint, request.method, scope['path'], status,
+                                     time.perf_counter() - start)
+
+    @staticmethod
+    async def send_stream(chunks, status, extra_headers, receive, send):
+        """Send each chunk of `chunks` as it comes until it ends or the client disconnects."""
+        headers = [(name.lower().encode(), value.encode()) for name, value in extra_headers.items()]
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers + CORS_HEADERS})
+
+        async def pump():
+            async for chunk in chunks:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        pumping, watching = asyncio.create_task(pump()), asyncio.create_task(disconnected())
+        done, pending = await asyncio.wait({pumping, watching}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # 生成器在取消后关闭, 其 finally 中注销订阅
+        await chunks.aclose()
+        if pumping in done and not pumping.exception():
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.db.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shipping.close()
+                self.instrumentation.retire()
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def create_app():
+    return AsyncServer(os.environ.get('MINISHOP_DB', 'data/e_commerce.db'),
+                       os.environ.get('MINISHOP_ALLOW_ANONYMOUS') == '1',
+                       metrics_dir=os.environ.get('MINISHOP_METRICS_DIR'))
+
+
+def has_session_key(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'Session_Key'").fetchone() is not None
+    finally:
+        conn.close()
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default='data/e_commerce.db', help='database file name')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--allow-anonymous', action='store_true',
+                        help='serve user-scoped reads without a session token, writes still need one')
+    args = parser.parse_args()
+
+    os.environ['MINISHOP_DB'] = args.db
+    if args.workers > 1 and not os.environ.get('MINISHOP_SECRET_KEY') and not has_session_key(args.db):
+        # uvicorn 的 worker 各自导入应用, 没有共享密钥时由这里生成一个经环境变量传给全部 worker
+        os.environ['MINISHOP_SECRET_KEY'] = AsyncSessionTokens.new_secret()
+    if args.allow_anonymous:
+        os.environ['MINISHOP_ALLOW_ANONYMOUS'] = '1'
+    metrics_dir = None
+    if args.workers > 1 and not os.environ.get('MINISHOP_METRICS_DIR'):
+        # /metrics 汇总全部 worker, 与 wsgi.serve 相同
+        metrics_dir = os.environ['MINISHOP_METRICS_DIR'] = tempfile.mkdtemp(prefix='minishop-metrics-')
+    try:
+        uvicorn.run('minishop.backend.asgi:create_app', factory=True, host=args.host,
+                    port=args.port, workers=args.workers, log_level='warning')
+    finally:
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
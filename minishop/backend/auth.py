@@ -0,0 +1,232 @@
+"""Signed session tokens issued by /login and checked on every request.
+
+A token is "<payload>.<signature>": the payload "user_id:expires_at:token_id"
+and its HMAC-SHA256 under a key shared by all processes on the database
+(Session_Key, or $MINISHOP_SECRET_KEY), both base64url encoded. Checking
+one costs an HMAC, a lookup in the process's set of revoked token ids and
+a lookup in an in-process TTL/LRU cache of user identities, so a request
+normally never touches SQLite. Revocations (logout) are written to
+Session_Revocation and every process pulls the new ones at most every
+`revocation_poll` seconds, which bounds how long a revoked token keeps
+working elsewhere.
+
+Without either shared key every process makes its own, valid only there;
+`shared_secret` tells the two apart, so a multi-process server can settle
+the key before it forks (see wsgi.py).
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+
+from minishop.database.cache import QueryCache
+
+TOKEN_TTL = 24 * 3600
+REVOCATION_POLL = 1.0
+
+
+class AuthError(Exception):
+    """Rejected credentials; `status` is 401 for a missing or bad token, 403 for a forbidden action."""
+
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.status = status
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def bearer_token(authorization):
+    """Token of an "Authorization: Bearer <token>" header value, None when absent."""
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(' ')
+    if scheme.lower() != 'bearer' or not token.strip():
+        raise AuthError('Malformed Authorization header')
+    return token.strip()
+
+
+class SessionTokens:
+    """Issue, check and revoke tokens for the users of `db` (a Database).
+
+    With `required` (the default) every user-scoped endpoint demands a
+    token; otherwise reads without one are served on the user_id they
+    name, for old clients, while writes still demand one.
+    """
+
+    def __init__(self, db, secret=None, token_ttl=TOKEN_TTL, required=True,
+                 identity_entries=65536, identity_ttl=60.0, revocation_poll=REVOCATION_POLL):
+        self.db = db
+        self.secret = (secret or os.environ.get('MINISHOP_SECRET_KEY') or '').encode() or None
+        self.shared_secret = self.secret is not None
+        self.token_ttl = token_ttl
+        self.required = required
+        self.identities = QueryCache(identity_entries, identity_ttl)
+        self.revocation_poll = revocation_poll
+        self.revoked = {}               # token_id -> expires_at
+        self.revocation_cursor = 0
+        self.polled_at = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_secret():
+        return secrets.token_urlsafe(32)
+
+    def _use_secret(self, secret):
+        if secret:
+            self.secret = secret.encode()
+            self.shared_secret = True
+        else:
+            # 没有共享存储时退回进程内密钥: 令牌只在本进程有效, 重启后失效
+            print("[WARN]no shared session key, tokens are only valid in this process and its forks")
+            self.secret = self.new_secret().encode()
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, user_id):
+        """(token, expires_at) of a new token for `user_id`."""
+        expires_at = int(time.time() + self.token_ttl)
+        payload = f'{user_id}:{expires_at}:{secrets.token_urlsafe(12)}'.encode()
+        return f'{_b64encode(payload)}.{_b64encode(self._sign(payload))}', expires_at
+
+    def decode(self, token):
+        """(user_id, expires_at, token_id) of a well-signed, unexpired token."""
+        try:
+            payload_text, _, signature_text = token.partition('.')
+            payload, signature = _b64decode(payload_text), _b64decode(signature_text)
+            user_id, expires_at, token_id = payload.decode('ascii').split(':')
+            user_id, expires_at = int(user_id), int(expires_at)
+        except ValueError:
+            raise AuthError('Malformed token')
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise AuthError('Invalid token')
+        if expires_at < time.time():
+            raise AuthError('Token expired')
+        return user_id, expires_at, token_id
+
+    def _claim_poll(self):
+        """True for the one caller that should pull new revocations now."""
+        if not self.db.has_session_store:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            if self.polled_at is not None and now - self.polled_at < self.revocation_poll:
+                return False
+            self.polled_at = now
+            return True
+
+    def _apply_revocations(self, rows):
+        now = time.time()
+        with self.lock:
+            for revocation_id, token_id, expires_at in rows:
+                self.revoked[token_id] = expires_at
+                self.revocation_cursor = max(self.revocation_cursor, revocation_id)
+            for token_id in [t for t, expires_at in self.revoked.items() if expires_at < now]:
+                del self.revoked[token_id]
+
+    def _check_revoked(self, token_id):
+        if token_id in self.revoked:
+            raise AuthError('Token revoked')
+
+    @staticmethod
+    def _known(identity):
+        if identity is None:
+            raise AuthError('Unknown user')
+        return identity
+
+    def ensure_secret(self):
+        """Load the signing key (or make a process-local one) unless already done."""
+        if self.secret is None:
+            with self.lock:
+                if self.secret is None:
+                    secret = (self.db.get_session_secret(self.new_secret())
+                              if self.db.has_session_store else None)
+                    self._use_secret(secret)
+
+    def login(self, username, password_hash):
+        """{'user_id', 'user_type', 'token', 'expires_at'}, None for bad credentials."""
+        user_id = self.db.confirm_user(username, password_hash)
+        if user_id is None:
+            return None
+        identity = self.identity(user_id)
+        self.ensure_secret()
+        token, expires_at = self.issue(user_id)
+        return {'user_id': user_id, 'user_type': identity['user_type'],
+                'token': token, 'expires_at': expires_at}
+
+    def identity(self, user_id):
+        return self._known(self.identities.get_or_load(
+            user_id, (), lambda: self.db.get_identity(user_id)))
+
+    def authenticate(self, token):
+        """Identity {'user_id', 'username', 'user_type'} of the token's user, or AuthError."""
+        self.ensure_secret()
+        user_id, _, token_id = self.decode(token)
+        if self._claim_poll():
+            self._apply_revocations(self.db.get_revocations(self.revocation_cursor))
+        self._check_revoked(token_id)
+        return self.identity(user_id)
+
+    def logout(self, token):
+        """Revoke `token` in every process; False when it could not be recorded."""
+        self.ensure_secret()
+        user_id, expires_at, token_id = self.decode(token)
+        with self.lock:
+            self.revoked[token_id] = expires_at
+        if not self.db.has_session_store:
+            return True
+        return self.db.revoke_session(token_id, user_id, expires_at)
+
+
+class AsyncSessionTokens(SessionTokens):
+    """SessionTokens over an AsyncDatabase; the Database-backed operations are coroutines."""
+
+    async def ensure_secret(self):
+        if self.secret is None:
+            secret = (await self.db.get_session_secret(self.new_secret())
+                      if self.db.has_session_store else None)
+            if self.secret is None:
+                self._use_secret(secret)
+
+    async def login(self, username, password_hash):
+        user_id = await self.db.confirm_user(username, password_hash)
+        if user_id is None:
+            return None
+        identity = await self.identity(user_id)
+        await self.ensure_secret()
+        token, expires_at = self.issue(user_id)
+        return {'user_id': user_id, 'user_type': identity['user_type'],
+                'token': token, 'expires_at': expires_at}
+
+    async def identity(self, user_id):
+        found, result = self.identities.lookup(user_id, ())
+        if found:
+            return self._known(result)
+        identity = await self.db.get_identity(user_id)
+        self.identities.store(user_id, identity, result)
+        return self._known(identity)
+
+    async def authenticate(self, token):
+        await self.ensure_secret()
+        user_id, _, token_id = self.decode(token)
+        if self._claim_poll():
+            self._apply_revocations(await self.db.get_revocations(self.revocation_cursor))
+        self._check_revoked(token_id)
+        return await self.identity(user_id)
+
+    async def logout(self, token):
+        await self.ensure_secret()
+        user_id, expires_at, token_id = self.decode(token)
+        self.revoked[token_id] = expires_at
+        if not self.db.has_session_store:
+            return True
+        return await self.db.revoke_session(token_id, user_id, expires_at)
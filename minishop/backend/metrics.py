@@ -0,0 +1,351 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+# 请求耗时直方图的桶上界(秒)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 慢请求日志中每个请求最多保留的 SQL 条数
+MAX_STATEMENTS_PER_REQUEST = 200
+# 共享目录中本进程快照的最短写入间隔(秒)
+DUMP_INTERVAL = 1.0
+RETIRED_FILE = 'retired.json'
+SHARED_LOCK_FILE = 'metrics.lock'
+
+
+class EndpointStats:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency_sum = 0.0
+        self.statuses = defaultdict(int)
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.sql_rows = 0
+
+
+class RequestSQL:
+    """SQL run on behalf of one request, including its queued writes."""
+
+    def __init__(self):
+        self.statements = []
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+
+
+class Metrics:
+    """Per-endpoint request latency and SQL statistics, rendered in Prometheus text format.
+
+    `init_app` hooks the Flask request lifecycle, `instrument` hooks the
+    engine and session of a Database; the ASGI server calls `observe` per
+    request itself and `instrument_async` reports an AsyncDatabase's
+    caches without counting its SQL. Statements are attributed to the
+    request running on the same thread, or, on the writer thread, to the
+    request that queued the write; other SQL is not counted. Requests
+    slower than `slow_threshold` seconds are logged with every statement
+    they ran.
+
+    Counters are kept per process. Worker processes that share a
+    `shared_dir` each write a snapshot there at most every DUMP_INTERVAL
+    seconds and on exit (`retire`), and /metrics on any of them renders
+    the sum, so counters only grow whichever worker is scraped; gauges
+    sum the workers still running.
+    """
+
+    def __init__(self, slow_threshold=0.5, shared_dir=None):
+        self.slow_threshold = slow_threshold
+        self.shared_dir = shared_dir
+        self.dumped_at = None
+        self.dump_lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointStats)
+        self.lock = threading.Lock()
+        self.db = None
+        self.shipping = None
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def instrument(self, db):
+        self.db = db
+        event.listen(db.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(db.session, 'do_orm_execute', self._do_orm_execute)
+        db.writer.key_factory = self._request_sql
+
+    def instrument_async(self, db):
+        self.db = db
+
+    def instrument_shipping(self, hub):
+        self.shipping = hub
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql = RequestSQL()
+
+    def _after_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        latency = time.perf_counter() - g.metrics_start
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.observe(endpoint, request.method, request.full_path.rstrip('?'),
+                     response.status_code, latency, g.metrics_sql)
+        return response
+
+    def observe(self, endpoint, method, path, status, latency, sql=None):
+        """Count one request to the route `endpoint`; `sql` is the RequestSQL it ran, if tracked."""
+        with self.lock:
+            stats = self.endpoints[endpoint, method]
+            stats.count += 1
+            stats.latency_sum += latency
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    stats.buckets[i] += 1
+            stats.statuses[status] += 1
+            if sql is not None:
+                stats.sql_statements += sql.count
+                stats.sql_seconds += sql.seconds
+                stats.sql_rows += sql.rows
+        if latency >= self.slow_threshold:
+            self._log_slow_request(method, path, latency, sql)
+        if self.shared_dir is not None and (
+                self.dumped_at is None or time.monotonic() - self.dumped_at >= DUMP_INTERVAL):
+            self.dump()
+
+    def _log_slow_request(self, method, path, latency, sql):
+        if sql is None:
+            print(f"[SLOW]{method} {path} took {latency * 1000:.1f}ms", flush=True)
+            return
+        lines = [f"[SLOW]{method} {path} took {latency * 1000:.1f}ms, "
+                 f"{sql.count} statements, {sql.seconds * 1000:.1f}ms in SQL"]
+        for statement, parameters, seconds in sql.statements:
+            lines.append(f"    {seconds * 1000:8.2f}ms  {' '.join(statement.split())}  {parameters!r}")
+        print('\n'.join(lines), flush=True)
+
+    def _request_sql(self):
+        if has_request_context() and 'metrics_sql' in g:
+            return g.metrics_sql
+        return None
+
+    def _current_sql(self):
+        # 写线程上执行的是排队写操作, 归属到提交它的请求
+        sql = self._request_sql()
+        if sql is None and self.db is not None:
+            sql = self.db.writer.current_key()
+        return sql
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # 起始时间放在执行上下文上, 语句出错时随上下文一起丢弃
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, '_metrics_start', None)
+        sql = self._current_sql()
+        if start is None or sql is None:
+            return
+        seconds = time.perf_counter() - start
+        sql.count += 1
+        sql.seconds += seconds
+        # SELECT 的 rowcount 为 -1, 其行数在 _do_orm_execute 中统计
+        if cursor.rowcount > 0:
+            sql.rows += cursor.rowcount
+        if len(sql.statements) < MAX_STATEMENTS_PER_REQUEST:
+            sql.statements.append((statement, parameters, seconds))
+
+    def _do_orm_execute(self, orm_execute_state):
+        sql = self._current_sql()
+        if not orm_execute_state.is_select or sql is None:
+            return None
+        # 缓冲结果以统计返回行数; Database 的查询本来就会取回全部结果
+        frozen = orm_execute_state.invoke_statement().freeze()
+        sql.rows += len(frozen.data)
+        return frozen()
+
+    # 多进程汇总
+
+    def _process_values(self):
+        """(counters, gauges) of the Database and ShippingHub of this process."""
+        counters, gauges = {}, {}
+        if self.db is not None:
+            cache = self.db.cache_stats()
+            for name in ('hits', 'misses', 'evictions', 'invalidations', 'expirations'):
+                counters[f'minishop_cache_{name}_total'] = cache[name]
+            gauges['minishop_cache_entries'] = cache['entries']
+            # AsyncDatabase 没有写队列
+            if hasattr(self.db, 'writer'):
+                writer = self.db.writer.stats()
+                for name in ('commits', 'operations', 'replays'):
+                    counters[f'minishop_write_{name}_total'] = writer[name]
+            suggest = self.db.suggester.stats()
+            for name in ('entries', 'keys', 'bytes'):
+                value = suggest['products'] + suggest['categories'] if name == 'entries' else suggest[name]
+                gauges[f'minishop_suggest_{name}'] = value
+            related = self.db.related_products.stats()
+            gauges['minishop_related_products'] = related['products']
+            counters['minishop_related_loads_total'] = related['loads']
+        if self.shipping is not None:
+            shipping = self.shipping.stats()
+            gauges['minishop_shipping_subscribers'] = shipping['subscribers']
+            for name in ('polls', 'delivered', 'dropped', 'rejected'):
+                counters[f'minishop_shipping_{name}_total'] = shipping[name]
+        return counters, gauges
+
+    def snapshot(self):
+        """Everything this process renders, as a JSON-serializable dict."""
+        with self.lock:
+            endpoints = [[endpoint, method, {
+                'buckets': list(stats.buckets), 'count': stats.count,
+                'latency_sum': stats.latency_sum,
+                'statuses': {str(status): count for status, count in stats.statuses.items()},
+                'sql_statements': stats.sql_statements, 'sql_seconds': stats.sql_seconds,
+                'sql_rows': stats.sql_rows}] for (endpoint, method), stats in self.endpoints.items()]
+        counters, gauges = self._process_values()
+        return {'pid': os.getpid(), 'endpoints': endpoints, 'counters': counters, 'gauges': gauges}
+
+    def _path(self, name):
+        return os.path.join(self.shared_dir, name)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        with open(self._path(SHARED_LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _write(self, name, snapshot):
+        temporary = self._path(f'{name}.{os.getpid()}.tmp')
+        with open(temporary, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temporary, self._path(name))
+
+    def _read(self, name):
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def dump(self, wait=False):
+        """Write this process's snapshot to `shared_dir` for the other workers' /metrics."""
+        # 同时结束的请求只需一个写入
+        if self.shared_dir is None or not self.dump_lock.acquire(blocking=wait):
+            return
+        try:
+            self.dumped_at = time.monotonic()
+            self._write(f'{os.getpid()}.json', self.snapshot())
+        finally:
+            self.dump_lock.release()
+
+    def retire(self):
+        """Fold this process's counters into the retired totals of `shared_dir` and
+        remove its file, so an exiting worker's counts are kept without its gauges."""
+        if self.shared_dir is None:
+            return
+        snapshot = self.snapshot()
+        with self._locked(fcntl.LOCK_EX):
+            retired = self._read(RETIRED_FILE)
+            snapshots = [snapshot] if retired is None else [retired, snapshot]
+            endpoints, counters, _ = merge_snapshots(snapshots)
+            self._write(RETIRED_FILE, {
+                'pid': None, 'counters': counters, 'gauges': {},
+                'endpoints': [[endpoint, method, stats]
+                              for (endpoint, method), stats in endpoints.items()]})
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(f'{os.getpid()}.json'))
+
+    def _snapshots(self):
+        if self.shared_dir is None:
+            return [self.snapshot()]
+        # 每个 worker 都只从它最近写入的文件读取, 文件中的计数只增不减,
+        # 因此无论抓取落在哪个 worker 上, 汇总值都不会回退
+        self.dump(wait=True)
+        snapshots = []
+        with self._locked(fcntl.LOCK_SH):
+            for name in os.listdir(self.shared_dir):
+                if name.endswith('.json'):
+                    snapshot = self._read(name)
+                    if snapshot is not None:
+                        snapshots.append(snapshot)
+        return snapshots
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format, summed over
+        every worker sharing `shared_dir`."""
+        endpoints, counters, gauges = merge_snapshots(self._snapshots())
+        endpoints = sorted(endpoints.items())
+        lines = ['# HELP minishop_request_duration_seconds Request latency.',
+                 '# TYPE minishop_request_duration_seconds histogram']
+        for (endpoint, method), stats in endpoints:
+            labels = f'endpoint="{endpoint}",method="{method}"'
+            for bound, count in zip(LATENCY_BUCKETS, stats['buckets']):
+                lines.append(f'minishop_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'minishop_request_duration_seconds_bucket{{{labels},le="+Inf"}} {stats["count"]}')
+            lines.append(f'minishop_request_duration_seconds_sum{{{labels}}} {stats["latency_sum"]}')
+            lines.append(f'minishop_request_duration_seconds_count{{{labels}}} {stats["count"]}')
+
+        lines += ['# HELP minishop_requests_total Requests by response status.',
+                  '# TYPE minishop_requests_total counter']
+        for (endpoint, method), stats in endpoints:
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append(f'minishop_requests_total{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+        for name, attribute, help_text in (
+                ('minishop_sql_statements_total', 'sql_statements', 'SQL statements executed.'),
+                ('minishop_sql_duration_seconds_total', 'sql_seconds', 'Time spent executing SQL.'),
+                ('minishop_sql_rows_total', 'sql_rows', 'Rows returned or modified by SQL.')):
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (endpoint, method), stats in endpoints:
+                lines.append(f'{name}{{endpoint="{endpoint}",method="{method}"}} {stats[attribute]}')
+
+        for name, value in counters.items():
+            lines += [f'# TYPE {name} counter', f'{name} {value}']
+        for name, value in gauges.items():
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge_snapshots(snapshots):
+    """(endpoints {(endpoint, method): stats}, counters, gauges) summed over `snapshots`;
+    gauges only of processes still running."""
+    endpoints, counters, gauges = {}, {}, {}
+    for snapshot in snapshots:
+        for endpoint, method, stats in snapshot['endpoints']:
+            merged = endpoints.get((endpoint, method))
+            if merged is None:
+                endpoints[endpoint, method] = merged = {
+                    'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'latency_sum': 0.0,
+                    'statuses': {}, 'sql_statements': 0, 'sql_seconds': 0.0, 'sql_rows': 0}
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], stats['buckets'])]
+            for status, count in stats['statuses'].items():
+                merged['statuses'][status] = merged['statuses'].get(status, 0) + count
+            for name in ('count', 'latency_sum', 'sql_statements', 'sql_seconds', 'sql_rows'):
+                merged[name] += stats[name]
+        for name, value in snapshot['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        # 已退出的 worker 只保留计数, 其瞬时值不再成立
+        if snapshot['pid'] is None or not process_alive(snapshot['pid']):
+            continue
+        for name, value in snapshot['gauges'].items():
+            gauges[name] = gauges.get(name, 0) + value
+    return endpoints, counters, gauges
@@ -1,33 +1,144 @@
-from flask import Flask, request
-from flask_restful import Resource, Api
+from flask import Flask, Response, request, make_response
+from flask_restful import Resource, Api, abort
 from flask_cors import CORS
+from werkzeug.http import http_date, parse_date, parse_etags
 
-from minishop.database.orm import Database
+try:
+    import orjson
+
+    def json_dumps(data):
+        return orjson.dumps(data)
+except ImportError:
+    import json
+
+    def json_dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+from minishop.backend.auth import AuthError, SessionTokens, bearer_token
+from minishop.backend.metrics import Metrics
+from minishop.backend.shipping import STREAM_RETRY_AFTER, ShippingHub, TooManyStreams
+from minishop.database.orm import (Database, CheckoutError, PURCHASE_PAGE_SIZE,
+                                   MAX_PURCHASE_PAGE_SIZE, REVIEW_PAGE_SIZE,
+                                   MAX_REVIEW_PAGE_SIZE, CATEGORY_PAGE_SIZE,
+                                   MAX_CATEGORY_PAGE_SIZE, SUGGEST_LIMIT, MAX_SUGGEST_LIMIT,
+                                   MAX_BATCH_REVIEW_LIMIT)
+from minishop.database.analytics import SALES_LIMIT
+from minishop.database.recommend import RELATED_LIMIT, MAX_RELATED_LIMIT
+
+
+def output_json(data, code, headers=None):
+    """Flask-RESTful representation encoding responses with orjson when available"""
+    response = make_response(json_dumps(data), code)
+    response.headers.extend(headers or {})
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+# 商品页公开, 反向代理可缓存几秒后再用 ETag 重新验证; 个人资料只允许浏览器缓存并每次验证
+PRODUCT_CACHE_CONTROL = 'public, max-age=0, s-maxage=5'
+PROFILE_CACHE_CONTROL = 'private, no-cache'
+# 推荐模型离线定期重建, 一分钟内的旧结果可以接受
+RELATED_CACHE_CONTROL = 'public, max-age=60'
+
+
+def validator_headers(prefix, entity_id, version, cache_control):
+    """ETag, Last-Modified and Cache-Control of a page at `version` (from
+    Database.get_version); none when the database has no versions"""
+    if version is None:
+        return {}
+    version, updated_at = version
+    return {'ETag': f'"{prefix}{entity_id}.{version}"',
+            'Last-Modified': http_date(updated_at),
+            'Cache-Control': cache_control}
+
+
+def not_modified(headers, if_none_match, if_modified_since):
+    """Whether a GET with these If-None-Match / If-Modified-Since header values
+    can be answered 304 for a page carrying `headers` (from validator_headers)"""
+    if not headers:
+        return False
+    if if_none_match:
+        return parse_etags(if_none_match).contains_weak(headers['ETag'].strip('"'))
+    if if_modified_since:
+        since = parse_date(if_modified_since)
+        return since is not None and parse_date(headers['Last-Modified']) <= since
+    return False
+
+
+def authorize(auth, user_id=None, user_type=None, query_token=False, required=False):
+    """Identity of the request's bearer token, checked to act as `user_id` and to
+    be a `user_type`; None for a request without token when tokens are optional,
+    which they never are for writes (`required`). With `query_token` the token
+    may also come as ?access_token=, for clients such as EventSource that cannot
+    set headers. Aborts with 401/403 otherwise"""
+    try:
+        token = bearer_token(request.headers.get('Authorization'))
+        if token is None and query_token:
+            token = request.args.get('access_token') or None
+        if token is None:
+            if auth.required or required:
+                raise AuthError('Authentication required')
+            return None
+        identity = auth.authenticate(token)
+        if user_id is not None and identity['user_id'] != user_id:
+            raise AuthError('Token does not belong to this user', 403)
+        if user_type is not None and identity['user_type'] != user_type:
+            raise AuthError(f'Only a {user_type} can do this', 403)
+        return identity
+    except AuthError as e:
+        abort(e.status, error=str(e))
 
 
 class Server:
-    def __init__(self, db_url='data/test.db'):
+    def __init__(self, db_url='data/test.db', slow_request_threshold=0.5, allow_anonymous=False,
+                 max_streams=None, metrics_dir=None):
         self.db = Database(db_url)
+        self.auth = SessionTokens(self.db, required=not allow_anonymous)
         self.app = Flask(__name__)
         self.api = Api(self.app)
+        self.api.representation('application/json')(output_json)
+        self.app.teardown_appcontext(self.db.remove_session)
+        # 每个打开的物流流占住一个请求线程, 由 max_streams 限制其数量
+        self.shipping = ShippingHub(self.db, max_streams=max_streams)
+
+        # Request latency and SQL statistics, served on /metrics; summed over the
+        # worker processes sharing `metrics_dir`
+        self.instrumentation = Metrics(slow_request_threshold, metrics_dir)
+        self.instrumentation.init_app(self.app)
+        self.instrumentation.instrument(self.db)
+        self.instrumentation.instrument_shipping(self.shipping)
 
         # Enable CORS
         CORS(self.app)
 
     class login(Resource):
-        def __init__(self, db: Database):
-            self.db = db
+        def __init__(self, auth: SessionTokens):
+            self.auth = auth
 
         def post(self):
+            """Check credentials and issue a session token"""
             data = request.json
             username = data['username']
             password_hash = data['password_hash']
-            user_id = self.db.confirm_user(username, password_hash)
-            if user_id is not None:
-                return {"user_id": user_id}, 200
+            session = self.auth.login(username, password_hash)
+            if session is not None:
+                return session, 200
             else:
                 return {"error": "Invalid username or password"}, 401
 
+    class logout(Resource):
+        def __init__(self, auth: SessionTokens):
+            self.auth = auth
+
+        def post(self):
+            """Revoke the session token sent with the request"""
+            if authorize(self.auth) is None:
+                abort(401, error='Authentication required')
+            if self.auth.logout(bearer_token(request.headers.get('Authorization'))):
+                return True, 200
+            else:
+                return {"error": "Failed to revoke session"}, 500
+
     class search(Resource):
         def __init__(self, db: Database):
             self.db = db
@@ -36,23 +147,68 @@ class Server:
             data = request.json
             query = data['query']
             field = data['field']
-            results = self.db.search_for_product(query, field)
+            sort = data.get('sort', 'relevance')
+            try:
+                results = self.db.search_for_product(query, field, sort)
+            except ValueError as e:
+                return {"error": str(e)}, 400
             return results, 200
 
-    class profile(Resource):
+    class suggest(Resource):
+        def __init__(self, db: Database):
+            self.db = db
+
+        def get(self):
+            """Search-as-you-type completions of product and category names"""
+            prefix = request.args.get('q', '').strip()
+            limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+            limit = max(1, min(limit, MAX_SUGGEST_LIMIT))
+            if not prefix:
+                return {"products": [], "categories": []}, 200
+            return self.db.suggest(prefix, limit), 200
+
+    class category(Resource):
         def __init__(self, db: Database):
             self.db = db
+
+        def get(self):
+            """Categories matching a name with their subtree product counts, and
+            one page of the products in those subtrees"""
+            query = request.args.get('query', '')
+            after_product_id = request.args.get('after_product_id', type=int)
+            limit = request.args.get('limit', CATEGORY_PAGE_SIZE, type=int)
+            limit = max(1, min(limit, MAX_CATEGORY_PAGE_SIZE))
+            categories, products, next_after_product_id = \
+                self.db.get_category_products(query, after_product_id, limit)
+            if categories:
+                return {"categories": categories, "products": products,
+                        "next_after_product_id": next_after_product_id}, 200
+            else:
+                return {"error": "Category not found"}, 404
+
+    class profile(Resource):
+        def __init__(self, db: Database, auth: SessionTokens):
+            self.db = db
+            self.auth = auth
         
         def get(self, user_id):
             """Retrieve user profile"""
-            user = self.db.get_user(user_id)
+            authorize(self.auth, user_id)
+            version = self.db.get_version('user', user_id)
+            headers = validator_headers('u', user_id, version, PROFILE_CACHE_CONTROL)
+            headers['Vary'] = 'Authorization'
+            if not_modified(headers, request.headers.get('If-None-Match'),
+                            request.headers.get('If-Modified-Since')):
+                return Response(status=304, headers=headers)
+            user = self.db.get_user(user_id, version and version[0])
             if user is not None:
-                return user, 200
+                return user, 200, headers
             else:
                 return {"error": "User not found"}, 404
 
         def post(self, user_id):
             """Update user profile"""
+            authorize(self.auth, user_id, required=True)
             user = self.db.update_user(user_id, **request.json)
             if user:
                 return True, 200
@@ -60,14 +216,21 @@ class Server:
                 return {"error": "User not found"}, 404
 
     class purchase(Resource):
-        def __init__(self, db: Database):
+        def __init__(self, db: Database, auth: SessionTokens):
             self.db = db
+            self.auth = auth
 
         def get(self, user_id):
-            """Retrieve user purchase history"""
-            orders, trackings = self.db.get_purchase_history(user_id)
+            """Retrieve user purchase history, newest orders first"""
+            authorize(self.auth, user_id)
+            before_order_id = request.args.get('before_order_id', type=int)
+            limit = request.args.get('limit', PURCHASE_PAGE_SIZE, type=int)
+            limit = max(1, min(limit, MAX_PURCHASE_PAGE_SIZE))
+            orders, trackings, next_before_order_id = \
+                self.db.get_purchase_history(user_id, before_order_id, limit)
             if orders:
-                return {"orders": orders, "trackings": trackings}, 200
+                return {"orders": orders, "trackings": trackings,
+                        "next_before_order_id": next_before_order_id}, 200
             else:
                 return {"error": "No purchase history found"}, 404
 
@@ -76,20 +239,75 @@ class Server:
             self.db = db
 
         def get(self, product_id):
-            """Retrieve product details"""
-            product, reviews, seller_id = self.db.get_product(product_id)
+            """Retrieve product details with one page of reviews"""
+            review_sort = request.args.get('review_sort', 'newest')
+            review_cursor = request.args.get('review_cursor')
+            review_limit = request.args.get('review_limit', REVIEW_PAGE_SIZE, type=int)
+            review_limit = max(1, min(review_limit, MAX_REVIEW_PAGE_SIZE))
+            # 校验值只需一次主键查询; 未变化时不再查询和序列化整个商品页
+            version = self.db.get_version('product', product_id)
+            headers = validator_headers('p', product_id, version, PRODUCT_CACHE_CONTROL)
+            if not_modified(headers, request.headers.get('If-None-Match'),
+                            request.headers.get('If-Modified-Since')):
+                return Response(status=304, headers=headers)
+            try:
+                product, reviews, seller_id, next_review_cursor = self.db.get_product(
+                    product_id, review_sort, review_cursor, review_limit, version and version[0])
+            except ValueError as e:
+                return {"error": str(e)}, 400
             if product is not None:
                 return {"product": product, "reviews": reviews, 
-                        "seller_id": seller_id}, 200
+                        "seller_id": seller_id,
+                        "next_review_cursor": next_review_cursor}, 200, headers
             else:
                 return {"error": "Product not found"}, 404
 
-    class review(Resource):
+    class related(Resource):
+        def __init__(self, db: Database):
+            self.db = db
+
+        def get(self, product_id):
+            """Products customers also bought, from the offline co-purchase model"""
+            limit = request.args.get('limit', RELATED_LIMIT, type=int)
+            limit = max(1, min(limit, MAX_RELATED_LIMIT))
+            related = self.db.get_related_products(product_id, limit)
+            if related is not None:
+                return {"product_id": product_id, "related": related}, 200, \
+                    {'Cache-Control': RELATED_CACHE_CONTROL}
+            else:
+                return {"error": "Recommendations are not built"}, 503
+
+    class products(Resource):
         def __init__(self, db: Database):
             self.db = db
 
+        def post(self):
+            """Retrieve many products in one request, each shaped like /product/<id>,
+            in request order, with the ids that were not found"""
+            data = request.json
+            review_limit = data.get('review_limit', 0)
+            if type(review_limit) is not int:
+                return {"error": "review_limit must be an integer"}, 400
+            review_limit = max(0, min(review_limit, MAX_BATCH_REVIEW_LIMIT))
+            try:
+                return self.db.get_products(data.get('product_ids'),
+                                            data.get('review_sort', 'newest'), review_limit), 200
+            except ValueError as e:
+                return {"error": str(e)}, 400
+
+    class review(Resource):
+        def __init__(self, db: Database, auth: SessionTokens):
+            self.db = db
+            self.auth = auth
+
         def get(self, review_id):
-            """Delete review"""
+            """Delete review, only by its author"""
+            identity = authorize(self.auth, required=True)
+            owners = self.db.get_review_owners(review_id)
+            if owners is None:
+                return {"error": "Review not found"}, 404
+            if owners.user_id != identity['user_id']:
+                abort(403, error='Only the author can delete this review')
             success = self.db.delete_review(review_id)
             if success:
                 return True, 200
@@ -99,6 +317,7 @@ class Server:
         def post(self, review_id):
             """Create new review"""
             review = request.json
+            authorize(self.auth, review.get('user_id'), required=True)
             success = self.db.add_review(review)
             if success:
                 return True, 200
@@ -106,11 +325,18 @@ class Server:
                 return {"error": "Failed to add review"}, 400
 
     class reply(Resource):
-        def __init__(self, db: Database):
+        def __init__(self, db: Database, auth: SessionTokens):
             self.db = db
+            self.auth = auth
 
         def get(self, review_id):
-            """Delete reply"""
+            """Delete reply, only by the owner of the reviewed product's store"""
+            identity = authorize(self.auth, user_type='merchant', required=True)
+            owners = self.db.get_review_owners(review_id)
+            if owners is None:
+                return {"error": "Review not found"}, 404
+            if owners.owner_id != identity['user_id']:
+                abort(403, error='Only the store owner can reply to this review')
             success = self.db.delete_reply(review_id)
             if success:
                 return True, 200
@@ -118,14 +344,113 @@ class Server:
                 return {"error": "Review not found"}, 404
 
         def post(self, review_id):
-            """Create new review"""
+            """Reply to a review, only by the owner of the reviewed product's store"""
             reply = request.json
+            identity = authorize(self.auth, user_type='merchant', required=True)
+            owners = self.db.get_review_owners(reply.get('review_id'))
+            if owners is None:
+                return {"error": "Review not found"}, 404
+            if owners.owner_id != identity['user_id']:
+                abort(403, error='Only the store owner can reply to this review')
             success = self.db.add_reply(reply)
             if success:
                 return True, 200
             else:
                 return {"error": "Failed to add review"}, 400
 
+    class checkout(Resource):
+        def __init__(self, db: Database, auth: SessionTokens):
+            self.db = db
+            self.auth = auth
+
+        def post(self):
+            """Place an order, reserving stock for every line or none"""
+            data = request.json
+            authorize(self.auth, data.get('user_id'), required=True)
+            try:
+                order = self.db.checkout(data['user_id'], data['items'],
+                                         data.get('payment_method'))
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            except CheckoutError as e:
+                return {"error": str(e), "product_id": e.product_id,
+                        "available": e.available}, 409
+            if order is not None:
+                return order, 200
+            else:
+                return {"error": "Failed to place order"}, 400
+
+    class merchant_sales(Resource):
+        def __init__(self, db: Database, auth: SessionTokens):
+            self.db = db
+            self.auth = auth
+
+        def get(self, user_id):
+            """Sales of the merchant's stores per day, store or product over ?from=&to="""
+            authorize(self.auth, user_id, user_type='merchant')
+            try:
+                report = self.db.get_merchant_sales(
+                    user_id, request.args.get('from'), request.args.get('to'),
+                    request.args.get('group_by', 'day'),
+                    request.args.get('limit', SALES_LIMIT, int),
+                    request.args.get('store_id', None, int))
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            if report is not None:
+                return report, 200
+            else:
+                return {"error": "Sales reporting is not set up"}, 503
+
+    class shipping_stream(Resource):
+        def __init__(self, auth: SessionTokens, hub: ShippingHub):
+            self.auth = auth
+            self.hub = hub
+
+        def get(self, user_id):
+            """Server-sent events of the user's shipments (or of ?shipping_id= only)"""
+            authorize(self.auth, user_id, query_token=True)
+            last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+            try:
+                last_event_id = int(last_event_id) if last_event_id else None
+            except ValueError:
+                last_event_id = None
+            try:
+                chunks = self.hub.stream(user_id, request.args.get('shipping_id', None, int),
+                                         last_event_id)
+            except TooManyStreams:
+                return ({"error": "Too many open streams, poll /purchase instead"}, 503,
+                        {'Retry-After': str(STREAM_RETRY_AFTER)})
+            return Response(chunks, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    class shipping_events(Resource):
+        def __init__(self, db: Database, auth: SessionTokens, hub: ShippingHub):
+            self.db = db
+            self.auth = auth
+            self.hub = hub
+
+        def post(self):
+            """Append a carrier's batch of track events for the merchant's own shipments"""
+            data = request.json
+            identity = authorize(self.auth, user_type='merchant', required=True)
+            try:
+                result = self.db.add_shipping_events(data.get('events'), identity['user_id'])
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            if result is None:
+                return {"error": "Failed to record shipping events"}, 500
+            self.hub.notify()
+            return result, 200
+
+    class metrics(Resource):
+        def __init__(self, metrics: Metrics):
+            self.metrics = metrics
+
+        def get(self):
+            """Prometheus metrics of this process"""
+            return Response(self.metrics.render(),
+                            mimetype='text/plain; version=0.0.4')
+
     #class UserList(Resource):
     #    def get(self):
     #        """Retrieve all users"""
@@ -138,23 +463,48 @@ class Server:
     #        users[new_id] = {"name": data["name"], "email": data["email"]}
     #        return users[new_id], 201
 
-    def run(self, host="127.0.0.1", port=5000):
+    def add_resources(self):
         # Registering resources with API
         self.api.add_resource(self.login, "/login", 
-                              resource_class_args=[self.db])
+                              resource_class_args=[self.auth])
+        self.api.add_resource(self.logout, "/logout",
+                              resource_class_args=[self.auth])
         self.api.add_resource(self.search, "/search", 
                               resource_class_args=[self.db])
-        self.api.add_resource(self.profile, "/profile/<int:user_id>", 
+        self.api.add_resource(self.suggest, "/suggest",
                               resource_class_args=[self.db])
-        self.api.add_resource(self.purchase, "/purchase/<int:user_id>", 
+        self.api.add_resource(self.category, "/category",
                               resource_class_args=[self.db])
+        self.api.add_resource(self.profile, "/profile/<int:user_id>", 
+                              resource_class_args=[self.db, self.auth])
+        self.api.add_resource(self.purchase, "/purchase/<int:user_id>", 
+                              resource_class_args=[self.db, self.auth])
         self.api.add_resource(self.product, "/product/<int:product_id>", 
                               resource_class_args=[self.db])
-        self.api.add_resource(self.review, "/review/<int:review_id>", 
+        self.api.add_resource(self.related, "/product/<int:product_id>/related",
                               resource_class_args=[self.db])
-        self.api.add_resource(self.reply, "/reply/<int:review_id>", 
+        self.api.add_resource(self.products, "/products",
                               resource_class_args=[self.db])
+        self.api.add_resource(self.review, "/review/<int:review_id>", 
+                              resource_class_args=[self.db, self.auth])
+        self.api.add_resource(self.reply, "/reply/<int:review_id>", 
+                              resource_class_args=[self.db, self.auth])
+        self.api.add_resource(self.checkout, "/checkout",
+                              resource_class_args=[self.db, self.auth])
+        self.api.add_resource(self.merchant_sales, "/merchant/<int:user_id>/sales",
+                              resource_class_args=[self.db, self.auth])
+        self.api.add_resource(self.shipping_stream, "/shipping/stream/<int:user_id>",
+                              resource_class_args=[self.auth, self.shipping])
+        self.api.add_resource(self.shipping_events, "/shipping/events",
+                              resource_class_args=[self.db, self.auth, self.shipping])
+        self.api.add_resource(self.metrics, "/metrics",
+                              resource_class_args=[self.instrumentation])
         #self.api.add_resource(self.UserList, "/users")
+
+    def run(self, host="127.0.0.1", port=5000):
+        """Serve with the single-process development server, see wsgi.py for production"""
+        self.add_resources()
+        self.db.suggester.start_background_build()
         self.app.run(host=host, port=port)
 
 
@@ -0,0 +1,321 @@
+"""Fan-out of shipping changes to server-sent event streams.
+
+Shipping_Update is filled by triggers whenever a track event is appended
+or a shipment changes status, whoever writes it. One poller per process
+reads the new rows and hands each one to the subscribers of its buyer,
+so the database sees one small indexed query per `poll_interval` however
+many streams are open. The last `buffer_size` events are kept already
+rendered, which lets a reconnecting EventSource resume from its
+Last-Event-ID without touching SQLite; a client that fell further behind
+gets a `reset` event and should re-fetch /purchase once.
+
+A WSGI stream holds a request thread for as long as it is open, so the
+threaded hub accepts at most `max_streams` of them per process and
+refuses more with TooManyStreams, keeping threads free for the API; the
+ASGI app serves streams as coroutines and is not capped.
+"""
+import asyncio
+import json
+import os
+import queue
+import threading
+from collections import deque
+
+POLL_INTERVAL = 0.5
+HEARTBEAT = 15.0
+RETRY_MS = 3000
+# 超出流数上限时建议客户端等待的秒数, 期间改为轮询
+STREAM_RETRY_AFTER = 30
+
+
+class TooManyStreams(Exception):
+    """The process already serves its maximum number of open streams."""
+
+
+def render_event(update_id, event):
+    data = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+    return f'id: {update_id}\nevent: shipping\ndata: {data}\n\n'.encode()
+
+
+RESET_EVENT = b'event: reset\ndata: {}\n\n'
+HEARTBEAT_COMMENT = b': keep-alive\n\n'
+
+
+class Subscription:
+    """Bounded queue of rendered events for one stream; a subscriber that lets
+    `queue_size` events pile up is dropped instead of holding memory."""
+
+    def __init__(self, user_id, shipping_id=None, queue_size=256):
+        self.user_id = user_id
+        self.shipping_id = shipping_id
+        self.events = queue.Queue(queue_size)
+        self.dropped = False
+
+    def wants(self, shipping_id):
+        return self.shipping_id is None or self.shipping_id == shipping_id
+
+    def offer(self, chunk):
+        try:
+            self.events.put_nowait(chunk)
+        except queue.Full:
+            self.dropped = True
+        return not self.dropped
+
+    def next_chunk(self, timeout):
+        """Next rendered event, HEARTBEAT_COMMENT after `timeout` idle seconds, None once dropped."""
+        if self.dropped:
+            return None
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None if self.dropped else HEARTBEAT_COMMENT
+
+
+class ShippingHub:
+    """Per-process poller of `db.get_shipping_updates` and registry of open streams.
+
+    The poller thread is started by the first subscriber and restarted
+    after fork, like the WriteQueue, so a hub built in a pre-forking
+    master works in every worker.
+    """
+
+    subscription_class = Subscription
+
+    def __init__(self, db, poll_interval=POLL_INTERVAL, buffer_size=10000, queue_size=256,
+                 heartbeat=HEARTBEAT, max_streams=None):
+        self.db = db
+        self.max_streams = max_streams
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.recent = deque(maxlen=buffer_size)   # (update_id, buyer_id, shipping_id, chunk)
+        self.last_update_id = None
+        self.subscribers = {}                     # buyer_id -> {Subscription}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.polls = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    # 轮询与分发
+
+    def _publish(self, updates):
+        with self.lock:
+            for update_id, buyer_id, event in updates:
+                shipping_id = event['shipping']['shipping_id']
+                chunk = render_event(update_id, event)
+                self.recent.append((update_id, buyer_id, shipping_id, chunk))
+                self.last_update_id = update_id
+                for subscription in list(self.subscribers.get(buyer_id, ())):
+                    if not subscription.wants(shipping_id):
+                        continue
+                    if subscription.offer(chunk):
+                        self.delivered += 1
+                    else:
+                        self._discard(subscription)
+                        self.dropped += 1
+
+    def _prefill(self, updates):
+        with self.lock:
+            if self.last_update_id is not None:
+                return
+            for update_id, buyer_id, event in updates:
+                self.recent.append((update_id, buyer_id, event['shipping']['shipping_id'],
+                                    render_event(update_id, event)))
+            self.last_update_id = updates[-1][0] if updates else 0
+
+    def poll(self):
+        """Publish the updates written since the last poll; the number published."""
+        self.polls += 1
+        if self.last_update_id is None:
+            self._prefill(self.db.get_shipping_updates(None, self.recent.maxlen))
+            return 0
+        updates = self.db.get_shipping_updates(self.last_update_id, self.recent.maxlen)
+        self._publish(updates)
+        return len(updates)
+
+    def _run(self):
+        while True:
+            try:
+                # 一次读满说明还有积压, 不等待直接继续
+                if self.poll() == self.recent.maxlen:
+                    continue
+            except Exception as e:
+                print(f"[WARN]shipping poll failed: {e}")
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+    def _ensure_started(self):
+        if self.last_update_id is None:
+            # 首个订阅者同步读取最近的变化, 断线重连的客户端可立即从缓冲补发
+            self.poll()
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name='minishop-shipping', daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        """Poll now instead of at the next interval, e.g. after this process ingested events."""
+        self.wakeup.set()
+
+    # 订阅
+
+    def _discard(self, subscription):
+        subscriptions = self.subscribers.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscribers[subscription.user_id]
+
+    def _backlog(self, subscription, last_event_id):
+        """Buffered events after `last_event_id` for the subscriber; [RESET_EVENT]
+        when the buffer no longer reaches back that far."""
+        if last_event_id is None:
+            return []
+        if not self.recent or last_event_id >= self.recent[-1][0]:
+            return []
+        if last_event_id < self.recent[0][0] - 1 and len(self.recent) == self.recent.maxlen:
+            return [RESET_EVENT]
+        return [chunk for update_id, buyer_id, shipping_id, chunk in self.recent
+                if update_id > last_event_id and buyer_id == subscription.user_id
+                and subscription.wants(shipping_id)]
+
+    def subscribe(self, user_id, shipping_id=None, last_event_id=None):
+        """Register a stream; returns (subscription, chunks to send first). Raises
+        TooManyStreams when `max_streams` are already open."""
+        subscription = self.subscription_class(user_id, shipping_id, self.queue_size)
+        with self.lock:
+            if self.max_streams is not None and \
+                    sum(len(s) for s in self.subscribers.values()) >= self.max_streams:
+                self.rejected += 1
+                raise TooManyStreams(f'{self.max_streams} streams already open')
+            backlog = self._backlog(subscription, last_event_id)
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription, [f'retry: {RETRY_MS}\n\n'.encode()] + backlog
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self._discard(subscription)
+
+    def stream(self, user_id, shipping_id=None, last_event_id=None):
+        """Iterator of SSE chunks for a WSGI response; unsubscribes when the client goes away."""
+        self._ensure_started()
+        subscription, backlog = self.subscribe(user_id, shipping_id, last_event_id)
+
+        def chunks():
+            try:
+                yield from backlog
+                while True:
+                    chunk = subscription.next_chunk(self.heartbeat)
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self.unsubscribe(subscription)
+        return chunks()
+
+    def stats(self):
+        with self.lock:
+            subscribers = sum(len(s) for s in self.subscribers.values())
+        return {'subscribers': subscribers, 'buffered': len(self.recent), 'polls': self.polls,
+                'delivered': self.delivered, 'dropped': self.dropped, 'rejected': self.rejected}
+
+
+class AsyncSubscription(Subscription):
+    def __init__(self, user_id, shipping_id=None, queue_size=256):
+        super().__init__(user_id, shipping_id, queue_size)
+        self.events = asyncio.Queue(queue_size)
+
+    def offer(self, chunk):
+        try:
+            self.events.put_nowait(chunk)
+        except asyncio.QueueFull:
+            self.dropped = True
+            # 唤醒等待中的 next_chunk, 让它结束流
+            self.events.get_nowait()
+            self.events.put_nowait(None)
+        return not self.dropped
+
+    async def next_chunk(self, timeout):
+        if self.dropped:
+            return None
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None if self.dropped else HEARTBEAT_COMMENT
+
+
+class AsyncShippingHub(ShippingHub):
+    """ShippingHub over an AsyncDatabase, polling from a task on the running event loop."""
+
+    subscription_class = AsyncSubscription
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.task = None
+        self.wakeup = None
+
+    async def poll(self):
+        self.polls += 1
+        if self.last_update_id is None:
+            self._prefill(await self.db.get_shipping_updates(None, self.recent.maxlen))
+            return 0
+        updates = await self.db.get_shipping_updates(self.last_update_id, self.recent.maxlen)
+        self._publish(updates)
+        return len(updates)
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.poll() == self.recent.maxlen:
+                    continue
+            except Exception as e:
+                print(f"[WARN]shipping poll failed: {e}")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    async def _ensure_started(self):
+        if self.last_update_id is None:
+            await self.poll()
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stream(self, user_id, shipping_id=None, last_event_id=None):
+        """Async iterator of SSE chunks; unsubscribes when the client goes away."""
+
+        async def chunks():
+            await self._ensure_started()
+            subscription, backlog = self.subscribe(user_id, shipping_id, last_event_id)
+            try:
+                for chunk in backlog:
+                    yield chunk
+                while True:
+                    chunk = await subscription.next_chunk(self.heartbeat)
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                self.unsubscribe(subscription)
+        return chunks()
@@ -0,0 +1,151 @@
+"""Production entry point: the Server app behind pre-forked gunicorn workers.
+
+    python -m minishop.backend.wsgi --db data/e_commerce.db --workers 4 --threads 8
+
+Signals are handled by the gunicorn master:
+    HUP   graceful reload, new workers start before the old ones finish
+    TERM  graceful shutdown, in-flight requests get --graceful-timeout seconds
+    TTIN / TTOU  add / remove one worker
+Workers are recycled after --max-requests requests (plus random jitter so
+they do not all restart together) to bound memory growth.
+
+With --preload the app and its engine are built once in the master and
+shared copy-on-write; every worker then drops the inherited SQLite
+connections right after fork and opens its own. A SQLite connection must
+never be used across fork. Without --preload, HUP also reloads the code.
+
+Workers share only the database file. In-process state built for one
+process exists once per worker:
+    QueryCache    table-version invalidation only reaches the worker that
+                  wrote; other workers may serve cached reads up to
+                  cache_ttl seconds old (Row_Version-keyed product pages
+                  excepted)
+    WriteQueue    one writer thread and group commit per worker, SQLite
+                  serializes the workers' transactions
+    ShippingHub   one Shipping_Update poller and stream cap per worker
+    Suggester     one /suggest index per worker, rebuilt after fork
+    SessionTokens identity cache and revocations per worker, revocations
+                  pulled every second; the signing key is settled in the
+                  master (--preload) or must be shared, see auth.py
+    Metrics       per worker, summed through a shared directory on /metrics
+Run a single worker (more threads) where stale cached reads matter.
+
+Every open /shipping/stream response holds one of the worker's threads,
+so at most --max-streams of them (half the threads by default) are served
+per worker; more get a 503 with Retry-After and the client polls
+/purchase instead. The ASGI app (asgi.py) serves streams without threads.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from minishop.backend.server import Server
+
+
+class ServerApplication(BaseApplication):
+    def __init__(self, db_url, options=None, slow_request_threshold=0.5, allow_anonymous=False,
+                 max_streams=None, metrics_dir=None):
+        self.db_url = db_url
+        self.options = options or {}
+        self.slow_request_threshold = slow_request_threshold
+        self.allow_anonymous = allow_anonymous
+        self.max_streams = max_streams
+        self.metrics_dir = metrics_dir
+        self.server = None
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('post_fork', self.post_fork)
+        self.cfg.set('worker_exit', self.worker_exit)
+
+    def load(self):
+        if self.server is None:
+            self.server = Server(self.db_url, self.slow_request_threshold, self.allow_anonymous,
+                                 self.max_streams, self.metrics_dir)
+            self.server.add_resources()
+            # 预加载时在 master 中确定签名密钥, fork 出的 worker 全部继承同一个
+            self.server.auth.ensure_secret()
+            if not self.server.auth.shared_secret and not self.cfg.preload_app and self.cfg.workers > 1:
+                raise RuntimeError('no shared session key: tokens would only be valid in the worker '
+                                   'that issued them; run database.py --create-session-store, set '
+                                   '$MINISHOP_SECRET_KEY, use --preload or a single worker')
+        return self.server.app
+
+    def post_fork(self, arbiter, worker):
+        # 丢弃从 master 继承的连接(不关闭, 它们仍属于 master), worker 按需新建自己的连接
+        if self.server is not None:
+            self.server.db.engine.dispose(close=False)
+            # 各 worker 各自持有 /suggest 索引, 启动后即在后台构建
+            self.server.db.suggester.start_background_build()
+
+    def worker_exit(self, arbiter, worker):
+        if self.server is not None:
+            self.server.instrumentation.retire()
+            self.server.db.close()
+
+
+def serve(db_url, host='127.0.0.1', port=5000, workers=None, threads=8,
+          max_requests=10000, max_requests_jitter=1000, timeout=30,
+          graceful_timeout=30, preload=True, slow_request_threshold=0.5, allow_anonymous=False,
+          max_streams=None):
+    options = {
+        'bind': f'{host}:{port}',
+        'workers': workers or multiprocessing.cpu_count(),
+        'worker_class': 'gthread',
+        'threads': threads,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests_jitter,
+        'timeout': timeout,
+        'graceful_timeout': graceful_timeout,
+        'preload_app': preload,
+        'proc_name': 'minishop',
+    }
+    if max_streams is None:
+        # 物流流占用的线程至多一半, 其余留给普通请求
+        max_streams = max(threads // 2, 1)
+    # 各 worker 在此目录中交换指标快照, /metrics 汇总全部 worker
+    metrics_dir = tempfile.mkdtemp(prefix='minishop-metrics-')
+    master_pid = os.getpid()
+    try:
+        ServerApplication(db_url, options, slow_request_threshold, allow_anonymous, max_streams,
+                          metrics_dir).run()
+    finally:
+        # worker 退出时 SystemExit 同样经过这里, 只有 master 删除目录
+        if os.getpid() == master_pid:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default='data/e_commerce.db', help='database file name')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, CPU count by default')
+    parser.add_argument('--threads', type=int, default=8, help='request threads per worker')
+    parser.add_argument('--max-requests', type=int, default=10000,
+                        help='recycle a worker after this many requests, 0 disables')
+    parser.add_argument('--max-requests-jitter', type=int, default=1000)
+    parser.add_argument('--timeout', type=int, default=30, help='seconds before a silent worker is killed')
+    parser.add_argument('--graceful-timeout', type=int, default=30)
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='build the app in every worker so HUP reloads code')
+    parser.add_argument('--slow-request-threshold', type=float, default=0.5)
+    parser.add_argument('--allow-anonymous', action='store_true',
+                        help='serve user-scoped reads without a session token, writes still need one')
+    parser.add_argument('--max-streams', type=int, default=None,
+                        help='open /shipping/stream responses per worker, half the threads by default')
+    args = parser.parse_args()
+
+    serve(args.db, args.host, args.port, args.workers, args.threads, args.max_requests,
+          args.max_requests_jitter, args.timeout, args.graceful_timeout, args.preload,
+          args.slow_request_threshold, args.allow_anonymous, args.max_streams)
+
+
+if __name__ == '__main__':
+    main()
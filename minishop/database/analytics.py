@@ -0,0 +1,88 @@
+"""Merchant sales reports over the Sales_Daily / Sales_Store_Daily rollups.
+
+The rollups hold one row per store, day (and product), so a report over
+any date range reads at most stores x days (x products) small rows by
+primary key. They are loaded straight into NumPy structured arrays and
+grouped with np.unique / np.bincount instead of a Python loop per row.
+Order counts of stores come from Sales_Store_Daily, where an order is
+counted once per store it bought from, and those of a whole merchant (the
+day rows and totals without a store filter) from Sales_Merchant_Daily,
+where it is counted once per merchant; per-product order counts are the
+orders that contained the product.
+"""
+from datetime import date, timedelta
+
+import numpy as np
+
+SALES_GROUPS = ('day', 'store', 'product')
+MAX_SALES_DAYS = 3660
+SALES_LIMIT = 100
+MAX_SALES_LIMIT = 1000
+EPOCH = date(1970, 1, 1)
+
+SALES_DTYPE = np.dtype([('key', 'i8'), ('revenue', 'f8'), ('units', 'i8'), ('orders', 'i8')])
+
+
+def parse_day(text):
+    """Days since 1970-01-01 of a 'YYYY-MM-DD' string; ValueError when malformed."""
+    try:
+        return (date.fromisoformat(text) - EPOCH).days
+    except (TypeError, ValueError):
+        raise ValueError(f'dates must look like {EPOCH.isoformat()}, not {text!r}')
+
+
+def format_day(day):
+    return (EPOCH + timedelta(days=int(day))).isoformat()
+
+
+def parse_sales_query(first, last, group_by, limit):
+    """(first_day, last_day, group_by, limit) of a report request; ValueError when invalid.
+    The range defaults to the last 30 days."""
+    last_day = parse_day(last) if last else (date.today() - EPOCH).days
+    first_day = parse_day(first) if first else last_day - 29
+    if first_day > last_day:
+        raise ValueError('from must not be after to')
+    if last_day - first_day >= MAX_SALES_DAYS:
+        raise ValueError(f'at most {MAX_SALES_DAYS} days per report')
+    if group_by not in SALES_GROUPS:
+        raise ValueError(f'group_by must be one of {SALES_GROUPS}')
+    return first_day, last_day, group_by, max(1, min(limit, MAX_SALES_LIMIT))
+
+
+def sales_array(rows):
+    """SALES_DTYPE array of (key, revenue, units, orders) rows."""
+    return np.fromiter(map(tuple, rows), SALES_DTYPE)
+
+
+def _sums(inverse, data, size):
+    return (np.bincount(inverse, weights=data['revenue'], minlength=size),
+            np.bincount(inverse, weights=data['units'], minlength=size).astype(np.int64),
+            np.bincount(inverse, weights=data['orders'], minlength=size).astype(np.int64))
+
+
+def aggregate_sales(data, group_by, first_day, last_day, limit=SALES_LIMIT, order_data=None):
+    """Report rows of a sales_array keyed by day, store_id or product_id:
+    every day of the range in order, or the `limit` best sellers by revenue.
+    Day rows take their orders from `order_data` (a sales_array keyed by day) when given."""
+    if group_by == 'day':
+        size = last_day - first_day + 1
+        revenue, units, orders = _sums(data['key'] - first_day, data, size)
+        if order_data is not None:
+            orders = _sums(order_data['key'] - first_day, order_data, size)[2]
+        keys = np.arange(first_day, last_day + 1).astype('datetime64[D]').astype(str).tolist()
+        selected = np.arange(size)
+    else:
+        unique, inverse = np.unique(data['key'], return_inverse=True)
+        revenue, units, orders = _sums(inverse, data, len(unique))
+        keys = unique.tolist()
+        selected = np.lexsort((unique, -revenue))[:limit]
+    name = 'day' if group_by == 'day' else f'{group_by}_id'
+    revenue = np.round(revenue, 2)
+    return [{name: keys[i], 'revenue': float(revenue[i]), 'units': int(units[i]),
+             'orders': int(orders[i])} for i in selected.tolist()]
+
+
+def sales_totals(data, order_data=None):
+    order_data = data if order_data is None else order_data
+    return {'revenue': round(float(data['revenue'].sum()), 2), 'units': int(data['units'].sum()),
+            'orders': int(order_data['orders'].sum())}
@@ -0,0 +1,206 @@
+"""Hot/cold archival of finished orders into a second SQLite file.
+
+    python -m minishop.database.archive --db data/e_commerce.db --older-than-days 180
+    python -m minishop.database.archive --db data/e_commerce.db --archive /mnt/cold/orders.db \\
+        --older-than-days 365 --batch-size 5000
+
+Completed and canceled orders created more than `older_than_days` ago
+move, with their Order_Item, Shipping and Shipping_Track rows, into the
+archive file (data/e_commerce_archive.db by default), which every
+Database connection ATTACHes as `archive` once it exists. The hot tables
+and their indexes then only hold recent and open orders, and the history
+queries read the archive only for the users and pages that reach into it.
+Order exports and the co-purchase model read both files.
+
+SQLite commits the files of an ATTACHed transaction one after the other,
+so a batch is moved in two single-file transactions instead: the rows are
+copied (upserted) into the archive, then deleted from the hot file under
+its write lock, but only for the orders whose hot rows still equal their
+archived copy. An order that changed in between stays hot until the next
+run, and until then readers take it from the hot file, never twice. An
+interrupted run is resumed by running it again.
+
+Only orders already counted in the sales rollups are archived (the job
+refreshes them first), since rollup refreshes read new orders from the
+hot tables; rebuilding the rollups from scratch afterwards would likewise
+only see the hot orders. Shipping_Update rows of archived shipments are
+left to its retention limit: the shipping streams only read new ones.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from minishop.database.database import create_order_archive
+from minishop.database.entities import ARCHIVE_SCHEMA, DATETIME_FORMAT
+
+ARCHIVE_AGE_DAYS = 180
+ARCHIVE_BATCH_SIZE = 1000
+ARCHIVED_STATUSES = ('completed', 'canceled')
+
+BATCH_ORDERS = "SELECT value FROM json_each(:order_ids)"
+BATCH_SHIPPINGS = f"SELECT shipping_id FROM main.Shipping WHERE order_id IN ({BATCH_ORDERS})"
+
+SELECT_BATCH = f"""
+    SELECT order_id FROM main.Order_Table
+    WHERE order_id > :after_order_id AND order_id <= :last_order_id
+      AND order_status IN {ARCHIVED_STATUSES} AND created_at < :created_before
+    ORDER BY order_id LIMIT :batch_size
+"""
+
+# 两个库结构相同, 整行复制; 重复运行时覆盖上次复制的旧行
+COPY_BATCH = [
+    f"INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.Order_Table "
+    f"SELECT * FROM main.Order_Table WHERE order_id IN ({BATCH_ORDERS})",
+    f"INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.Order_Item "
+    f"SELECT * FROM main.Order_Item WHERE order_id IN ({BATCH_ORDERS})",
+    f"INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.Shipping "
+    f"SELECT * FROM main.Shipping WHERE order_id IN ({BATCH_ORDERS})",
+    f"INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.Shipping_Track "
+    f"SELECT * FROM main.Shipping_Track WHERE shipping_id IN ({BATCH_SHIPPINGS})",
+]
+
+# 复制之后又被修改的订单: 热库中存在归档副本里没有的行
+CHANGED_ORDERS = f"""
+    SELECT order_id FROM (
+        SELECT * FROM main.Order_Table WHERE order_id IN ({BATCH_ORDERS})
+        EXCEPT SELECT * FROM {ARCHIVE_SCHEMA}.Order_Table WHERE order_id IN ({BATCH_ORDERS}))
+    UNION
+    SELECT order_id FROM (
+        SELECT * FROM main.Order_Item WHERE order_id IN ({BATCH_ORDERS})
+        EXCEPT SELECT * FROM {ARCHIVE_SCHEMA}.Order_Item WHERE order_id IN ({BATCH_ORDERS}))
+    UNION
+    SELECT order_id FROM (
+        SELECT * FROM main.Shipping WHERE order_id IN ({BATCH_ORDERS})
+        EXCEPT SELECT * FROM {ARCHIVE_SCHEMA}.Shipping WHERE order_id IN ({BATCH_ORDERS}))
+    UNION
+    SELECT order_id FROM main.Shipping WHERE shipping_id IN (
+        SELECT shipping_id FROM (
+            SELECT * FROM main.Shipping_Track WHERE shipping_id IN ({BATCH_SHIPPINGS})
+            EXCEPT SELECT * FROM {ARCHIVE_SCHEMA}.Shipping_Track
+            WHERE shipping_id IN ({BATCH_SHIPPINGS})))
+"""
+
+DELETE_BATCH = [
+    f"DELETE FROM main.Shipping_Track WHERE shipping_id IN ({BATCH_SHIPPINGS})",
+    f"DELETE FROM main.Shipping WHERE order_id IN ({BATCH_ORDERS})",
+    f"DELETE FROM main.Order_Item WHERE order_id IN ({BATCH_ORDERS})",
+    f"DELETE FROM main.Order_Table WHERE order_id IN ({BATCH_ORDERS})",
+]
+
+
+def archive_path(db_path):
+    """Default archive file of a database file: data/e_commerce.db -> data/e_commerce_archive.db"""
+    root, extension = os.path.splitext(db_path)
+    return f'{root}_archive{extension or ".db"}'
+
+
+def create_archive(path):
+    """Create the archive file at `path` unless it exists. It is built under a
+    temporary name and renamed, so connections never ATTACH a file without tables."""
+    if os.path.exists(path):
+        return False
+    temporary = f'{path}.{os.getpid()}.tmp'
+    conn = sqlite3.connect(temporary)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        create_order_archive(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temporary, path)
+    return True
+
+
+def attached_schemas(conn):
+    return {row[1] for row in conn.execute('PRAGMA database_list')}
+
+
+class OrderArchiver:
+    """Move finished orders from the main database of `conn` (a sqlite3 connection
+    with the archive attached) into the archive, `batch_size` orders at a time."""
+
+    def __init__(self, conn, batch_size=ARCHIVE_BATCH_SIZE):
+        if ARCHIVE_SCHEMA not in attached_schemas(conn):
+            raise ValueError(f'no {ARCHIVE_SCHEMA} database attached')
+        self.conn = conn
+        self.batch_size = batch_size
+
+    def _transaction(self, begin, statements, parameters):
+        self.conn.execute(begin)
+        try:
+            for statement in statements:
+                self.conn.execute(statement, parameters)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _move(self, order_ids):
+        """Archive one batch; the number of orders moved."""
+        self._transaction('BEGIN', COPY_BATCH, {'order_ids': json.dumps(order_ids)})
+        # 持有主库写锁再比对, 比对之后到删除之前不会再有修改
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            changed = {row[0] for row in self.conn.execute(
+                CHANGED_ORDERS, {'order_ids': json.dumps(order_ids)})}
+            unchanged = [order_id for order_id in order_ids if order_id not in changed]
+            for statement in DELETE_BATCH:
+                self.conn.execute(statement, {'order_ids': json.dumps(unchanged)})
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return len(unchanged)
+
+    def run(self, created_before, last_order_id):
+        """Archive the finished orders created before `created_before` (a datetime)
+        with order_id <= `last_order_id`; returns {'orders', 'skipped', 'batches', 'seconds'}."""
+        start = time.perf_counter()
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        stats = {'orders': 0, 'skipped': 0, 'batches': 0}
+        try:
+            after_order_id = 0
+            while True:
+                order_ids = [row[0] for row in self.conn.execute(SELECT_BATCH, {
+                    'after_order_id': after_order_id, 'last_order_id': last_order_id,
+                    'created_before': created_before.strftime(DATETIME_FORMAT),
+                    'batch_size': self.batch_size})]
+                if not order_ids:
+                    break
+                after_order_id = order_ids[-1]
+                moved = self._move(order_ids)
+                stats['orders'] += moved
+                stats['skipped'] += len(order_ids) - moved
+                stats['batches'] += 1
+        finally:
+            self.conn.isolation_level = isolation_level
+        stats['seconds'] = time.perf_counter() - start
+        return stats
+
+
+def main():
+    from minishop.database.orm import Database
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default='data/e_commerce.db', help='database file name')
+    parser.add_argument('--archive', type=str, default=None,
+                        help='archive file, default: <db>_archive.db next to the database')
+    parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AGE_DAYS,
+                        help='archive completed and canceled orders created this many days ago')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                        help='orders moved per transaction')
+    args = parser.parse_args()
+
+    db = Database(args.db, archive_path=args.archive)
+    stats = db.archive_orders(datetime.now() - timedelta(days=args.older_than_days), args.batch_size)
+    print(f"[INFO]{stats['orders']} orders archived to {db.archive_path} in {stats['batches']} batches, "
+          f"{stats['skipped']} changed while copying left for the next run, {stats['seconds']:.1f}s")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+import asyncio
+import time
+from functools import wraps
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from minishop.database.entities import *
+from minishop.database.cache import QueryCache, async_cached
+from minishop.database.orm import (
+    CATEGORY_PAGE_SIZE, MIN_SEARCH_INDEX_QUERY, SUGGEST_LIMIT, PURCHASE_PAGE_SIZE, REVIEW_PAGE_SIZE, REVIEW_SORT_KEYS,
+    SEARCH_INDEX_COLUMNS, SEARCH_SORTS,
+    CheckoutError, category_counts_statement, category_page_statement,
+    configure_sqlite_connection, group_purchase_history, page_category,
+    page_reviews, parse_checkout, place_order, search_statement,
+    serialize_product_page, serialize_profile, serialize_rated_product, suggest_statements,
+    VERSIONED_ENTITIES, page_version, row_version_statement, assemble_product_batch,
+    OPTIONAL_TABLES, detect_optional_tables,
+    CATALOG_VERSION, parse_product_ids, product_page_statement, product_pages_statement, review_page_statement,
+    top_reviews_statement,
+    confirm_user_statement, identity_statement, profile_statement, apply_user_update,
+    insert_review, remove_review, set_review_reply,
+    record_revocation, revocations_statement, serialize_identity, store_session_secret,
+    review_owners_statement, append_shipping_events, parse_shipping_events,
+    serialize_shipping_updates, shipping_updates_statement,
+    SALES_REFRESH_INTERVAL, SALES_ROLLUP_CURSOR, assemble_merchant_sales, merchant_sales_statement,
+    merchant_orders_statement, refresh_rollups,
+    attach_archive, purchase_page_statement, purchase_statements, split_purchase_page,
+)
+from minishop.database.analytics import SALES_LIMIT, parse_sales_query
+from minishop.database.suggest import Suggester
+from minishop.database.recommend import RELATED_LIMIT, RelatedProducts, model_path
+from minishop.database.archive import archive_path as default_archive_path
+
+
+def async_queued_write(*tables):
+    """`queued_write` for AsyncDatabase: the method is a plain function receiving
+    a synchronous Session after `self` (through run_sync) and must not commit.
+    Writes of the process run one at a time under an asyncio lock, each in a
+    transaction of its own; errors are reported and turned into False."""
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            async with self.write_lock:
+                try:
+                    async with self.Session() as session:
+                        result = await session.run_sync(
+                            lambda sync_session: method(self, sync_session, *args, **kwargs))
+                        await session.commit()
+                        return result
+                except IntegrityError as e:
+                    print(f"Error in {method.__name__}: {e.orig}")
+                except Exception as e:
+                    print(f"An unexpected error occurred: {e}")
+                finally:
+                    self.cache.bump(*tables)
+            return False
+        return wrapper
+    return decorator
+
+
+class AsyncDatabase:
+    """Database with the same methods and return values, on async SQLAlchemy over aiosqlite.
+
+    Every method opens its own AsyncSession, so calls from concurrent
+    tasks never share one. Call `await connect()` once inside the event
+    loop before use and `await close()` on shutdown.
+    """
+
+    def __init__(self, db_url='data/test.db', pool_size=8, max_overflow=8,
+                 cache_entries=1024, cache_ttl=60.0, suggest_entries=1_000_000,
+                 suggest_max_age=300.0, related_path=None, archive_path=None):
+        self.engine = create_async_engine(
+            f'sqlite+aiosqlite:///{db_url}',
+            pool_size=pool_size, max_overflow=max_overflow)
+        event.listen(self.engine.sync_engine, 'connect', configure_sqlite_connection)
+        self.archive_path = archive_path or default_archive_path(db_url)
+        event.listen(self.engine.sync_engine, 'checkout',
+                     lambda dbapi_connection, connection_record, proxy:
+                     attach_archive(dbapi_connection, connection_record.info, self.archive_path))
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.write_lock = asyncio.Lock()
+        self.cache = QueryCache(cache_entries, cache_ttl)
+        # 可选表的标志在 connect 中检测
+        for attribute, _, _ in OPTIONAL_TABLES:
+            setattr(self, attribute, False)
+        self.sales_refreshed_at = float('-inf')
+        # 本进程不经 ORM 修改商品与分类名称, 索引按 max_age 或目录版本变化时重建
+        self.suggester = Suggester(None, suggest_entries, suggest_max_age)
+        self.suggest_lock = asyncio.Lock()
+        self.related_products = RelatedProducts(related_path or model_path(db_url))
+
+    async def connect(self):
+        async with self.engine.connect() as conn:
+            tables = set(await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names()))
+        detect_optional_tables(self, tables.__contains__)
+        print("[INFO]async database constructed")
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def confirm_user(self, username, password_hash):
+        async with self.Session() as session:
+            return await session.scalar(confirm_user_statement(username, password_hash))
+
+    async def get_identity(self, user_id):
+        async with self.Session() as session:
+            user = (await session.execute(identity_statement(user_id))).first()
+        return serialize_identity(user) if user else None
+
+    @async_queued_write('Session_Key')
+    def get_session_secret(self, session, candidate):
+        return store_session_secret(session, candidate)
+
+    @async_queued_write('Session_Revocation')
+    def revoke_session(self, session, token_id, user_id, expires_at):
+        if not self.has_session_store:
+            return False
+        return record_revocation(session, token_id, user_id, expires_at)
+
+    async def get_revocations(self, after_revocation_id):
+        if not self.has_session_store:
+            return []
+        async with self.Session() as session:
+            return (await session.execute(revocations_statement(after_revocation_id))).all()
+
+    @async_cached('Product', 'Product_Tag', 'Category', 'Category_Closure', 'Product_Rating')
+    async def search_for_product(self, query, field, sort='relevance'):
+        if sort not in SEARCH_SORTS:
+            raise ValueError(f'unknown search sort: {sort!r}')
+        if field not in SEARCH_INDEX_COLUMNS:
+            return []
+        use_index = self.has_search_index and len(query) >= MIN_SEARCH_INDEX_QUERY
+        async with self.Session() as session:
+            result = await session.execute(search_statement(
+                query, field, sort, use_index, self.has_rating_aggregates,
+                self.has_category_closure))
+            return [serialize_rated_product(product) for product in result.all()]
+
+    @async_cached('Product', 'Product_Tag', 'Category', 'Category_Closure', 'Product_Rating')
+    async def get_category_products(self, query, after_product_id=None, limit=CATEGORY_PAGE_SIZE):
+        async with self.Session() as session:
+            categories = (await session.execute(
+                category_counts_statement(query, self.has_category_closure))).all()
+            if not categories:
+                return [], [], None
+            products = (await session.execute(category_page_statement(
+                query, after_product_id, limit, self.has_rating_aggregates,
+                self.has_category_closure))).all()
+        return page_category(categories, products, limit)
+
+    async def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        suggester = self.suggester
+        if suggester.version_due():
+            suggester.check_version(await self._catalog_version())
+        # 首次构建时其他请求等待; 过期重建时只由一个任务执行, 其余任务继续使用旧索引
+        if suggester.needs_build() and not (suggester.products is not None
+                                            and self.suggest_lock.locked()):
+            async with self.suggest_lock:
+                if suggester.needs_build():
+                    try:
+                        version = await self._catalog_version()
+                        products, categories = suggest_statements(
+                            self.has_rating_aggregates, self.has_category_closure,
+                            suggester.max_entries)
+                        async with self.Session() as session:
+                            product_rows = (await session.execute(products)).all()
+                            category_rows = (await session.execute(categories)).all()
+                        await asyncio.to_thread(suggester.build, product_rows, category_rows, version)
+                    except Exception as e:
+                        suggester.build_failed(e)
+        return suggester.lookup(prefix, limit)
+
+    async def _catalog_version(self):
+        try:
+            async with self.Session() as session:
+                return tuple((await session.execute(CATALOG_VERSION)).one())
+        except OperationalError:
+            return None
+
+    async def get_version(self, entity, entity_id):
+        if entity not in VERSIONED_ENTITIES:
+            raise ValueError(f'unknown versioned entity: {entity!r}')
+        if not self.has_row_versions:
+            return None
+        async with self.Session() as session:
+            rows = (await session.execute(row_version_statement(entity, entity_id))).all()
+        return page_version(rows)
+
+    @async_cached('User')
+    async def get_user(self, user_id, version=None):
+        async with self.Session() as session:
+            user = (await session.execute(profile_statement(user_id))).first()
+        return serialize_profile(user) if user else None
+
+    @async_queued_write('User')
+    def update_user(self, session, user_id, **kwargs):
+        return apply_user_update(session, user_id, kwargs)
+
+    async def get_purchase_history(self, user_id, before_order_id=None, limit=PURCHASE_PAGE_SIZE):
+        async with self.Session() as session:
+            with_archive = (await session.connection()).info.get(ARCHIVE_SCHEMA, False)
+            order_ids, hot_ids, archived_ids, next_before_order_id = split_purchase_page(
+                (await session.execute(purchase_page_statement(
+                    user_id, before_order_id, limit, with_archive))).all(), limit)
+            if not order_ids:
+                return [], [], None
+
+            orders, tracking = [], []
+            for ids, archived in ((hot_ids, False), (archived_ids, True)):
+                if ids:
+                    orders_statement, tracking_statement = purchase_statements(ids, archived)
+                    orders += (await session.execute(orders_statement)).all()
+                    tracking += (await session.execute(tracking_statement)).all()
+        if hot_ids and archived_ids:
+            orders.sort(key=lambda row: -row[0])
+        return group_purchase_history(order_ids, orders, tracking) + (next_before_order_id,)
+
+    async def get_products(self, product_ids, review_sort='newest', review_limit=0):
+        if review_sort not in REVIEW_SORT_KEYS:
+            raise ValueError(f'unknown review sort: {review_sort!r}')
+        return await self._get_products(parse_product_ids(product_ids), review_sort, review_limit)
+
+    @async_cached('Product', 'Review', 'Store', 'Product_Rating')
+    async def _get_products(self, product_ids, review_sort, review_limit):
+        async with self.Session() as session:
+            products = (await session.execute(
+                product_pages_statement(product_ids, self.has_rating_aggregates))).all()
+            reviews = []
+            if review_limit and products:
+                reviews = (await session.execute(
+                    top_reviews_statement(product_ids, review_sort, review_limit))).all()
+        return assemble_product_batch(product_ids, products, reviews, review_limit)
+
+    @async_cached('Product', 'Review', 'Store', 'Product_Rating')
+    async def get_product(self, product_id, review_sort='newest', review_cursor=None,
+                          review_limit=REVIEW_PAGE_SIZE, version=None):
+        if review_sort not in REVIEW_SORT_KEYS:
+            raise ValueError(f'unknown review sort: {review_sort!r}')
+        reviews = review_page_statement(product_id, review_sort, review_cursor, review_limit)
+
+        async with self.Session() as session:
+            row = (await session.execute(
+                product_page_statement(product_id, self.has_rating_aggregates))).first()
+            if row is None:
+                return None, [], None, None
+            reviews = (await session.execute(reviews)).all()
+
+        reviews, next_cursor = page_reviews(reviews, review_limit)
+        product, seller_id = serialize_product_page(row)
+        return product, reviews, seller_id, next_cursor
+
+    async def get_review_owners(self, review_id):
+        async with self.Session() as session:
+            return (await session.execute(review_owners_statement(review_id))).first()
+
+    @async_queued_write('Review', 'Product_Rating')
+    def add_review(self, session, review):
+        return insert_review(session, review)
+
+    @async_queued_write('Review', 'Product_Rating')
+    def delete_review(self, session, review_id):
+        return remove_review(session, review_id)
+
+    @async_queued_write('Review')
+    def add_reply(self, session, reply):
+        return set_review_reply(session, reply['review_id'], reply['reply'])
+
+    @async_queued_write('Review')
+    def delete_reply(self, session, review_id):
+        return set_review_reply(session, review_id, None)
+
+    async def checkout(self, buyer_id, items, payment_method=None):
+        lines = parse_checkout(buyer_id, items, payment_method)
+        result = await self._place_order(buyer_id, lines, payment_method)
+        if not self.has_row_versions:
+            self.cache.bump('Product')
+        if isinstance(result, CheckoutError):
+            raise result
+        return result or None
+
+    @async_queued_write('Order_Table', 'Order_Item')
+    def _place_order(self, session, buyer_id, lines, payment_method):
+        return place_order(session, buyer_id, lines, payment_method)
+
+    async def refresh_sales_rollups(self):
+        refreshed = await self._refresh_sales_rollups()
+        if refreshed:
+            self.sales_refreshed_at = time.monotonic()
+        return refreshed
+
+    @async_queued_write('Sales_Daily', 'Sales_Store_Daily', 'Sales_Merchant_Daily')
+    def _refresh_sales_rollups(self, session):
+        if not self.has_sales_rollups:
+            return False
+        return refresh_rollups(session)
+
+    async def get_merchant_sales(self, merchant_id, first=None, last=None, group_by='day',
+                                 limit=SALES_LIMIT, store_id=None):
+        query = parse_sales_query(first, last, group_by, limit)
+        if not self.has_sales_rollups:
+            return None
+        if time.monotonic() - self.sales_refreshed_at > SALES_REFRESH_INTERVAL:
+            await self.refresh_sales_rollups()
+        return await self._get_merchant_sales(merchant_id, *query, store_id)
+
+    @async_cached('Sales_Daily', 'Sales_Store_Daily', 'Sales_Merchant_Daily', 'Store')
+    async def _get_merchant_sales(self, merchant_id, first_day, last_day, group_by, limit, store_id):
+        async with self.Session() as session:
+            rows = (await session.execute(merchant_sales_statement(
+                merchant_id, first_day, last_day, group_by, store_id))).all()
+            store_rows = order_rows = None
+            if group_by == 'product':
+                store_rows = (await session.execute(merchant_sales_statement(
+                    merchant_id, first_day, last_day, 'store', store_id))).all()
+            if store_id is None:
+                order_rows = (await session.execute(merchant_orders_statement(
+                    merchant_id, first_day, last_day))).all()
+            through_order_id = await session.scalar(select(SALES_ROLLUP_CURSOR))
+        return assemble_merchant_sales(merchant_id, first_day, last_day, group_by, limit, store_id,
+                                       rows, store_rows, order_rows, through_order_id)
+
+    async def get_related_products(self, product_id, limit=RELATED_LIMIT):
+        # 只读内存映射, 查询只需微秒级, 无需交给线程池
+        return self.related_products.related(product_id, limit)
+
+    async def add_shipping_events(self, events, merchant_id=None):
+        result = await self._append_shipping_events(parse_shipping_events(events), merchant_id)
+        return result or None
+
+    @async_queued_write('Shipping', 'Shipping_Track')
+    def _append_shipping_events(self, session, events, merchant_id):
+        return append_shipping_events(session, events, self.has_shipping_updates, merchant_id)
+
+    async def get_shipping_updates(self, after_update_id=None, limit=1000):
+        if not self.has_shipping_updates:
+            return []
+        async with self.Session() as session:
+            return serialize_shipping_updates(
+                (await session.execute(shipping_updates_statement(after_update_id, limit))).all())
+
+    def cache_stats(self):
+        return self.cache.stats()
@@ -0,0 +1,402 @@
+"""Streaming bulk import of products and export of orders.
+
+    python -m minishop.database.bulk import-products --db data/e_commerce.db products.csv
+    python -m minishop.database.bulk import-products --db data/e_commerce.db products.jsonl \\
+        --rejects rejected.jsonl --max-errors 1000
+    python -m minishop.database.bulk export-orders --db data/e_commerce.db \\
+        --first-order-id 1000001 --last-order-id 2000000 --format csv --output orders.csv
+
+Imports read CSV (with a header row) or JSONL one record at a time and
+write `chunk_size` valid records per transaction through executemany,
+together with the job's Import_Checkpoint row. A failed or interrupted
+import therefore resumes exactly after the last committed chunk: run the
+same command again. Records that fail validation are skipped, written to
+`rejects` and counted; more than `max_errors` of them abort the import.
+Memory stays bounded by one chunk whatever the file size.
+
+Product records have the Product columns (product_id optional, updated in
+place when it exists) and `category_ids`, a JSON list or a CSV cell like
+"3;17", which replaces the product's Product_Tag rows when present.
+
+Exports stream Order_Table joined with Order_Item in order_id order, merged
+with the archive's copies of both once it is attached (see archive.py), and
+never hold more than one fetch batch: JSONL writes one order per line with
+its items nested, CSV one line per item with the order columns repeated.
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+from minishop.database.database import create_import_checkpoints
+from minishop.database.entities import DATETIME_FORMAT
+
+CHUNK_SIZE = 10_000
+MAX_ERRORS = 100
+EXPORT_BATCH_SIZE = 10_000
+FORMATS = ('csv', 'jsonl')
+PRODUCT_STATUSES = ('active', 'inactive')
+PRODUCT_COLUMNS = ('product_id', 'store_id', 'product_name', 'product_description', 'price',
+                   'stock', 'created_at', 'status')
+ORDER_COLUMNS = ('order_id', 'buyer_id', 'payer_id', 'payment_method', 'payment_status',
+                 'payment_time', 'order_status', 'total_amount', 'created_at')
+ORDER_ITEM_COLUMNS = ('product_id', 'quantity', 'price_at_purchase')
+
+
+class RecordError(ValueError):
+    """A source record that cannot be imported."""
+
+
+class ImportAborted(Exception):
+    """More rejected records than allowed; the committed chunks and checkpoint are kept."""
+
+
+def file_format(path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'ndjson':
+        fmt = 'jsonl'
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {FORMATS}, not {fmt!r}')
+    return fmt
+
+
+def read_records(source, fmt, offset=0):
+    """Yield (record dict, byte offset just past it) from binary file `source`,
+    starting at byte `offset` (0 or an offset this function yielded)."""
+    position = offset
+
+    def lines():
+        nonlocal position
+        for line in source:
+            position += len(line)
+            yield line.decode('utf-8-sig' if position == len(line) else 'utf-8')
+
+    if fmt == 'jsonl':
+        source.seek(offset)
+        for line in lines():
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield RecordError(f'invalid JSON: {e}'), position
+                    continue
+                yield record, position
+        return
+
+    # CSV 的表头总在文件开头; 续传时先读表头再跳到断点
+    source.seek(0)
+    position = 0
+    header = next(csv.reader(lines()), None)
+    if header is None:
+        return
+    if offset:
+        source.seek(offset)
+        position = offset
+    # csv.reader 每次只取完成一条记录所需的行, 因此 position 恰好落在记录末尾
+    for row in csv.reader(lines()):
+        if not row:
+            continue
+        if len(row) != len(header):
+            yield RecordError(f'expected {len(header)} fields, found {len(row)}'), position
+            continue
+        yield dict(zip(header, row)), position
+
+
+def _optional(record, name):
+    value = record.get(name)
+    return None if value is None or value == '' else value
+
+
+def _integer(record, name, minimum=0, required=True):
+    value = _optional(record, name)
+    if value is None:
+        if required:
+            raise RecordError(f'{name} is required')
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise RecordError(f'{name} must be an integer')
+    if value < minimum:
+        raise RecordError(f'{name} must be at least {minimum}')
+    return value
+
+
+def parse_product(record, category_ids):
+    """(Product row in PRODUCT_COLUMNS order, tag category ids or None) of a
+    source record; `category_ids` is the set of existing categories.
+    product_id is None for new products. Raises RecordError."""
+    if isinstance(record, RecordError):
+        raise record
+    if not isinstance(record, dict):
+        raise RecordError('record must be an object')
+    name = _optional(record, 'product_name')
+    if not isinstance(name, str) or len(name) > 255:
+        raise RecordError('product_name must be a string of at most 255 characters')
+    description = _optional(record, 'product_description')
+    if description is not None and not isinstance(description, str):
+        raise RecordError('product_description must be a string')
+    try:
+        price = round(float(_optional(record, 'price')), 2)
+    except (TypeError, ValueError):
+        raise RecordError('price must be a number')
+    if not price >= 0:
+        raise RecordError('price must not be negative')
+    created_at = _optional(record, 'created_at')
+    if created_at is None:
+        created_at = datetime.now().strftime(DATETIME_FORMAT)
+    else:
+        try:
+            created_at = datetime.strptime(created_at, DATETIME_FORMAT).strftime(DATETIME_FORMAT)
+        except (TypeError, ValueError):
+            raise RecordError(f'created_at must look like {datetime(2025, 4, 1):{DATETIME_FORMAT}}')
+    status = _optional(record, 'status') or 'active'
+    if status not in PRODUCT_STATUSES:
+        raise RecordError(f'status must be one of {PRODUCT_STATUSES}')
+    row = (_integer(record, 'product_id', 1, required=False), _integer(record, 'store_id', 1),
+           name, description, price, _integer(record, 'stock'), created_at, status)
+
+    tags = record.get('category_ids')
+    if tags is None:
+        return row, None
+    if isinstance(tags, str):
+        tags = [tag for tag in tags.replace('|', ';').split(';') if tag.strip()]
+    if not isinstance(tags, list):
+        raise RecordError('category_ids must be a list')
+    try:
+        tags = sorted({int(tag) for tag in tags})
+    except (TypeError, ValueError):
+        raise RecordError('category_ids must be integers')
+    unknown = [tag for tag in tags if tag not in category_ids]
+    if unknown:
+        raise RecordError(f'unknown category_ids: {unknown}')
+    return row, tags
+
+
+class ProductImporter:
+    """Import one source file into Product/Product_Tag on a sqlite3 connection.
+
+    The job name (the source's absolute path by default) keys the
+    checkpoint; a checkpoint is only reused while the file keeps its size,
+    `restart` discards it.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, chunk_size=CHUNK_SIZE, max_errors=MAX_ERRORS,
+                 rejects=None):
+        self.conn = conn
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.rejects = rejects
+        self.category_ids = set()
+
+    def _checkpoint(self, job, source_size, restart):
+        row = self.conn.execute(
+            'SELECT source_size, byte_offset, records, imported, rejected, finished '
+            'FROM Import_Checkpoint WHERE job = ?', (job,)).fetchone()
+        if row is None or restart:
+            return {'byte_offset': 0, 'records': 0, 'imported': 0, 'rejected': 0, 'finished': 0}
+        if row[0] != source_size:
+            raise ValueError(f'{job} changed since its checkpoint, import it again with restart')
+        return dict(zip(('byte_offset', 'records', 'imported', 'rejected', 'finished'), row[1:]))
+
+    def _reject(self, number, record, error, progress):
+        progress['rejected'] += 1
+        if self.rejects is not None:
+            data = None if isinstance(record, RecordError) else record
+            self.rejects.write(json.dumps({'record': number, 'error': str(error), 'data': data},
+                                          ensure_ascii=False) + '\n')
+
+    def _write_chunk(self, job, source_size, chunk, progress):
+        """Insert or update one chunk and move the checkpoint, in one transaction."""
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            stores = {store_id for store_id, in conn.execute(
+                'SELECT store_id FROM Store WHERE store_id IN (SELECT value FROM json_each(?))',
+                (json.dumps(sorted({row[1] for _, row, _ in chunk})),))}
+            # 新商品的编号在写锁内分配, 商品标签需要它
+            next_id = max([conn.execute('SELECT coalesce(max(product_id), 0) FROM Product')
+                          .fetchone()[0]] + [row[0] or 0 for _, row, _ in chunk]) + 1
+            products, tagged, tags = [], [], []
+            for number, row, product_tags in chunk:
+                if row[1] not in stores:
+                    self._reject(number, dict(zip(PRODUCT_COLUMNS, row)),
+                                 f'unknown store_id: {row[1]}', progress)
+                    continue
+                if row[0] is None:
+                    row = (next_id,) + row[1:]
+                    next_id += 1
+                products.append(row)
+                if product_tags is not None:
+                    tagged.append(row[0])
+                    tags.extend((row[0], category_id) for category_id in product_tags)
+            conn.executemany(
+                f"INSERT INTO Product({', '.join(PRODUCT_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                f"ON CONFLICT(product_id) DO UPDATE SET "
+                f"{', '.join(f'{c} = excluded.{c}' for c in PRODUCT_COLUMNS[1:])}", products)
+            conn.execute('DELETE FROM Product_Tag WHERE product_id IN (SELECT value FROM json_each(?))',
+                         (json.dumps(tagged),))
+            conn.executemany('INSERT OR IGNORE INTO Product_Tag(product_id, category_id) VALUES (?, ?)',
+                             tags)
+            progress['imported'] += len(products)
+            conn.execute(
+                'INSERT INTO Import_Checkpoint(job, source_size, byte_offset, records, imported, '
+                'rejected, finished, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP) '
+                'ON CONFLICT(job) DO UPDATE SET source_size = excluded.source_size, '
+                'byte_offset = excluded.byte_offset, records = excluded.records, '
+                'imported = excluded.imported, rejected = excluded.rejected, '
+                'finished = excluded.finished, updated_at = excluded.updated_at',
+                (job, source_size, progress['byte_offset'], progress['records'],
+                 progress['imported'], progress['rejected'], progress['finished']))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def run(self, path, fmt=None, job=None, restart=False):
+        """Import `path`; returns the job's totals {'records', 'imported', 'rejected', ...}."""
+        fmt = file_format(path, fmt)
+        job = job or os.path.abspath(path)
+        source_size = os.path.getsize(path)
+        isolation_level, self.conn.isolation_level = self.conn.isolation_level, None
+        try:
+            create_import_checkpoints(self.conn)
+            progress = self._checkpoint(job, source_size, restart)
+            if progress['finished']:
+                print(f'[INFO]{job} was already imported: {progress}')
+                return progress
+            if progress['byte_offset']:
+                print(f"[INFO]resuming {job} after record {progress['records']}")
+            self.category_ids = {category_id for category_id, in
+                                 self.conn.execute('SELECT category_id FROM Category')}
+            start = time.perf_counter()
+            started_with = progress['records']
+            with open(path, 'rb') as source:
+                chunk = []
+                for record, offset in read_records(source, fmt, progress['byte_offset']):
+                    progress['records'] += 1
+                    try:
+                        row, tags = parse_product(record, self.category_ids)
+                        chunk.append((progress['records'], row, tags))
+                    except RecordError as e:
+                        self._reject(progress['records'], record, e, progress)
+                    if progress['rejected'] > self.max_errors:
+                        raise ImportAborted(f"{progress['rejected']} rejected records, "
+                                            f"more than max_errors={self.max_errors}")
+                    progress['byte_offset'] = offset
+                    if len(chunk) >= self.chunk_size:
+                        self._write_chunk(job, source_size, chunk, progress)
+                        chunk = []
+                progress['finished'] = 1
+                self._write_chunk(job, source_size, chunk, progress)
+            elapsed = time.perf_counter() - start
+            records = progress['records'] - started_with
+            print(f"[INFO]Product: {records} records in {elapsed:.1f}s "
+                  f"({records / max(elapsed, 1e-9):,.0f} records/s), "
+                  f"{progress['imported']} imported, {progress['rejected']} rejected in total")
+            return progress
+        finally:
+            self.conn.isolation_level = isolation_level
+
+
+class OrderExporter:
+    """Write (order columns..., item columns...) rows, ordered by order_id, to `out` (text)."""
+
+    def __init__(self, out, fmt):
+        self.out = out
+        self.fmt = file_format('', fmt)
+        self.csv = csv.writer(out) if self.fmt == 'csv' else None
+        self.orders = 0
+        self.items = 0
+
+    def write(self, rows):
+        if self.csv is not None:
+            self.csv.writerow(ORDER_COLUMNS + ORDER_ITEM_COLUMNS)
+        order = None
+        for row in rows:
+            order_values, item_values = row[:len(ORDER_COLUMNS)], row[len(ORDER_COLUMNS):]
+            if order is None or order['order_id'] != order_values[0]:
+                if order is not None:
+                    self._write_order(order)
+                order = dict(zip(ORDER_COLUMNS, order_values))
+                order['items'] = []
+            if item_values[0] is not None:
+                order['items'].append(dict(zip(ORDER_ITEM_COLUMNS, item_values)))
+        if order is not None:
+            self._write_order(order)
+        self.out.flush()
+        return {'orders': self.orders, 'items': self.items}
+
+    def _write_order(self, order):
+        self.orders += 1
+        self.items += len(order['items'])
+        if self.csv is None:
+            self.out.write(json.dumps(order, ensure_ascii=False, separators=(',', ':')) + '\n')
+            return
+        values = [order[name] for name in ORDER_COLUMNS]
+        for item in order['items'] or [dict.fromkeys(ORDER_ITEM_COLUMNS)]:
+            self.csv.writerow(values + [item[name] for name in ORDER_ITEM_COLUMNS])
+
+
+def main():
+    from minishop.database.orm import Database
+
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    products = commands.add_parser('import-products', help='import products from CSV or JSONL')
+    products.add_argument('source', type=str, help='.csv (with header) or .jsonl file')
+    products.add_argument('--format', choices=FORMATS, default=None, help='default: from the extension')
+    products.add_argument('--job', type=str, default=None,
+                          help='checkpoint name, default: the absolute source path')
+    products.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    products.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='records per transaction')
+    products.add_argument('--max-errors', type=int, default=MAX_ERRORS,
+                          help='abort after this many rejected records')
+    products.add_argument('--rejects', type=str, default=None,
+                          help='append rejected records to this JSONL file')
+    orders = commands.add_parser('export-orders', help='export orders with their items')
+    orders.add_argument('--first-order-id', type=int, default=None)
+    orders.add_argument('--last-order-id', type=int, default=None)
+    orders.add_argument('--format', choices=FORMATS, default='jsonl')
+    orders.add_argument('--output', type=str, default=None, help='default: stdout')
+    orders.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE, help='rows per fetch')
+    for command in (products, orders):
+        command.add_argument('--db', type=str, default='data/e_commerce.db', help='database file name')
+    args = parser.parse_args()
+
+    # 数据库构造时的提示输出到 stderr, 导出到 stdout 的数据保持干净
+    with contextlib.redirect_stdout(sys.stderr):
+        db = Database(args.db)
+    if args.command == 'import-products':
+        rejects = open(args.rejects, 'a', encoding='utf-8') if args.rejects else None
+        try:
+            db.import_products(args.source, args.format, job=args.job, restart=args.restart,
+                               chunk_size=args.chunk_size, max_errors=args.max_errors,
+                               rejects=rejects)
+        except (ImportAborted, ValueError) as e:
+            print(f'[FAIL]{e}')
+            sys.exit(1)
+        finally:
+            if rejects is not None:
+                rejects.close()
+    else:
+        if args.output is None:
+            out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline='')
+        else:
+            out = open(args.output, 'w', encoding='utf-8', newline='')
+        start = time.perf_counter()
+        with out:
+            totals = db.export_orders(out, args.format, args.first_order_id, args.last_order_id,
+                                      args.batch_size)
+        print(f"[INFO]{totals['orders']} orders, {totals['items']} items exported in "
+              f"{time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
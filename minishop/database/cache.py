@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+
+class QueryCache:
+    """LRU + TTL cache for Database read results, invalidated by table versions.
+
+    Every entry remembers the version of each table it was read from. A write
+    bumps the versions of the tables it touched, so the next lookup of an
+    entry depending on them misses instead of serving stale rows. The TTL
+    only bounds staleness caused by writers in other processes.
+    Cached values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_entries=1024, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.table_versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    def _versions(self, tables):
+        return tuple(self.table_versions.get(table, 0) for table in tables)
+
+    def lookup(self, key, tables):
+        """Return (True, value) on a hit, else (False, versions) to pass to `store`."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at, versions = entry
+                if versions != self._versions(tables):
+                    del self.entries[key]
+                    self.invalidations += 1
+                elif expires_at < time.monotonic():
+                    del self.entries[key]
+                    self.expirations += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+            self.misses += 1
+            # 在读数据库之前记录版本号, 读取期间发生的写入会让该条目在下次命中时失效
+            return False, self._versions(tables)
+
+    def store(self, key, value, versions):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl, versions)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, tables, loader):
+        if self.max_entries <= 0:
+            return loader()
+        found, result = self.lookup(key, tables)
+        if found:
+            return result
+        value = loader()
+        self.store(key, value, result)
+        return value
+
+    def bump(self, *tables):
+        with self.lock:
+            for table in tables:
+                self.table_versions[table] = self.table_versions.get(table, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'expirations': self.expirations,
+            }
+
+
+def cached(*tables):
+    """Read-through cache a Database method on `self.cache`, keyed by its arguments."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            return self.cache.get_or_load(
+                key, tables, lambda: method(self, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def async_cached(*tables):
+    """`cached` for coroutine methods of an async Database."""
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self.cache.max_entries <= 0:
+                return await method(self, *args, **kwargs)
+            key = (method.__name__, args, tuple(sorted(kwargs.items())))
+            found, result = self.cache.lookup(key, tables)
+            if found:
+                return result
+            value = await method(self, *args, **kwargs)
+            self.cache.store(key, value, result)
+            return value
+        return wrapper
+    return decorator
@@ -3,7 +3,587 @@ import argparse
 import sqlite3
 import hashlib
 
-def create_table(conn: sqlite3.Connection):
+# 商品全文索引: rowid 即 product_id, category_name 为该商品所有分类名(空格分隔)
+SEARCH_INDEX_CATEGORIES = """
+    (SELECT group_concat(Category.category_name, ' ')
+     FROM Product_Tag JOIN Category ON Product_Tag.category_id = Category.category_id
+     WHERE Product_Tag.product_id = {product_id})
+"""
+
+def _refresh_search_row(product_id: str) -> str:
+    # 先删后插: 外层语句的 ON CONFLICT 策略会覆盖触发器内的 OR REPLACE
+    return f"""
+        DELETE FROM Product_Search WHERE rowid = {product_id};
+        INSERT INTO Product_Search(rowid, product_name, product_description, category_name)
+        SELECT product_id, product_name, product_description,
+               {SEARCH_INDEX_CATEGORIES.format(product_id='Product.product_id')}
+        FROM Product WHERE product_id = {product_id};
+    """
+
+def create_search_index(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # trigram 分词支持中文子串匹配, 查询至少需要 3 个字符
+    cursor.executescript(f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS Product_Search USING fts5(
+        product_name, product_description, category_name,
+        tokenize = 'trigram'
+    );
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_ai AFTER INSERT ON Product BEGIN
+        {_refresh_search_row('new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_au
+    AFTER UPDATE OF product_name, product_description ON Product BEGIN
+        {_refresh_search_row('new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_ad AFTER DELETE ON Product BEGIN
+        DELETE FROM Product_Search WHERE rowid = old.product_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_tag_ai AFTER INSERT ON Product_Tag BEGIN
+        {_refresh_search_row('new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_tag_ad AFTER DELETE ON Product_Tag BEGIN
+        {_refresh_search_row('old.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_category_au
+    AFTER UPDATE OF category_name ON Category BEGIN
+        UPDATE Product_Search
+        SET category_name = {SEARCH_INDEX_CATEGORIES.format(product_id='Product_Search.rowid')}
+        WHERE rowid IN (SELECT product_id FROM Product_Tag WHERE category_id = new.category_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Search_category_ad AFTER DELETE ON Category BEGIN
+        UPDATE Product_Search
+        SET category_name = {SEARCH_INDEX_CATEGORIES.format(product_id='Product_Search.rowid')}
+        WHERE rowid IN (SELECT product_id FROM Product_Tag WHERE category_id = old.category_id);
+    END;
+    """)
+
+def _rating_delta(row: str, sign: str) -> str:
+    # 把一条评价计入(sign='+')或移出(sign='-')其商品的评分汇总
+    histogram = ', '.join(f'rating_{star} = rating_{star} {sign} ({row}.rating = {star})'
+                          for star in range(1, 6))
+    return f"""
+        INSERT INTO Product_Rating(product_id)
+        SELECT {row}.product_id WHERE {row}.rating IS NOT NULL AND NOT EXISTS
+            (SELECT 1 FROM Product_Rating WHERE product_id = {row}.product_id);
+        UPDATE Product_Rating
+        SET review_count = review_count {sign} 1, rating_sum = rating_sum {sign} {row}.rating,
+            {histogram}
+        WHERE product_id = {row}.product_id AND {row}.rating IS NOT NULL;
+    """
+
+def create_rating_aggregates(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 每个商品的评价数、评分和与 1-5 星分布, 由 Review 上的触发器在同一事务内增量维护
+    # 不使用 ON CONFLICT/OR 子句: 外层语句的冲突策略会覆盖触发器内的策略
+    cursor.executescript(f"""
+    CREATE TABLE IF NOT EXISTS Product_Rating (
+        product_id INTEGER PRIMARY KEY,
+        review_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        rating_1 INTEGER NOT NULL DEFAULT 0,
+        rating_2 INTEGER NOT NULL DEFAULT 0,
+        rating_3 INTEGER NOT NULL DEFAULT 0,
+        rating_4 INTEGER NOT NULL DEFAULT 0,
+        rating_5 INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (product_id) REFERENCES Product(product_id)
+    );
+
+    CREATE TRIGGER IF NOT EXISTS Product_Rating_ai AFTER INSERT ON Review BEGIN
+        {_rating_delta('new', '+')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Rating_ad AFTER DELETE ON Review BEGIN
+        {_rating_delta('old', '-')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Product_Rating_au AFTER UPDATE OF product_id, rating ON Review BEGIN
+        {_rating_delta('old', '-')}
+        {_rating_delta('new', '+')}
+    END;
+    """)
+
+def rebuild_rating_aggregates(conn: sqlite3.Connection):
+    """Recompute Product_Rating from Review, creating it and its triggers when missing."""
+    create_rating_aggregates(conn)
+    histogram = ', '.join(f'sum(rating = {star})' for star in range(1, 6))
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM Product_Rating')
+    cursor.execute(f"""
+        INSERT INTO Product_Rating(product_id, review_count, rating_sum,
+                                   rating_1, rating_2, rating_3, rating_4, rating_5)
+        SELECT product_id, count(*), sum(rating), {histogram}
+        FROM Review WHERE rating IS NOT NULL
+        GROUP BY product_id
+    """)
+    conn.commit()
+
+# 以 category_id 为根的子树(含自身)
+CATEGORY_SUBTREE = "SELECT descendant_id FROM Category_Closure WHERE ancestor_id = {category_id}"
+
+def _detach_subtree(category_id: str, strict: bool) -> str:
+    # 删除子树内节点与子树外祖先之间的路径; strict 时根节点自身也被移出
+    subtree = CATEGORY_SUBTREE.format(category_id=category_id)
+    inner = subtree + (f" AND descendant_id != {category_id}" if strict else "")
+    return f"""
+        DELETE FROM Category_Closure
+        WHERE descendant_id IN ({subtree}) AND ancestor_id NOT IN ({inner});
+    """
+
+def create_category_closure(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 分类树的闭包表: 每对 (祖先, 后代) 一行, 含深度为 0 的自身; 由 Category 上的触发器维护
+    cursor.executescript(f"""
+    CREATE TABLE IF NOT EXISTS Category_Closure (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id),
+        FOREIGN KEY (ancestor_id) REFERENCES Category(category_id),
+        FOREIGN KEY (descendant_id) REFERENCES Category(category_id)
+    );
+    CREATE INDEX IF NOT EXISTS Category_Closure_descendant_idx
+    ON Category_Closure(descendant_id, ancestor_id);
+
+    CREATE TRIGGER IF NOT EXISTS Category_Closure_ai AFTER INSERT ON Category BEGIN
+        INSERT INTO Category_Closure(ancestor_id, descendant_id, depth)
+        SELECT new.category_id, new.category_id, 0
+        UNION ALL
+        SELECT ancestor_id, new.category_id, depth + 1
+        FROM Category_Closure WHERE descendant_id = new.parent_category_id;
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Category_Closure_bu
+    BEFORE UPDATE OF parent_category_id ON Category
+    WHEN new.parent_category_id IN ({CATEGORY_SUBTREE.format(category_id='old.category_id')}) BEGIN
+        SELECT RAISE(ABORT, 'category cannot become its own descendant');
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Category_Closure_au
+    AFTER UPDATE OF parent_category_id ON Category BEGIN
+        {_detach_subtree('new.category_id', strict=False)}
+        INSERT INTO Category_Closure(ancestor_id, descendant_id, depth)
+        SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+        FROM Category_Closure AS above, Category_Closure AS below
+        WHERE above.descendant_id = new.parent_category_id AND below.ancestor_id = new.category_id;
+    END;
+
+    -- 被删分类的子分类成为新的根
+    CREATE TRIGGER IF NOT EXISTS Category_Closure_ad AFTER DELETE ON Category BEGIN
+        {_detach_subtree('old.category_id', strict=True)}
+    END;
+    """)
+
+def rebuild_category_closure(conn: sqlite3.Connection):
+    """Recompute Category_Closure from parent_category_id, creating it and its triggers when missing."""
+    create_category_closure(conn)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM Category_Closure')
+    cursor.execute("""
+        WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+            SELECT category_id, category_id, 0 FROM Category
+            UNION ALL
+            SELECT closure.ancestor_id, Category.category_id, closure.depth + 1
+            FROM closure JOIN Category ON Category.parent_category_id = closure.descendant_id
+        )
+        INSERT INTO Category_Closure(ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM closure
+    """)
+    conn.commit()
+
+def _bump_version(entity: str, entity_id: str) -> str:
+    # 记录一次页面内容变化: 版本号加一并更新修改时间, HTTP 的 ETag/Last-Modified 由此得出
+    return f"""
+        INSERT INTO Row_Version(entity, entity_id, version, updated_at)
+        SELECT '{entity}', {entity_id}, 0, 0 WHERE NOT EXISTS
+            (SELECT 1 FROM Row_Version WHERE entity = '{entity}' AND entity_id = {entity_id});
+        UPDATE Row_Version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE entity = '{entity}' AND entity_id = {entity_id};
+    """
+
+def create_row_versions(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 商品页与个人资料的版本号, 由触发器在写入的同一事务内递增; 从未改过的行没有记录, 视为版本 0
+    # ('database', 0) 行的版本号是随机的库标识, 重新生成的数据库不会与旧库的 ETag 相同
+    cursor.executescript(f"""
+    CREATE TABLE IF NOT EXISTS Row_Version (
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL,
+        PRIMARY KEY (entity, entity_id)
+    ) WITHOUT ROWID;
+
+    INSERT INTO Row_Version(entity, entity_id, version, updated_at)
+    SELECT 'database', 0, abs(random()) % 4294967296, CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE NOT EXISTS (SELECT 1 FROM Row_Version WHERE entity = 'database');
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_product_ai AFTER INSERT ON Product BEGIN
+        {_bump_version('product', 'new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_product_au AFTER UPDATE ON Product BEGIN
+        {_bump_version('product', 'new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_product_ad AFTER DELETE ON Product BEGIN
+        {_bump_version('product', 'old.product_id')}
+    END;
+
+    -- 商品页包含评价与评分汇总
+    CREATE TRIGGER IF NOT EXISTS Row_Version_review_ai AFTER INSERT ON Review BEGIN
+        {_bump_version('product', 'new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_review_au AFTER UPDATE ON Review BEGIN
+        {_bump_version('product', 'old.product_id')}
+        {_bump_version('product', 'new.product_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_review_ad AFTER DELETE ON Review BEGIN
+        {_bump_version('product', 'old.product_id')}
+    END;
+
+    -- 商品页包含店主 seller_id
+    CREATE TRIGGER IF NOT EXISTS Row_Version_store_au AFTER UPDATE OF owner_id ON Store BEGIN
+        INSERT INTO Row_Version(entity, entity_id, version, updated_at)
+        SELECT 'product', product_id, 0, 0 FROM Product
+        WHERE store_id = new.store_id AND product_id NOT IN
+            (SELECT entity_id FROM Row_Version WHERE entity = 'product');
+        UPDATE Row_Version SET version = version + 1, updated_at = CAST(strftime('%s', 'now') AS INTEGER)
+        WHERE entity = 'product'
+          AND entity_id IN (SELECT product_id FROM Product WHERE store_id = new.store_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_user_ai AFTER INSERT ON User BEGIN
+        {_bump_version('user', 'new.user_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_user_au AFTER UPDATE ON User BEGIN
+        {_bump_version('user', 'new.user_id')}
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Row_Version_user_ad AFTER DELETE ON User BEGIN
+        {_bump_version('user', 'old.user_id')}
+    END;
+    """)
+
+def create_shipping_updates(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 物流变化日志: 新增的轨迹与 Shipping.shipping_status 的变化各记一行, 供推送服务按 update_id 增量读取
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS Shipping_Update (
+        update_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipping_id INTEGER NOT NULL,
+        track_id INTEGER,                   -- NULL: 只有 shipping_status 变化
+        FOREIGN KEY (shipping_id) REFERENCES Shipping(shipping_id)
+    );
+
+    CREATE TRIGGER IF NOT EXISTS Shipping_Update_track_ai AFTER INSERT ON Shipping_Track BEGIN
+        INSERT INTO Shipping_Update(shipping_id, track_id) VALUES (new.shipping_id, new.track_id);
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS Shipping_Update_status_au
+    AFTER UPDATE OF shipping_status ON Shipping
+    WHEN old.shipping_status IS NOT new.shipping_status BEGIN
+        INSERT INTO Shipping_Update(shipping_id, track_id) VALUES (new.shipping_id, NULL);
+    END;
+    """)
+
+# 计入销售额的订单: 除已取消外的所有订单; day 为 1970-01-01 起的天数
+SALES_ORDER = "Order_Table.order_status != 'canceled'"
+SALES_DAY = "CAST(julianday(Order_Table.created_at) - 2440587.5 AS INTEGER)"
+
+def _sales_deltas(orders: str, condition: str, sign: str) -> list:
+    """Upserts adding `sign` times the sales of the orders selected by `orders`
+    (a FROM clause joining Order_Table) and `condition` to the rollup tables."""
+    joins = f"""
+        FROM {orders}
+        CROSS JOIN Order_Item ON Order_Item.order_id = Order_Table.order_id
+        CROSS JOIN Product ON Product.product_id = Order_Item.product_id"""
+    items = f"""{joins}
+        WHERE {condition}"""
+    merchant_items = f"""{joins}
+        CROSS JOIN Store ON Store.store_id = Product.store_id
+        WHERE {condition}"""
+    return [f"""
+    INSERT INTO Sales_Daily(store_id, day, product_id, revenue, units, orders)
+    SELECT Product.store_id, {SALES_DAY}, Order_Item.product_id,
+           sum({sign} * Order_Item.quantity * Order_Item.price_at_purchase),
+           sum({sign} * Order_Item.quantity), sum({sign})
+    {items}
+    GROUP BY 1, 2, 3
+    ON CONFLICT(store_id, day, product_id) DO UPDATE SET
+        revenue = revenue + excluded.revenue, units = units + excluded.units,
+        orders = orders + excluded.orders
+    """, f"""
+    INSERT INTO Sales_Store_Daily(store_id, day, revenue, units, orders)
+    SELECT store_id, day, sum(revenue), sum(units), sum(sign) FROM (
+        SELECT Product.store_id AS store_id, {SALES_DAY} AS day, {sign} AS sign,
+               sum({sign} * Order_Item.quantity * Order_Item.price_at_purchase) AS revenue,
+               sum({sign} * Order_Item.quantity) AS units
+        {items}
+        GROUP BY Product.store_id, Order_Table.order_id
+    )
+    GROUP BY store_id, day
+    ON CONFLICT(store_id, day) DO UPDATE SET
+        revenue = revenue + excluded.revenue, units = units + excluded.units,
+        orders = orders + excluded.orders
+    """, f"""
+    INSERT INTO Sales_Merchant_Daily(merchant_id, day, orders)
+    SELECT merchant_id, day, sum(sign) FROM (
+        SELECT Store.owner_id AS merchant_id, {SALES_DAY} AS day, {sign} AS sign
+        {merchant_items}
+        GROUP BY Store.owner_id, Order_Table.order_id
+    )
+    GROUP BY merchant_id, day
+    ON CONFLICT(merchant_id, day) DO UPDATE SET orders = orders + excluded.orders
+    """]
+
+# 增量刷新: 汇总 last_order_id 之后的新订单, 再修正已汇总订单的取消/恢复; 须在一个事务内执行
+# 新订单按主键范围读取, 范围两端是状态表的主键子查询; CROSS JOIN 固定连接顺序由
+# Order_Table 范围/待修正表驱动, 避免优化器按统计信息改为扫描 Order_Table/Order_Item
+SALES_ROLLUP_STATE = "(SELECT {} FROM Sales_Rollup_State WHERE name = 'sales')"
+SALES_ROLLUP_REFRESH = [
+    "UPDATE Sales_Rollup_State SET target_order_id = "
+    "(SELECT coalesce(max(order_id), 0) FROM Order_Table) WHERE name = 'sales'",
+    *_sales_deltas("Order_Table",
+                   f"Order_Table.order_id > {SALES_ROLLUP_STATE.format('last_order_id')} "
+                   f"AND Order_Table.order_id <= {SALES_ROLLUP_STATE.format('target_order_id')} "
+                   f"AND {SALES_ORDER}", '1'),
+    *_sales_deltas("""Sales_Rollup_Dirty
+        CROSS JOIN Order_Table ON Order_Table.order_id = Sales_Rollup_Dirty.order_id""",
+                   f"({SALES_ORDER}) != Sales_Rollup_Dirty.counted",
+                   f"(CASE WHEN {SALES_ORDER} THEN 1 ELSE -1 END)"),
+    "DELETE FROM Sales_Rollup_Dirty",
+    "UPDATE Sales_Rollup_State SET last_order_id = target_order_id, "
+    "refreshed_at = CURRENT_TIMESTAMP WHERE name = 'sales'",
+]
+
+def create_sales_rollups(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    # 早先建立的汇总没有 Sales_Merchant_Daily, 建表后须从全部订单重建
+    tables = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    backfill = 'Sales_Store_Daily' in tables and 'Sales_Merchant_Daily' not in tables
+
+    # 商家销售汇总: 每店铺每商品每天, 每店铺每天(订单数按店铺去重), 与每商家每天的订单数(按商家去重,
+    # 一个订单买了同一商家几个店铺的商品只计一次; 商家按汇总时店铺的 owner_id, 店铺转手后须重建)
+    # 新订单由 refresh_sales_rollups 按 order_id 增量汇总; 已汇总订单取消或恢复时由触发器记入 Sales_Rollup_Dirty
+    cursor.executescript(f"""
+    CREATE TABLE IF NOT EXISTS Sales_Daily (
+        store_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        units INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (store_id, day, product_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS Sales_Store_Daily (
+        store_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        revenue REAL NOT NULL,
+        units INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (store_id, day)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS Sales_Merchant_Daily (
+        merchant_id INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (merchant_id, day)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS Sales_Rollup_State (
+        name TEXT PRIMARY KEY,
+        last_order_id INTEGER NOT NULL,
+        target_order_id INTEGER NOT NULL,
+        refreshed_at DATETIME
+    );
+    INSERT INTO Sales_Rollup_State(name, last_order_id, target_order_id)
+    SELECT 'sales', 0, 0 WHERE NOT EXISTS (SELECT 1 FROM Sales_Rollup_State WHERE name = 'sales');
+
+    CREATE TABLE IF NOT EXISTS Sales_Rollup_Dirty (
+        order_id INTEGER PRIMARY KEY,
+        counted INTEGER NOT NULL            -- 变化前是否已计入汇总
+    );
+
+    CREATE TRIGGER IF NOT EXISTS Sales_Rollup_order_au AFTER UPDATE OF order_status ON Order_Table
+    WHEN (old.order_status = 'canceled') != (new.order_status = 'canceled')
+     AND old.order_id <= (SELECT last_order_id FROM Sales_Rollup_State WHERE name = 'sales') BEGIN
+        INSERT INTO Sales_Rollup_Dirty(order_id, counted)
+        SELECT new.order_id, old.order_status != 'canceled'
+        WHERE NOT EXISTS (SELECT 1 FROM Sales_Rollup_Dirty WHERE order_id = new.order_id);
+    END;
+    """)
+    if backfill:
+        rebuild_sales_rollups(conn)
+
+def refresh_sales_rollups(conn: sqlite3.Connection):
+    """Fold the orders placed or (un)canceled since the last refresh into the sales rollups."""
+    create_sales_rollups(conn)
+    cursor = conn.cursor()
+    for statement in SALES_ROLLUP_REFRESH:
+        cursor.execute(statement)
+    conn.commit()
+
+def rebuild_sales_rollups(conn: sqlite3.Connection):
+    """Recompute the sales rollups from all orders, creating them and their trigger when missing."""
+    create_sales_rollups(conn)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM Sales_Daily')
+    cursor.execute('DELETE FROM Sales_Store_Daily')
+    cursor.execute('DELETE FROM Sales_Merchant_Daily')
+    cursor.execute('DELETE FROM Sales_Rollup_Dirty')
+    cursor.execute("UPDATE Sales_Rollup_State SET last_order_id = 0 WHERE name = 'sales'")
+    refresh_sales_rollups(conn)
+
+def create_import_checkpoints(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 批量导入的断点: 与每一批数据在同一事务中提交, 失败后从 byte_offset 继续读取源文件
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS Import_Checkpoint (
+        job TEXT PRIMARY KEY,
+        source_size INTEGER NOT NULL,       -- 源文件大小, 文件变化后断点作废
+        byte_offset INTEGER NOT NULL,
+        records INTEGER NOT NULL,
+        imported INTEGER NOT NULL,
+        rejected INTEGER NOT NULL,
+        finished INTEGER NOT NULL DEFAULT 0,
+        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+
+def create_session_store(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 登录令牌的签名密钥与已吊销令牌, 供同一数据库上的所有 worker 进程共享
+    # 吊销记录只需保留到令牌过期; revocation_id 单调递增, 各进程据此增量拉取
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS Session_Key (
+        key_id INTEGER PRIMARY KEY CHECK (key_id = 1),
+        secret TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Session_Revocation (
+        revocation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        token_id TEXT NOT NULL UNIQUE,
+        user_id INTEGER NOT NULL,
+        expires_at REAL NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES User(user_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS Session_Revocation_expires_idx ON Session_Revocation(expires_at);
+    """)
+
+def create_order_archive(conn: sqlite3.Connection, schema: str = 'main'):
+    """Tables of the cold order archive in `schema` (an archive file opened on its
+    own, or ATTACHed): the order tables with their columns in the same order, so
+    rows move with INSERT ... SELECT *, and the indexes of the history queries."""
+    cursor = conn.cursor()
+
+    # 归档库只存放订单及其物流, User/Product 仍在主库, 因此不声明跨库外键
+    cursor.executescript(f"""
+    CREATE TABLE IF NOT EXISTS {schema}.Order_Table (
+        order_id INTEGER PRIMARY KEY,
+        buyer_id INTEGER NOT NULL,
+        payer_id INTEGER,
+        payment_method TEXT,
+        payment_status TEXT,
+        payment_time DATETIME DEFAULT NULL,
+        order_status TEXT NOT NULL,
+        total_amount DECIMAL(10,2) NOT NULL,
+        created_at DATETIME
+    );
+
+    CREATE TABLE IF NOT EXISTS {schema}.Order_Item (
+        order_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL,
+        price_at_purchase DECIMAL(10,2) NOT NULL,
+        PRIMARY KEY (order_id, product_id)
+    );
+
+    CREATE TABLE IF NOT EXISTS {schema}.Shipping (
+        shipping_id INTEGER PRIMARY KEY,
+        order_id INTEGER NOT NULL,
+        tracking_number VARCHAR(50) NOT NULL,
+        carrier VARCHAR(50) NOT NULL,
+        shipping_status TEXT NOT NULL,
+        estimated_arrival DATETIME,
+        actual_arrival DATETIME,
+        recipient_name VARCHAR(50) NOT NULL,
+        recipient_phone VARCHAR(20) NOT NULL,
+        shipping_address TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS {schema}.Shipping_Track (
+        shipping_id INTEGER NOT NULL,
+        track_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        location TEXT NOT NULL,
+        timestamp DATETIME,
+        PRIMARY KEY (shipping_id, track_id)
+    );
+
+    CREATE INDEX IF NOT EXISTS {schema}.Order_Table_buyer_idx ON Order_Table(buyer_id);
+    CREATE INDEX IF NOT EXISTS {schema}.Shipping_order_idx ON Shipping(order_id);
+    """)
+
+def create_indexes(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    # 热点查询过滤/排序所用外键的二级索引, 可在已有数据库上重复执行
+    cursor.executescript("""
+    -- 购物记录: buyer_id 过滤, 按 order_id (rowid) 倒序分页
+    CREATE INDEX IF NOT EXISTS Order_Table_buyer_idx ON Order_Table(buyer_id);
+    -- 商品页评价: 按时间或评分排序的 keyset 分页
+    CREATE INDEX IF NOT EXISTS Review_product_time_idx ON Review(product_id, comment_time);
+    CREATE INDEX IF NOT EXISTS Review_product_rating_idx ON Review(product_id, rating);
+    CREATE INDEX IF NOT EXISTS Shipping_order_idx ON Shipping(order_id);
+    CREATE INDEX IF NOT EXISTS Product_store_idx ON Product(store_id);
+    CREATE INDEX IF NOT EXISTS Product_Tag_category_idx ON Product_Tag(category_id, product_id);
+    CREATE INDEX IF NOT EXISTS Store_owner_idx ON Store(owner_id);
+
+    PRAGMA optimize;
+    """)
+
+def rebuild_search_index(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+    cursor.executescript("""
+    DROP TABLE IF EXISTS Product_Search;
+    DROP TRIGGER IF EXISTS Product_Search_ai;
+    DROP TRIGGER IF EXISTS Product_Search_au;
+    DROP TRIGGER IF EXISTS Product_Search_ad;
+    DROP TRIGGER IF EXISTS Product_Search_tag_ai;
+    DROP TRIGGER IF EXISTS Product_Search_tag_ad;
+    DROP TRIGGER IF EXISTS Product_Search_category_au;
+    DROP TRIGGER IF EXISTS Product_Search_category_ad;
+    """)
+    create_search_index(conn)
+    cursor.execute(f"""
+        INSERT INTO Product_Search(rowid, product_name, product_description, category_name)
+        SELECT product_id, product_name, product_description,
+               {SEARCH_INDEX_CATEGORIES.format(product_id='Product.product_id')}
+        FROM Product
+    """)
+    conn.commit()
+
+def create_schema(conn: sqlite3.Connection):
     cursor = conn.cursor()
 
     cursor.executescript("""
@@ -127,6 +707,20 @@ def create_table(conn: sqlite3.Connection):
     );                                                                           
     """)
 
+def create_table(conn: sqlite3.Connection):
+    cursor = conn.cursor()
+
+    create_schema(conn)
+    create_search_index(conn)
+    create_rating_aggregates(conn)
+    create_category_closure(conn)
+    create_session_store(conn)
+    create_row_versions(conn)
+    create_shipping_updates(conn)
+    create_import_checkpoints(conn)
+    create_sales_rollups(conn)
+    create_indexes(conn)
+
     def get_password_hash(password: str) -> str:
         return hashlib.sha256(password.encode('utf-8')).hexdigest()
     users = [('小明', get_password_hash('123456'), 'merchant'),
@@ -140,13 +734,11 @@ def create_table(conn: sqlite3.Connection):
              ('Mick', get_password_hash('890123'), 'customer'),
              ('Sarra', get_password_hash('901234'), 'customer')]
 
-    for user in users:
-        cursor.executescript(f"""
-            -- 学生数据
-            INSERT or IGNORE INTO User(username, password_hash, user_type) VALUES
-            ('{user[0]}', '{user[1]}', '{user[2]}');
-        """)
-        
+    # 学生数据
+    cursor.executemany(
+        "INSERT or IGNORE INTO User(username, password_hash, user_type) VALUES (?, ?, ?)",
+        users)
+
     cursor.executescript("""
     -- 店铺数据
     INSERT or IGNORE INTO Store(store_name, owner_id, store_description, store_status) VALUES
@@ -200,7 +792,10 @@ def create_table(conn: sqlite3.Connection):
     ('食品', NULL),
     ('服装', NULL),          
     ('医药', NULL),          
-    ('生活家居', NULL);
+    ('生活家居', NULL),
+    ('手机', 1),
+    ('羽毛球', 2),
+    ('水果', 3);
 
     -- 商品标签数据
     INSERT or IGNORE INTO Product_Tag(product_id, category_id) VALUES
@@ -214,7 +809,11 @@ def create_table(conn: sqlite3.Connection):
     (8, 6),
     (9, 5),
     (10, 5),
-    (11, 4);                
+    (11, 4),
+    (1, 8),
+    (3, 8),
+    (4, 9),
+    (6, 7);                
 
     -- 物流信息数据
     INSERT or IGNORE INTO Shipping(order_id, tracking_number, carrier, shipping_status, estimated_arrival, actual_arrival, recipient_name, recipient_phone, shipping_address) VALUES
@@ -238,10 +837,59 @@ def create_table(conn: sqlite3.Connection):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--db', type=str, default='data/test.db', help='database file name')
+    parser.add_argument('--rebuild-search-index', action='store_true',
+                        help='rebuild the product full-text index of an existing database')
+    parser.add_argument('--create-indexes', action='store_true',
+                        help='add the secondary indexes to an existing database')
+    parser.add_argument('--rebuild-ratings', action='store_true',
+                        help='backfill or repair the per-product rating aggregates')
+    parser.add_argument('--rebuild-category-closure', action='store_true',
+                        help='backfill or repair the category tree closure table')
+    parser.add_argument('--create-row-versions', action='store_true',
+                        help='add the page version table behind HTTP ETags to an existing database')
+    parser.add_argument('--create-shipping-updates', action='store_true',
+                        help='add the shipping change log behind the tracking event streams')
+    parser.add_argument('--rebuild-sales-rollups', action='store_true',
+                        help='backfill or repair the merchant sales rollups')
+    parser.add_argument('--refresh-sales-rollups', action='store_true',
+                        help='fold the orders placed since the last refresh into the sales rollups')
+    parser.add_argument('--create-session-store', action='store_true',
+                        help='add the login token key and revocation tables to an existing database')
     args = parser.parse_args()
 
     conn = sqlite3.connect(args.db)
     print('Opened database successfully')
-    create_table(conn)
-    print('Table created successfully')
+    if args.create_indexes:
+        create_indexes(conn)
+        print('Indexes created successfully')
+    elif args.rebuild_search_index:
+        rebuild_search_index(conn)
+        print('Search index rebuilt successfully')
+    elif args.rebuild_ratings:
+        rebuild_rating_aggregates(conn)
+        print('Rating aggregates rebuilt successfully')
+    elif args.rebuild_category_closure:
+        rebuild_category_closure(conn)
+        print('Category closure rebuilt successfully')
+    elif args.create_row_versions:
+        create_row_versions(conn)
+        conn.commit()
+        print('Row versions created successfully')
+    elif args.create_shipping_updates:
+        create_shipping_updates(conn)
+        conn.commit()
+        print('Shipping updates created successfully')
+    elif args.rebuild_sales_rollups:
+        rebuild_sales_rollups(conn)
+        print('Sales rollups rebuilt successfully')
+    elif args.refresh_sales_rollups:
+        refresh_sales_rollups(conn)
+        print('Sales rollups refreshed successfully')
+    elif args.create_session_store:
+        create_session_store(conn)
+        conn.commit()
+        print('Session store created successfully')
+    else:
+        create_table(conn)
+        print('Table created successfully')
     conn.close()
\ No newline at end of file
@@ -1,24 +1,68 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, Integer, String, Text,
-                        DECIMAL, DATETIME, func, ForeignKey,
-                        CheckConstraint, PrimaryKeyConstraint,)
-from decimal import Decimal
-from datetime import datetime
+                        DECIMAL, DATETIME, Float, func, ForeignKey,
+                        CheckConstraint, PrimaryKeyConstraint, MetaData,)
 
 # Define the base class for ORM models
 Base = declarative_base()
 
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def _format_datetime(value):
+    return value.strftime(DATETIME_FORMAT) if value is not None else None
+
+def _format_decimal(value):
+    return float(value) if value is not None else None
+
+def _converter(column):
+    if isinstance(column.type, DATETIME):
+        return '_format_datetime'
+    if isinstance(column.type, DECIMAL):
+        return '_format_decimal'
+    return None
+
+def compile_serializer(columns, from_attributes=False, as_list=False):
+    """Generate a function converting one row into JSON-ready python values.
+
+    `columns` are Column objects (or ORM attributes / labelled expressions
+    carrying a `.type`). The generated function reads `row[i]`, or
+    `row.<name>` when `from_attributes` is set, and returns a dict keyed by
+    column name, or a list when `as_list` is set. Only DATETIME and DECIMAL
+    columns pay for a conversion call.
+    """
+    fields = []
+    for i, column in enumerate(columns):
+        access = f'row.{column.key}' if from_attributes else f'row[{i}]'
+        converter = _converter(column)
+        value = f'{converter}({access})' if converter else access
+        fields.append(value if as_list else f'{column.key!r}: {value}')
+    body = f'[{", ".join(fields)}]' if as_list else f'{{{", ".join(fields)}}}'
+    namespace = {'_format_datetime': _format_datetime,
+                 '_format_decimal': _format_decimal}
+    exec(f'def serialize(row):\n    return {body}\n', namespace)
+    return namespace['serialize']
+
 class SerializerMixin:
+    # 由 compile_entity_serializers 在模块加载时为每个实体生成
+    serializer_columns = ()
+    _serialize_object = None
+    _serialize_row = None
+
     def to_dict(self):
-        ret = {}
-        for c in self.__table__.columns:
-            if isinstance(getattr(self, c.name), datetime):
-                ret[c.name] = getattr(self, c.name).strftime("%Y-%m-%d %H:%M:%S")
-            elif isinstance(getattr(self, c.name), Decimal):
-                ret[c.name] = float(getattr(self, c.name))
-            else:
-                ret[c.name] = getattr(self, c.name)
-        return ret
+        return self._serialize_object()
+
+    @classmethod
+    def row_to_dict(cls, row):
+        """Serialize a tuple selected with `query(*cls.serializer_columns)`."""
+        return cls._serialize_row(row)
+
+def compile_entity_serializers(base):
+    for mapper in base.registry.mappers:
+        entity = mapper.class_
+        columns = list(entity.__table__.columns)
+        entity.serializer_columns = tuple(getattr(entity, c.key) for c in columns)
+        entity._serialize_object = compile_serializer(columns, from_attributes=True)
+        entity._serialize_row = staticmethod(compile_serializer(columns))
 
 # Define the ORM model
 class User(Base, SerializerMixin):
@@ -135,6 +179,18 @@ class Review(Base, SerializerMixin):
         ),
     )
 
+class Product_Rating(Base, SerializerMixin):
+    __tablename__ = 'Product_Rating'
+
+    product_id = Column(Integer, ForeignKey('Product.product_id'), primary_key=True)
+    review_count = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_1 = Column(Integer, nullable=False, default=0)
+    rating_2 = Column(Integer, nullable=False, default=0)
+    rating_3 = Column(Integer, nullable=False, default=0)
+    rating_4 = Column(Integer, nullable=False, default=0)
+    rating_5 = Column(Integer, nullable=False, default=0)
+
 class Category(Base, SerializerMixin):
     __tablename__ = 'Category'
 
@@ -142,6 +198,114 @@ class Category(Base, SerializerMixin):
     category_name = Column(String(100), nullable=False)
     parent_category_id = Column(Integer, ForeignKey('Category.category_id'), nullable=True)
 
+class Shipping_Update(Base, SerializerMixin):
+    __tablename__ = 'Shipping_Update'
+
+    update_id = Column(Integer, primary_key=True, autoincrement=True)
+    shipping_id = Column(Integer, ForeignKey('Shipping.shipping_id'), nullable=False)
+    track_id = Column(Integer, nullable=True)
+
+class Row_Version(Base, SerializerMixin):
+    __tablename__ = 'Row_Version'
+
+    entity = Column(Text, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('entity', 'entity_id'),
+    )
+
+class Sales_Daily(Base, SerializerMixin):
+    __tablename__ = 'Sales_Daily'
+
+    store_id = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    product_id = Column(Integer, nullable=False)
+    revenue = Column(Float, nullable=False)
+    units = Column(Integer, nullable=False)
+    orders = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('store_id', 'day', 'product_id'),
+    )
+
+class Sales_Store_Daily(Base, SerializerMixin):
+    __tablename__ = 'Sales_Store_Daily'
+
+    store_id = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    revenue = Column(Float, nullable=False)
+    units = Column(Integer, nullable=False)
+    orders = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('store_id', 'day'),
+    )
+
+class Sales_Merchant_Daily(Base, SerializerMixin):
+    __tablename__ = 'Sales_Merchant_Daily'
+
+    merchant_id = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    orders = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('merchant_id', 'day'),
+    )
+
+class Sales_Rollup_State(Base, SerializerMixin):
+    __tablename__ = 'Sales_Rollup_State'
+
+    name = Column(Text, primary_key=True)
+    last_order_id = Column(Integer, nullable=False)
+    target_order_id = Column(Integer, nullable=False)
+    refreshed_at = Column(DATETIME, nullable=True)
+
+class Sales_Rollup_Dirty(Base, SerializerMixin):
+    __tablename__ = 'Sales_Rollup_Dirty'
+
+    order_id = Column(Integer, primary_key=True)
+    counted = Column(Integer, nullable=False)
+
+class Import_Checkpoint(Base, SerializerMixin):
+    __tablename__ = 'Import_Checkpoint'
+
+    job = Column(Text, primary_key=True)
+    source_size = Column(Integer, nullable=False)
+    byte_offset = Column(Integer, nullable=False)
+    records = Column(Integer, nullable=False)
+    imported = Column(Integer, nullable=False)
+    rejected = Column(Integer, nullable=False)
+    finished = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DATETIME, nullable=False, default=func.now())
+
+class Session_Key(Base, SerializerMixin):
+    __tablename__ = 'Session_Key'
+
+    key_id = Column(Integer, primary_key=True)
+    secret = Column(Text, nullable=False)
+
+class Session_Revocation(Base, SerializerMixin):
+    __tablename__ = 'Session_Revocation'
+
+    revocation_id = Column(Integer, primary_key=True, autoincrement=True)
+    token_id = Column(Text, nullable=False, unique=True)
+    user_id = Column(Integer, ForeignKey('User.user_id'), nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+class Category_Closure(Base, SerializerMixin):
+    __tablename__ = 'Category_Closure'
+
+    ancestor_id = Column(Integer, ForeignKey('Category.category_id'), nullable=False)
+    descendant_id = Column(Integer, ForeignKey('Category.category_id'), nullable=False)
+    depth = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('ancestor_id', 'descendant_id'),
+    )
+
 class Product_Tag(Base, SerializerMixin):
     __tablename__ = 'Product_Tag'
 
@@ -189,3 +353,12 @@ class Shipping_Track(Base, SerializerMixin):
             name='check_shipping_track_status'
         ),
     )
+
+compile_entity_serializers(Base)
+
+# 冷数据归档库(以 archive 的名字 ATTACH)中的订单表, 与主库的表同名同列, 只用于查询
+ARCHIVE_SCHEMA = 'archive'
+ARCHIVED_TABLES = MetaData()
+Archived_Order_Table, Archived_Order_Item, Archived_Shipping, Archived_Shipping_Track = (
+    entity.__table__.to_metadata(ARCHIVED_TABLES, schema=ARCHIVE_SCHEMA)
+    for entity in (Order_Table, Order_Item, Shipping, Shipping_Track))
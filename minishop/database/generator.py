@@ -0,0 +1,349 @@
+"""Synthetic, referentially consistent datasets for load tests and benchmarks.
+
+    python -m minishop.database.generator --db data/bench.db --preset small
+    python -m minishop.database.generator --db data/prod.db --preset production --seed 7
+    python -m minishop.database.generator --db data/custom.db --users 50000 --products 200000
+
+The same seed and counts always produce the same database. Rows are
+streamed in batches through executemany and committed in large
+transactions, so memory stays bounded by the batch size plus one float
+per product (its price, reused for Order_Item.price_at_purchase).
+Secondary indexes, the search index, the rating aggregates and the
+category closure are built after the bulk load.
+"""
+import argparse
+import hashlib
+import os
+import random
+import sqlite3
+import time
+from array import array
+from datetime import datetime, timedelta
+
+from minishop.database.database import (create_schema, create_indexes, rebuild_search_index,
+                                        rebuild_rating_aggregates, rebuild_category_closure,
+                                        create_session_store, create_row_versions,
+                                        create_shipping_updates, create_import_checkpoints,
+                                        rebuild_sales_rollups)
+
+PRESETS = {
+    'tiny': dict(users=1_000, stores=100, categories=30, products=5_000,
+                 orders=10_000, reviews=10_000),
+    'small': dict(users=20_000, stores=2_000, categories=100, products=100_000,
+                  orders=200_000, reviews=200_000),
+    'medium': dict(users=200_000, stores=20_000, categories=300, products=1_000_000,
+                   orders=2_000_000, reviews=2_000_000),
+    # 约 5000 万条 Order_Item (平均每单 2.5 件)
+    'production': dict(users=1_000_000, stores=100_000, categories=1_000, products=10_000_000,
+                       orders=20_000_000, reviews=20_000_000),
+}
+COUNT_NAMES = ('users', 'stores', 'categories', 'products', 'orders', 'reviews')
+
+MERCHANT_RATIO = 0.05
+MAX_ITEMS_PER_ORDER = 4        # 每单 1..4 件, 平均 2.5
+MAX_TAGS_PER_PRODUCT = 3
+START_TIME = datetime(2023, 1, 1)
+TIME_SPAN_SECONDS = 2 * 365 * 24 * 3600
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+TOP_CATEGORIES = ['电子产品', '休闲运动', '食品', '服装', '医药', '生活家居',
+                  '图书', '美妆', '母婴', '汽车用品']
+SUB_CATEGORY_WORDS = ['配件', '精选', '进口', '户外', '专业', '儿童', '家用', '便携', '经典', '新品']
+BRANDS = ['小米', '华为', '尤尼克斯', '李宁', '安踏', '公牛', '海尔', '美的', '三只松鼠', '云南白药',
+          '优衣库', '耐克', '格力', '联想', '百草味']
+NOUNS = ['羽毛球拍', '跑鞋', '手机', '耳机', '西瓜', '苹果', '排插', '洗衣机', '布洛芬', 'T恤',
+         '保温杯', '台灯', '背包', '坚果', '充电宝', '电饭煲', '衬衫', '键盘', '牙刷', '毛巾']
+ADJECTIVES = ['高性价比', '正品', '新款', '限量', '轻便', '耐用', '旗舰', '经典款', '加厚', '智能']
+CITIES = ['北京市', '上海市', '天津市', '广州市', '深圳市', '杭州市', '成都市', '武汉市', '西安市', '南京市']
+CARRIERS = ['顺丰快递', '圆通快递', '京东快递', '中通快递', '韵达快递']
+PAYMENT_METHODS = ['credit_card', 'wechat', 'alipay']
+COMMENTS = ['很好用', '物流很快', '质量一般', '性价比高', '和描述不符', '会回购', '包装破损', '客服态度很好']
+
+# 订单状态分布, 以及各状态下的物流状态与轨迹
+ORDER_STATUSES = ['pending', 'paid', 'shipped', 'completed', 'canceled']
+ORDER_STATUS_WEIGHTS = [5, 10, 15, 65, 5]
+SHIPPING_BY_ORDER_STATUS = {'paid': 'pending', 'shipped': 'in_transit', 'completed': 'delivered'}
+TRACKS_BY_SHIPPING_STATUS = {
+    'pending': ['sorting'],
+    'in_transit': ['sorting', 'picked_up', 'in_transit'],
+    'delivered': ['sorting', 'picked_up', 'in_transit', 'delivered'],
+}
+RATINGS = [1, 2, 3, 4, 5]
+RATING_WEIGHTS = [5, 5, 15, 35, 40]
+
+
+def user_password(user_id):
+    """Plain-text password of a generated user, for benchmarks that log in."""
+    return f'password{user_id}'
+
+
+def password_hash(password):
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+def merchant_count(counts):
+    return max(1, int(counts['users'] * MERCHANT_RATIO))
+
+
+def timestamp(rng, start=START_TIME, span=TIME_SPAN_SECONDS):
+    return (start + timedelta(seconds=rng.randrange(span))).strftime(DATETIME_FORMAT)
+
+
+def batched(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Generator:
+    def __init__(self, conn: sqlite3.Connection, counts, seed=0,
+                 batch_size=10_000, commit_every=500_000):
+        self.conn = conn
+        self.counts = counts
+        self.seed = seed
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.merchants = merchant_count(counts)
+        self.prices = array('d')
+
+    def rng(self, table):
+        # 每张表独立的随机序列: 调整某一张表的规模不影响其他表的内容
+        return random.Random(f'{self.seed}:{table}')
+
+    def insert(self, table, sql, rows):
+        start = time.perf_counter()
+        total = pending = 0
+        for batch in batched(rows, self.batch_size):
+            self.conn.executemany(sql, batch)
+            total += len(batch)
+            pending += len(batch)
+            if pending >= self.commit_every:
+                self.conn.commit()
+                pending = 0
+        self.conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f'[INFO]{table}: {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/s)')
+        return total
+
+    def users(self):
+        rng = self.rng('User')
+        for user_id in range(1, self.counts['users'] + 1):
+            user_type = 'merchant' if user_id <= self.merchants else 'customer'
+            yield (user_id, f'user{user_id}', password_hash(user_password(user_id)),
+                   f'user{user_id}@example.com', f'1{user_id:010d}',
+                   f'{rng.choice(CITIES)}{rng.randrange(1, 999)}号', timestamp(rng), user_type)
+
+    def stores(self):
+        rng = self.rng('Store')
+        for store_id in range(1, self.counts['stores'] + 1):
+            brand = rng.choice(BRANDS)
+            status = 'active' if rng.random() < 0.95 else 'closed'
+            yield (store_id, f'{brand}旗舰店{store_id}', rng.randint(1, self.merchants),
+                   f'{brand}官方授权店铺', status, timestamp(rng))
+
+    def categories(self):
+        rng = self.rng('Category')
+        tops = min(len(TOP_CATEGORIES), self.counts['categories'])
+        for category_id in range(1, self.counts['categories'] + 1):
+            if category_id <= tops:
+                yield (category_id, TOP_CATEGORIES[category_id - 1], None)
+            else:
+                # 父分类取自更早生成的分类, 保证层级无环
+                parent = rng.randint(1, category_id - 1)
+                yield (category_id, f'{rng.choice(SUB_CATEGORY_WORDS)}{category_id}', parent)
+
+    def products(self):
+        rng = self.rng('Product')
+        for product_id in range(1, self.counts['products'] + 1):
+            price = round(rng.lognormvariate(4.5, 1.2), 2) + 1
+            self.prices.append(price)
+            brand, noun = rng.choice(BRANDS), rng.choice(NOUNS)
+            status = 'active' if rng.random() < 0.95 else 'inactive'
+            yield (product_id, rng.randint(1, self.counts['stores']),
+                   f'{brand}{noun} {rng.choice(ADJECTIVES)}{product_id}',
+                   f'{brand}{rng.choice(ADJECTIVES)}{noun}, 型号 {product_id:08d}',
+                   price, rng.randint(0, 1000), timestamp(rng), status)
+
+    def product_tags(self):
+        rng = self.rng('Product_Tag')
+        for product_id in range(1, self.counts['products'] + 1):
+            tags = rng.sample(range(1, self.counts['categories'] + 1),
+                              min(self.counts['categories'], rng.randint(1, MAX_TAGS_PER_PRODUCT)))
+            for category_id in tags:
+                yield (product_id, category_id)
+
+    def orders(self):
+        """Yield (order, items, shipping, tracks) per order; created_at grows with order_id."""
+        rng = self.rng('Order_Table')
+        orders = self.counts['orders']
+        products = self.counts['products']
+        step = TIME_SPAN_SECONDS / max(orders, 1)
+        for order_id in range(1, orders + 1):
+            buyer_id = rng.randint(self.merchants + 1, self.counts['users'])
+            created = START_TIME + timedelta(seconds=int(order_id * step))
+            status = rng.choices(ORDER_STATUSES, ORDER_STATUS_WEIGHTS)[0]
+
+            items = []
+            total = 0.0
+            for product_id in rng.sample(range(1, products + 1),
+                                         min(products, rng.randint(1, MAX_ITEMS_PER_ORDER))):
+                quantity = rng.randint(1, 3)
+                price = self.prices[product_id - 1]
+                total += quantity * price
+                items.append((order_id, product_id, quantity, price))
+
+            if status == 'pending':
+                payment = (None, 'pending', None)
+            elif status == 'canceled':
+                payment = (rng.choice(PAYMENT_METHODS), 'failed', None)
+            else:
+                paid = created + timedelta(minutes=rng.randint(1, 30))
+                payment = (rng.choice(PAYMENT_METHODS), 'success', paid.strftime(DATETIME_FORMAT))
+            order = (order_id, buyer_id, buyer_id, *payment, status, round(total, 2),
+                     created.strftime(DATETIME_FORMAT))
+
+            shipping, tracks = None, []
+            if status in SHIPPING_BY_ORDER_STATUS:
+                shipping_status = SHIPPING_BY_ORDER_STATUS[status]
+                estimated = created + timedelta(days=3)
+                arrived = (created + timedelta(days=rng.randint(1, 5))).strftime(DATETIME_FORMAT) \
+                    if shipping_status == 'delivered' else None
+                # shipping_id 与 order_id 相同, 保持确定性且无需回查
+                shipping = (order_id, order_id, f'SN{order_id:012d}', rng.choice(CARRIERS),
+                            shipping_status, estimated.strftime(DATETIME_FORMAT), arrived,
+                            f'收件人{buyer_id}', f'1{buyer_id:010d}', f'{rng.choice(CITIES)}{buyer_id}号')
+                for track_id, track_status in enumerate(TRACKS_BY_SHIPPING_STATUS[shipping_status], 1):
+                    at = created + timedelta(hours=6 * track_id)
+                    tracks.append((order_id, track_id, track_status, rng.choice(CITIES),
+                                   at.strftime(DATETIME_FORMAT)))
+            yield order, items, shipping, tracks
+
+    def reviews(self):
+        rng = self.rng('Review')
+        for review_id in range(1, self.counts['reviews'] + 1):
+            comment_time = timestamp(rng)
+            reply, reply_time = None, None
+            if rng.random() < 0.2:
+                reply, reply_time = '感谢您的评价', comment_time
+            yield (review_id, rng.randint(self.merchants + 1, self.counts['users']),
+                   rng.randint(1, self.counts['products']), comment_time,
+                   rng.choices(RATINGS, RATING_WEIGHTS)[0], rng.choice(COMMENTS), reply, reply_time)
+
+    def insert_orders(self):
+        start = time.perf_counter()
+        totals = dict(orders=0, items=0, shippings=0, tracks=0)
+        pending = 0
+        for batch in batched(self.orders(), self.batch_size):
+            orders = [order for order, _, _, _ in batch]
+            items = [item for _, order_items, _, _ in batch for item in order_items]
+            shippings = [shipping for _, _, shipping, _ in batch if shipping is not None]
+            tracks = [track for _, _, _, order_tracks in batch for track in order_tracks]
+            self.conn.executemany(
+                "INSERT INTO Order_Table(order_id, buyer_id, payer_id, payment_method, payment_status, "
+                "payment_time, order_status, total_amount, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                orders)
+            self.conn.executemany(
+                "INSERT INTO Order_Item(order_id, product_id, quantity, price_at_purchase) "
+                "VALUES (?, ?, ?, ?)", items)
+            self.conn.executemany(
+                "INSERT INTO Shipping(shipping_id, order_id, tracking_number, carrier, shipping_status, "
+                "estimated_arrival, actual_arrival, recipient_name, recipient_phone, shipping_address) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", shippings)
+            self.conn.executemany(
+                "INSERT INTO Shipping_Track(shipping_id, track_id, status, location, timestamp) "
+                "VALUES (?, ?, ?, ?, ?)", tracks)
+            for name, rows in (('orders', orders), ('items', items),
+                               ('shippings', shippings), ('tracks', tracks)):
+                totals[name] += len(rows)
+            pending += len(orders) + len(items) + len(shippings) + len(tracks)
+            if pending >= self.commit_every:
+                self.conn.commit()
+                pending = 0
+        self.conn.commit()
+        elapsed = time.perf_counter() - start
+        print(f'[INFO]Order_Table/Order_Item/Shipping/Shipping_Track: {totals} in {elapsed:.1f}s')
+
+    def run(self):
+        self.insert('User', "INSERT INTO User(user_id, username, password_hash, email, phone_number, "
+                    "address, registration_date, user_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.users())
+        self.insert('Store', "INSERT INTO Store(store_id, store_name, owner_id, store_description, "
+                    "store_status, registration_date) VALUES (?, ?, ?, ?, ?, ?)", self.stores())
+        self.insert('Category', "INSERT INTO Category(category_id, category_name, parent_category_id) "
+                    "VALUES (?, ?, ?)", self.categories())
+        self.insert('Product', "INSERT INTO Product(product_id, store_id, product_name, "
+                    "product_description, price, stock, created_at, status) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.products())
+        self.insert('Product_Tag', "INSERT INTO Product_Tag(product_id, category_id) VALUES (?, ?)",
+                    self.product_tags())
+        self.insert_orders()
+        self.insert('Review', "INSERT INTO Review(review_id, user_id, product_id, comment_time, rating, "
+                    "comment, reply, reply_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self.reviews())
+
+
+def generate(db_path, counts, seed=0, batch_size=10_000, commit_every=500_000):
+    """Create `db_path` from the create_table schema and fill it with `counts` rows."""
+    if os.path.exists(db_path):
+        raise FileExistsError(f'{db_path} already exists')
+
+    conn = sqlite3.connect(db_path)
+    # 批量导入期间关闭日志与同步, 完成后切回 WAL
+    conn.executescript("""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        PRAGMA cache_size = -262144;
+        PRAGMA temp_store = MEMORY;
+    """)
+    create_schema(conn)
+
+    start = time.perf_counter()
+    Generator(conn, counts, seed, batch_size, commit_every).run()
+
+    index_start = time.perf_counter()
+    create_indexes(conn)
+    rebuild_search_index(conn)
+    rebuild_rating_aggregates(conn)
+    rebuild_category_closure(conn)
+    create_session_store(conn)
+    create_row_versions(conn)
+    create_shipping_updates(conn)
+    create_import_checkpoints(conn)
+    rebuild_sales_rollups(conn)
+    conn.execute('ANALYZE')
+    conn.commit()
+    print(f'[INFO]indexes built in {time.perf_counter() - index_start:.1f}s')
+
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.close()
+    print(f'[INFO]{db_path} generated in {time.perf_counter() - start:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, required=True, help='database file to create')
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every preset count')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch-size', type=int, default=10_000, help='rows per executemany')
+    parser.add_argument('--commit-every', type=int, default=500_000, help='rows per transaction')
+    for name in COUNT_NAMES:
+        parser.add_argument(f'--{name}', type=int, default=None, help=f'override the {name} count')
+    args = parser.parse_args()
+
+    counts = {name: max(1, int(count * args.scale)) for name, count in PRESETS[args.preset].items()}
+    for name in COUNT_NAMES:
+        if getattr(args, name) is not None:
+            counts[name] = getattr(args, name)
+    if counts['users'] <= merchant_count(counts):
+        parser.error('--users is too small to leave any customers')
+    print(f'[INFO]generating {counts} with seed {args.seed}')
+    generate(args.db, counts, args.seed, args.batch_size, args.commit_every)
+
+
+if __name__ == '__main__':
+    main()
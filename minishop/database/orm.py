@@ -1,196 +1,1231 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import (create_engine, delete, distinct, event, exists, func, insert, inspect,
+                        literal, null, select, text, tuple_, type_coerce, union_all, update, column,
+                        table, Float, String)
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError, OperationalError
 from datetime import datetime
-from decimal import Decimal
+from functools import wraps
+import base64
+import json
+import os
+import time
 
 from minishop.database.entities import *
+from minishop.database.cache import QueryCache, cached
+from minishop.database.writer import WriteQueue
+from minishop.database.suggest import Suggester, track_changes
+from minishop.database.analytics import (SALES_LIMIT, aggregate_sales, format_day,
+                                         parse_sales_query, sales_array, sales_totals)
+from minishop.database.database import SALES_ROLLUP_REFRESH
+from minishop.database.bulk import (CHUNK_SIZE, EXPORT_BATCH_SIZE, MAX_ERRORS, OrderExporter,
+                                    ProductImporter)
+from minishop.database.recommend import (MAX_BASKET, MAX_PAIRS, MIN_COUNT, NEIGHBOURS, ORDER_BATCH,
+                                         PARTITIONS, RELATED_LIMIT, RelatedProducts,
+                                         RelatedProductsBuilder, model_path)
+from minishop.database.archive import (ARCHIVE_BATCH_SIZE, OrderArchiver, create_archive,
+                                       archive_path as default_archive_path)
+import numpy as np
 
-def serialize(l : list):
-    for i in range(len(l)):
-        if isinstance(l[i], datetime):
-            l[i] = l[i].strftime('%Y-%m-%d %H:%M:%S')
-        elif isinstance(l[i], Decimal):
-            l[i] = float(l[i])
-    return l
+# trigram 分词器要求查询至少 3 个字符, 更短的查询退回 LIKE
+MIN_SEARCH_INDEX_QUERY = 3
+PURCHASE_PAGE_SIZE = 20
+MAX_PURCHASE_PAGE_SIZE = 100
+REVIEW_PAGE_SIZE = 20
+MAX_REVIEW_PAGE_SIZE = 100
+# 评价排序方式 -> 排序键; 均以 review_id 作为第二排序键保证 keyset 游标唯一
+# comment_time 按数据库中的原始文本比较, 避免游标经过 datetime 转换后格式不一致
+REVIEW_SORT_KEYS = {
+    'newest': type_coerce(Review.comment_time, String),
+    'rating': Review.rating,
+}
+MAX_BATCH_PRODUCTS = 100
+MAX_BATCH_REVIEW_LIMIT = 20
+SUGGEST_LIMIT = 8
+MAX_SUGGEST_LIMIT = 20
+CATEGORY_PAGE_SIZE = 20
+MAX_CATEGORY_PAGE_SIZE = 100
+MAX_CATEGORY_MATCHES = 100
+PAYMENT_METHODS = ('credit_card', 'wechat', 'alipay')
+MAX_CHECKOUT_ITEMS = 100
+MAX_SHIPPING_EVENTS = 1000
+# 轨迹状态 -> 物流单状态; 轨迹状态取值与 Shipping_Track 表上的 CHECK 约束一致
+TRACK_SHIPPING_STATUS = {
+    'sorting': 'shipped',
+    'picked_up': 'shipped',
+    'in_transit': 'in_transit',
+    'delivered': 'delivered',
+}
+# Shipping_Update 只保留最近的这么多行, 更早的变化由客户端重新拉取购物记录获得
+SHIPPING_UPDATE_RETENTION = 100_000
+SEARCH_INDEX_COLUMNS = {
+    'name': 'product_name',
+    'description': 'product_description',
+    'category': 'category_name',
+}
+SEARCH_SORTS = ('relevance', 'rating')
 
+# 每个新连接执行的 PRAGMA: WAL 下读写互不阻塞, 写锁冲突时等待而不是立即报错
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,          # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,      # 负数单位为 KiB
+}
 
-class Database:
-    def __init__(self, db_url='data/test.db'):
-        engine = create_engine(f'sqlite:///{db_url}')
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
-        print("[INFO]database constructed")
+def configure_sqlite_connection(dbapi_connection, connection_record=None):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
 
-    def confirm_user(self, username, password_hash):
-        user = self.session.query(User).filter_by(
-            username=username, password_hash=password_hash).first()
-        if user:
-            return user.user_id
-        else:
-            return None
-    
-    def search_for_product(self, query, field):
-        if field == 'name':
-            products = self.session.query(Product).filter(Product.product_name.like(f'%{query}%')).all()
-        elif field == 'category':
-            products = self.session.query(Product)\
-            .join(Product_Tag, Product.product_id == Product_Tag.product_id)\
-            .join(Category, Product_Tag.category_id == Category.category_id)\
-            .filter(Category.category_name.like(f'%{query}%')).all()
-        elif field == 'description':
-            products = self.session.query(Product).filter(Product.product_description.like(f'%{query}%')).all()
-        else:
-            products = []
-        return [product.to_dict() for product in products]
-
-    def get_user(self, user_id):
-        user = self.session.query(
-            User.username, User.email, User.phone_number, User.address)\
-            .filter_by(user_id=user_id).first()
-        if user:
-            user_serialized = serialize(user)
-            return {'username': user_serialized[0], 'email': user_serialized[1], 'phone_number': user_serialized[2], 'address': user_serialized[3]}
-        else:
-            return None
-        
-    def update_user(self, user_id, **kwargs):
-        try:
-            # Step 1: Query for the user by user_id
-            user = self.session.query(User).filter_by(user_id=user_id).first()
-
-            if user:
-                # Step 2: Update the user's information
-                user.username = kwargs.get('username', user.username)
-                user.email = kwargs.get('email', user.email)
-                user.phone_number = kwargs.get('phone_number', user.phone_number)
-                user.address = kwargs.get('address', user.address)
-
-                # Step 3: Commit the transaction to save changes
-                self.session.commit()
-                print(f"User {user_id} updated successfully!")
-                return True
-            else:
-                print(f"User with id {user_id} not found.")
+def attach_archive(dbapi_connection, info, path):
+    """ATTACH the order archive at `path` as `archive` to a pooled connection whose
+    record `info` remembers it, once per connection and only after the archive file exists."""
+    if info.get(ARCHIVE_SCHEMA) or not os.path.exists(path):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (path,))
+    cursor.close()
+    info[ARCHIVE_SCHEMA] = True
+
+def archive_attached(connection, path):
+    """Whether the archive is attached to `connection` (a Connection in use), attaching
+    it now when the file was created after the connection was checked out."""
+    pooled = connection.connection
+    # 事务中不能 ATTACH, 这种情况下本次只读热库
+    if not pooled.info.get(ARCHIVE_SCHEMA) and not pooled.dbapi_connection.in_transaction:
+        attach_archive(pooled.dbapi_connection, pooled.info, path)
+    return pooled.info.get(ARCHIVE_SCHEMA, False)
+
+def queued_write(*tables):
+    """Run a write method on the Database's WriteQueue and invalidate the
+    cached reads of the tables it modifies.
+
+    The method receives the writer's session after `self` and must not
+    commit; it is committed together with the other writes of its group.
+    Errors are reported and turned into False like the read-modify-write
+    methods always did.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return self.writer.submit(lambda session: method(self, session, *args, **kwargs))
+            except IntegrityError as e:
+                print(f"Error in {method.__name__}: {e.orig}")
+            except Exception as e:
+                print(f"An unexpected error occurred: {e}")
+            finally:
+                self.cache.bump(*tables)
+            return False
+        return wrapper
+    return decorator
+
+PURCHASE_COLUMNS = (
+    Order_Table.order_id, Order_Table.order_status, Order_Table.created_at,
+    Product.product_name, Product.product_id, Order_Item.quantity, Order_Item.price_at_purchase,
+)
+serialize_purchase = compile_serializer(PURCHASE_COLUMNS, as_list=True)
+ORDER_TABLES = (Order_Table.__table__, Order_Item.__table__, Shipping.__table__,
+                Shipping_Track.__table__)
+ARCHIVED_ORDER_TABLES = (Archived_Order_Table, Archived_Order_Item, Archived_Shipping,
+                         Archived_Shipping_Track)
+
+def not_in_hot_orders(order_id):
+    """Condition on an archived order_id: the order is not also in the hot file
+    (archived while it changed, see archive.py), where it is read from instead."""
+    return ~exists().where(Order_Table.order_id == order_id)
+
+def purchase_page_statement(user_id, before_order_id, limit, with_archive=False):
+    """(order_id, archived) of the user's orders before `before_order_id`, newest
+    first, `limit + 1` rows; with the archive attached from both files. An order
+    in both files (archived while it changed, see archive.py) comes from the hot one."""
+    def page(order, archived):
+        statement = select(order.c.order_id, literal(archived).label('archived'))\
+            .where(order.c.buyer_id == user_id)
+        if before_order_id is not None:
+            statement = statement.where(order.c.order_id < before_order_id)
+        return statement.order_by(order.c.order_id.desc()).limit(limit + 1)
+
+    hot = page(Order_Table.__table__, 0)
+    if not with_archive:
+        return hot
+    cold = page(Archived_Order_Table, 1).where(not_in_hot_orders(Archived_Order_Table.c.order_id))
+    pages = union_all(select(hot.subquery('hot_page')),
+                      select(cold.subquery('archived_page'))).subquery('purchase_pages')
+    return select(pages).order_by(pages.c.order_id.desc()).limit(limit + 1)
+
+def purchase_statements(order_ids, archived=False):
+    """(orders, tracking) queries of the purchase-history rows of `order_ids`, in
+    PURCHASE_COLUMNS and Shipping x Shipping_Track columns, from the hot tables or the archive."""
+    order, item, shipping, track = ARCHIVED_ORDER_TABLES if archived else ORDER_TABLES
+    orders = select(order.c.order_id, order.c.order_status, order.c.created_at,
+                    Product.product_name, Product.product_id, item.c.quantity,
+                    item.c.price_at_purchase)\
+        .select_from(order)\
+        .join(item, order.c.order_id == item.c.order_id)\
+        .join(Product, item.c.product_id == Product.product_id)\
+        .where(order.c.order_id.in_(order_ids))\
+        .order_by(order.c.order_id.desc(), item.c.product_id)
+    tracking = select(*shipping.c, *track.c)\
+        .select_from(shipping)\
+        .join(track, track.c.shipping_id == shipping.c.shipping_id)\
+        .where(shipping.c.order_id.in_(order_ids))\
+        .order_by(shipping.c.shipping_id, track.c.track_id)
+    return orders, tracking
+
+def split_purchase_page(page, limit):
+    """(order_ids, hot order_ids, archived order_ids, next_before_order_id) of
+    purchase_page_statement rows."""
+    next_before_order_id = page[limit - 1][0] if len(page) > limit else None
+    page = page[:limit]
+    return ([row[0] for row in page], [row[0] for row in page if not row[1]],
+            [row[0] for row in page if row[1]], next_before_order_id)
+
+def encode_cursor(sort_value, review_id):
+    raw = json.dumps([sort_value, review_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        sort_value, review_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError(f'invalid review cursor: {cursor!r}')
+    return sort_value, int(review_id)
 
-        except IntegrityError as e:
-            # Step 4: Handle conflicts (like unique constraint violation)
-            session.rollback()  # Rollback the transaction in case of error
-            print(f"Error updating user: {e.orig}")  # Print error message
+def group_purchase_history(order_ids, orders, tracking):
+    """Serialize purchase rows and attach the Shipping x Shipping_Track rows of each order."""
+    tracking_by_order = {order_id: [] for order_id in order_ids}
+    split = len(Shipping.serializer_columns)
+    for row in tracking:
+        shipping = Shipping.row_to_dict(row[:split])
+        tracking_by_order[shipping['order_id']].append(
+            [shipping, Shipping_Track.row_to_dict(row[split:])])
 
-        except Exception as e:
-            # Handle other exceptions
-            session.rollback()
-            print(f"An unexpected error occurred: {e}")
+    # trackings 与 orders 逐行对应, 同一订单的多件商品共享物流信息
+    trackings = [tracking_by_order[order[0]] for order in orders]
+    return [serialize_purchase(order) for order in orders], trackings
+
+def page_reviews(reviews, review_limit):
+    """Cut `review_limit + 1` fetched (review columns..., sort key) rows to one
+    serialized page and the cursor of the next one."""
+    next_cursor = None
+    if len(reviews) > review_limit:
+        last = reviews[review_limit - 1]
+        next_cursor = encode_cursor(last[-1], last.review_id)
+        reviews = reviews[:review_limit]
+    return [Review.row_to_dict(review) for review in reviews], next_cursor
+
+def review_owners_statement(review_id):
+    """(user_id, owner_id) of a review: its author and the owner of the reviewed
+    product's store, owner_id None when the store is gone"""
+    return select(Review.user_id, Store.owner_id)\
+        .select_from(Review)\
+        .outerjoin(Product, Product.product_id == Review.product_id)\
+        .outerjoin(Store, Store.store_id == Product.store_id)\
+        .where(Review.review_id == review_id)
+
+def review_page_statement(product_id, review_sort, review_cursor, review_limit):
+    """`review_limit + 1` (review columns..., sort_key) rows of a product's reviews in
+    `review_sort` order after the opaque `review_cursor`; ValueError for a malformed cursor."""
+    sort_key = REVIEW_SORT_KEYS[review_sort]
+    reviews = select(*Review.serializer_columns, sort_key.label('sort_key'))\
+        .where(Review.product_id == product_id)
+    if review_cursor is not None:
+        sort_value, review_id = decode_cursor(review_cursor)
+        reviews = reviews.where(tuple_(sort_key, Review.review_id) < (sort_value, review_id))
+    return reviews.order_by(sort_key.desc(), Review.review_id.desc()).limit(review_limit + 1)
+
+# 以下写操作接收同步 Session 且不提交: Database 经 queued_write 在写线程上调用,
+# AsyncDatabase 经 run_sync 调用, 两边共用同一份实现
+
+def insert_review(session, review):
+    session.add(Review(
+        user_id=review['user_id'],
+        product_id=review['product_id'],
+        comment=review['comment'],
+        rating=review['rating'],
+        comment_time=datetime.now(),
+        reply=None,
+        reply_time=None
+    ))
+    return True
+
+def remove_review(session, review_id):
+    review = session.get(Review, review_id)
+    if review is None:
+        print(f"Review with id {review_id} not found.")
         return False
+    session.delete(review)
+    return True
 
-    def get_purchase_history(self, user_id):
-        orders = self.session.query(
-                Order_Table.order_id, Order_Table.order_status, Order_Table.created_at, 
-                Product.product_name, Product.product_id, Order_Item.quantity, Order_Item.price_at_purchase,
-                )\
-               .join(Order_Item, Order_Table.order_id == Order_Item.order_id)\
-               .join(Product, Order_Item.product_id == Product.product_id)\
-               .filter(Order_Table.buyer_id == user_id).all()
-
-        trackings = []
-        for order in orders:
-            tracking = self.session.query(Shipping, Shipping_Track)\
-               .filter(Shipping.order_id == order[0])\
-               .filter(Shipping_Track.shipping_id == Shipping.shipping_id).all()
-            trackings.append([[t[0].to_dict(), t[1].to_dict()] for t in tracking])
-
-        return [serialize(list(order)) for order in orders], trackings
-
-    def get_product(self, product_id):
-        product = self.session.query(Product).filter(Product.product_id == product_id).first()
-        reviews = self.session.query(Review).filter(Review.product_id == product_id).all()
-        seller_id = self.session.query(User.user_id)\
-            .join(Store, User.user_id == Store.owner_id)\
-            .join(Product, Store.store_id == Product.store_id)\
-            .filter(Product.product_id == product_id).first()
-
-        return product.to_dict(), [review.to_dict() for review in reviews], int(seller_id[0])
-
-    def add_review(self, review):
-        try:
-            new_review = Review(
-                user_id=review['user_id'],
-                product_id=review['product_id'],
-                comment=review['comment'],
-                rating=review['rating'],
-                comment_time=datetime.now(),
-                reply=None,
-                reply_time=None
-            )
-            self.session.add(new_review)
-            self.session.commit()
-            print(f"Review added successfully!")
-            return True
-        except IntegrityError as e:
-            # Step 4: Handle conflicts (like unique constraint violation)
-            session.rollback()  # Rollback the transaction in case of error
-            print(f"Error adding review: {e.orig}")  # Print error message
-
-        except Exception as e:
-            # Handle other exceptions
-            session.rollback()
-            print(f"An unexpected error occurred: {e}")
+def set_review_reply(session, review_id, reply):
+    """Set the store's reply to a review, or clear it when `reply` is None."""
+    review = session.get(Review, review_id)
+    if review is None:
+        print(f"Review with id {review_id} not found.")
         return False
+    review.reply = reply
+    review.reply_time = datetime.now() if reply is not None else None
+    return True
+
+def parse_shipping_events(events):
+    """Validate carrier events [{'tracking_number', 'status', 'location', 'timestamp'?}, ...]
+    into (tracking_number, status, location, datetime or None) tuples; raises ValueError."""
+    if not isinstance(events, list) or not events:
+        raise ValueError('events must be a non-empty list')
+    if len(events) > MAX_SHIPPING_EVENTS:
+        raise ValueError(f'at most {MAX_SHIPPING_EVENTS} events per request')
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict):
+            raise ValueError('every event must be an object')
+        tracking_number, status, location = (
+            event.get('tracking_number'), event.get('status'), event.get('location'))
+        if not isinstance(tracking_number, str) or not isinstance(location, str):
+            raise ValueError('tracking_number and location must be strings')
+        if status not in TRACK_SHIPPING_STATUS:
+            raise ValueError(f'unknown track status: {status!r}')
+        timestamp = event.get('timestamp')
+        if timestamp is not None:
+            try:
+                timestamp = datetime.strptime(timestamp, DATETIME_FORMAT)
+            except (TypeError, ValueError):
+                raise ValueError(f'timestamp must look like {datetime(2025, 4, 1):{DATETIME_FORMAT}}')
+        parsed.append((tracking_number, status, location, timestamp))
+    return parsed
+
+def sellers_shipments(merchant_id):
+    """Condition on Shipping: the order contains a product of `merchant_id`'s stores"""
+    return exists().where(Order_Item.order_id == Shipping.order_id,
+                          Product.product_id == Order_Item.product_id,
+                          Store.store_id == Product.store_id,
+                          Store.owner_id == merchant_id)
+
+def append_shipping_events(session, events, prune_updates=True, merchant_id=None):
+    """Append parsed carrier events to Shipping_Track and move each shipment to the
+    status of its last event, in `session` without committing; with `prune_updates`
+    trims Shipping_Update to SHIPPING_UPDATE_RETENTION rows. With `merchant_id`
+    only shipments of orders containing that merchant's products are updated, the
+    others count as unknown. Returns {'accepted': count, 'unknown_tracking_numbers': [...]}."""
+    numbers = {event[0] for event in events}
+    shipments = select(Shipping.tracking_number, Shipping.shipping_id)\
+        .where(Shipping.tracking_number.in_(numbers))
+    if merchant_id is not None:
+        shipments = shipments.where(sellers_shipments(merchant_id))
+    shipments = dict(session.execute(shipments).all())
+    last_track_ids = dict(session.execute(
+        select(Shipping_Track.shipping_id, func.max(Shipping_Track.track_id))
+        .where(Shipping_Track.shipping_id.in_(shipments.values()))
+        .group_by(Shipping_Track.shipping_id)).all())
+
+    tracks, latest, unknown = [], {}, []
+    for tracking_number, status, location, timestamp in events:
+        shipping_id = shipments.get(tracking_number)
+        if shipping_id is None:
+            if tracking_number not in unknown:
+                unknown.append(tracking_number)
+            continue
+        track_id = last_track_ids[shipping_id] = last_track_ids.get(shipping_id, 0) + 1
+        timestamp = timestamp or datetime.now().replace(microsecond=0)
+        tracks.append({'shipping_id': shipping_id, 'track_id': track_id, 'status': status,
+                       'location': location, 'timestamp': timestamp})
+        latest[shipping_id] = (status, timestamp)
+
+    if tracks:
+        session.execute(insert(Shipping_Track), tracks)
+    for shipping_id, (status, timestamp) in latest.items():
+        values = {'shipping_status': TRACK_SHIPPING_STATUS[status]}
+        if status == 'delivered':
+            values['actual_arrival'] = timestamp
+        session.execute(update(Shipping).where(Shipping.shipping_id == shipping_id).values(**values))
+    if prune_updates:
+        session.execute(delete(Shipping_Update).where(
+            Shipping_Update.update_id <= select(func.max(Shipping_Update.update_id)).scalar_subquery()
+            - SHIPPING_UPDATE_RETENTION))
+    return {'accepted': len(tracks), 'unknown_tracking_numbers': unknown}
+
+SHIPPING_WIDTH = len(Shipping.serializer_columns)
+
+def shipping_updates_statement(after_update_id, limit):
+    """Shipping_Update rows after `after_update_id` (the last `limit` ids when None)
+    with the buyer, the shipment's current row and the new track, if any."""
+    statement = select(Shipping_Update.update_id, Order_Table.buyer_id,
+                       *Shipping.serializer_columns, *Shipping_Track.serializer_columns)\
+        .select_from(Shipping_Update)\
+        .join(Shipping, Shipping.shipping_id == Shipping_Update.shipping_id)\
+        .join(Order_Table, Order_Table.order_id == Shipping.order_id)\
+        .outerjoin(Shipping_Track, (Shipping_Track.shipping_id == Shipping_Update.shipping_id)
+                   & (Shipping_Track.track_id == Shipping_Update.track_id))
+    if after_update_id is None:
+        # 取最近 limit 个编号范围内的行, 按主键范围查找而不是倒序扫描整表
+        after_update_id = select(func.max(Shipping_Update.update_id) - limit).scalar_subquery()
+    return statement.where(Shipping_Update.update_id > after_update_id)\
+        .order_by(Shipping_Update.update_id).limit(limit)
+
+def serialize_shipping_updates(rows):
+    """[(update_id, buyer_id, event dict)] in update order; the event carries the
+    shipment and, for a new track, the track in the /purchase trackings format."""
+    updates = []
+    for row in sorted(rows, key=lambda row: row[0]):
+        shipping = Shipping.row_to_dict(row[2:2 + SHIPPING_WIDTH])
+        track = row[2 + SHIPPING_WIDTH:]
+        track = Shipping_Track.row_to_dict(track) if track[1] is not None else None
+        updates.append((row[0], row[1], {'update_id': row[0], 'order_id': shipping['order_id'],
+                                         'shipping': shipping, 'track': track}))
+    return updates
+
+def order_export_statement(first_order_id=None, last_order_id=None, with_archive=False):
+    """Orders in [first_order_id, last_order_id] joined with their items, in
+    bulk.ORDER_COLUMNS + ORDER_ITEM_COLUMNS order, sorted by order_id; with the
+    archive attached from both files."""
+    def orders(order, item):
+        statement = select(
+            order.c.order_id.label('order_id'), order.c.buyer_id, order.c.payer_id,
+            order.c.payment_method, order.c.payment_status,
+            type_coerce(order.c.payment_time, String), order.c.order_status,
+            type_coerce(order.c.total_amount, Float), type_coerce(order.c.created_at, String),
+            item.c.product_id, item.c.quantity, type_coerce(item.c.price_at_purchase, Float),
+        ).select_from(order).outerjoin(item, item.c.order_id == order.c.order_id)
+        if first_order_id is not None:
+            statement = statement.where(order.c.order_id >= first_order_id)
+        if last_order_id is not None:
+            statement = statement.where(order.c.order_id <= last_order_id)
+        return statement
+
+    hot = orders(Order_Table.__table__, Order_Item.__table__)
+    if not with_archive:
+        return hot.order_by(Order_Table.order_id)
+    cold = orders(Archived_Order_Table, Archived_Order_Item)\
+        .where(not_in_hot_orders(Archived_Order_Table.c.order_id))
+    # 每个订单只来自一个库, 按 order_id 归并后同一订单的行仍然相邻
+    statement = union_all(hot, cold)
+    return statement.order_by(statement.selected_columns.order_id)
+
+ACTIVE_PRODUCT_IDS = select(Product.product_id).where(Product.status == 'active')
 
-    def delete_review(self, review_id):
+def basket_statement(first_order_id, last_order_id, with_archive=False):
+    """(order_id, product_id) of the items of orders in [first_order_id, last_order_id]
+    that were not canceled, sorted by order_id; with the archive attached from both files."""
+    def baskets(order, item):
+        return select(item.c.order_id.label('order_id'), item.c.product_id)\
+            .join(order, order.c.order_id == item.c.order_id)\
+            .where(item.c.order_id.between(first_order_id, last_order_id),
+                   order.c.order_status != 'canceled')
+
+    hot = baskets(Order_Table.__table__, Order_Item.__table__)
+    if not with_archive:
+        return hot.order_by(Order_Item.order_id)
+    cold = baskets(Archived_Order_Table, Archived_Order_Item)\
+        .where(not_in_hot_orders(Archived_Order_Item.c.order_id))
+    statement = union_all(hot, cold)
+    return statement.order_by(statement.selected_columns.order_id)
+
+# 读取销售报表前, 距上次增量刷新超过该秒数时先在本进程刷新一次
+SALES_REFRESH_INTERVAL = 60.0
+SALES_ROLLUP_CURSOR = select(Sales_Rollup_State.last_order_id)\
+    .where(Sales_Rollup_State.name == 'sales').scalar_subquery()
+
+def refresh_rollups(session):
+    """Run SALES_ROLLUP_REFRESH in the session's transaction."""
+    for statement in SALES_ROLLUP_REFRESH:
+        session.execute(text(statement))
+    return True
+
+def merchant_sales_statement(merchant_id, first_day, last_day, group_by, store_id=None):
+    """(key, revenue, units, orders) rollup rows of the merchant's stores in the
+    day range; per product from Sales_Daily, otherwise from Sales_Store_Daily."""
+    table = Sales_Daily if group_by == 'product' else Sales_Store_Daily
+    key = {'day': table.day, 'store': table.store_id}.get(group_by, Sales_Daily.product_id)
+    stores = select(Store.store_id).where(Store.owner_id == merchant_id)
+    if store_id is not None:
+        stores = stores.where(Store.store_id == store_id)
+    return select(key, table.revenue, table.units, table.orders)\
+        .where(table.store_id.in_(stores), table.day.between(first_day, last_day))
+
+def merchant_orders_statement(merchant_id, first_day, last_day):
+    """(day, 0, 0, orders) rows of the merchant's distinct orders per day in the range,
+    in the columns of merchant_sales_statement"""
+    return select(Sales_Merchant_Daily.day, literal(0.0), literal(0), Sales_Merchant_Daily.orders)\
+        .where(Sales_Merchant_Daily.merchant_id == merchant_id,
+               Sales_Merchant_Daily.day.between(first_day, last_day))
+
+def assemble_merchant_sales(merchant_id, first_day, last_day, group_by, limit, store_id,
+                            rows, store_rows, order_rows, through_order_id):
+    """The report of merchant_sales_statement `rows`, with the store-level `store_rows`
+    for product reports and, without a store filter, the merchant_orders_statement
+    `order_rows` so that an order spanning the merchant's stores counts once."""
+    data = sales_array(rows)
+    store_data = sales_array(store_rows) if store_rows is not None else data
+    order_data = sales_array(order_rows) if order_rows is not None else None
+    return {'merchant_id': merchant_id, 'from': format_day(first_day), 'to': format_day(last_day),
+            'group_by': group_by, 'store_id': store_id,
+            'totals': sales_totals(store_data, order_data),
+            'rows': aggregate_sales(data, group_by, first_day, last_day, limit, order_data),
+            'through_order_id': through_order_id}
+
+class CheckoutError(Exception):
+    """An order line could not be reserved: the product is missing,
+    inactive or has less than the requested stock left."""
+
+    def __init__(self, message, product_id, available=None):
+        super().__init__(message)
+        self.product_id = product_id
+        self.available = available
+
+def parse_checkout(buyer_id, items, payment_method):
+    """Validate a checkout request and merge its [{'product_id', 'quantity'}, ...]
+    items into (product_id, quantity) lines sorted by product_id; raises ValueError."""
+    if type(buyer_id) is not int:
+        raise ValueError(f'invalid user_id: {buyer_id!r}')
+    if payment_method is not None and payment_method not in PAYMENT_METHODS:
+        raise ValueError(f'unknown payment method: {payment_method!r}')
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_CHECKOUT_ITEMS:
+        raise ValueError(f'items must be a list of 1 to {MAX_CHECKOUT_ITEMS} lines')
+    lines = {}
+    for item in items:
         try:
-            review = self.session.query(Review).filter_by(review_id=review_id).first()
-            if review:
-                self.session.delete(review)
-                self.session.commit()
-                print(f"Review {review_id} deleted successfully!")
-                return True
-            else:
-                print(f"Review with id {review_id} not found.")
-        except Exception as e:
-            session.rollback()
-            print(f"An unexpected error occurred: {e}")
+            product_id, quantity = item['product_id'], item['quantity']
+        except (TypeError, KeyError):
+            raise ValueError('every item needs a product_id and a quantity')
+        if type(product_id) is not int or type(quantity) is not int or quantity <= 0:
+            raise ValueError(f'invalid item: {item!r}')
+        lines[product_id] = lines.get(product_id, 0) + quantity
+    return sorted(lines.items())
+
+def place_order(session, buyer_id, lines, payment_method):
+    """Reserve stock for `lines` and write the order in `session` without committing.
+
+    Returns {'order_id', 'total_amount'}, or a CheckoutError (returned, not
+    raised, so the writes grouped with it still commit) after putting back
+    any stock already taken for this order.
+    """
+    # 库存扣减是带条件的 UPDATE, 不足时不命中任何行; 不做先读后写, 因此不会超卖
+    prices = []
+    for product_id, quantity in lines:
+        price = session.execute(
+            update(Product)
+            .where(Product.product_id == product_id, Product.status == 'active',
+                   Product.stock >= quantity)
+            .values(stock=Product.stock - quantity)
+            .returning(Product.price)
+            .execution_options(synchronize_session=False)).scalar()
+        if price is None:
+            # 归还本单已扣减的库存后正常返回, 同组其他写操作不受影响
+            for reserved_id, reserved in lines[:len(prices)]:
+                session.execute(
+                    update(Product).where(Product.product_id == reserved_id)
+                    .values(stock=Product.stock + reserved)
+                    .execution_options(synchronize_session=False))
+            available = session.scalar(select(Product.stock).where(
+                Product.product_id == product_id, Product.status == 'active'))
+            if available is None:
+                return CheckoutError('Product not available', product_id)
+            return CheckoutError('Insufficient stock', product_id, available)
+        prices.append(price)
+
+    total_amount = sum(price * quantity for price, (_, quantity) in zip(prices, lines))
+    order = Order_Table(buyer_id=buyer_id, payment_method=payment_method,
+                        order_status='pending', total_amount=total_amount,
+                        created_at=datetime.now())
+    session.add(order)
+    session.flush()
+    session.add_all(Order_Item(order_id=order.order_id, product_id=product_id,
+                               quantity=quantity, price_at_purchase=price)
+                    for price, (product_id, quantity) in zip(prices, lines))
+    return {'order_id': order.order_id, 'total_amount': float(total_amount)}
+
+PROFILE_COLUMNS = (User.username, User.email, User.phone_number, User.address)
+serialize_profile = compile_serializer(PROFILE_COLUMNS)
+
+PRODUCT_SEARCH = table('Product_Search', column('rowid'))
+RATING_COLUMNS = (Product_Rating.review_count, Product_Rating.rating_sum)
+RATING_HISTOGRAM_COLUMNS = (Product_Rating.rating_1, Product_Rating.rating_2, Product_Rating.rating_3,
+                            Product_Rating.rating_4, Product_Rating.rating_5)
+RATING_AVERAGE = type_coerce(Product_Rating.rating_sum, Float) / Product_Rating.review_count
+PRODUCT_WIDTH = len(Product.serializer_columns)
+
+def select_rated_products(*extra_columns, with_ratings=True, histogram=False):
+    """SELECT product columns, review_count, rating_sum[, rating_1..5], *extra_columns
+    FROM Product LEFT JOIN Product_Rating. Without the aggregate table the
+    rating columns are NULL."""
+    ratings = RATING_COLUMNS + (RATING_HISTOGRAM_COLUMNS if histogram else ())
+    if not with_ratings:
+        return select(*Product.serializer_columns, *(null() for _ in ratings),
+                      *extra_columns).select_from(Product)
+    return select(*Product.serializer_columns, *ratings, *extra_columns).select_from(Product)\
+        .outerjoin(Product_Rating, Product_Rating.product_id == Product.product_id)
+
+def category_tree(with_closure=True):
+    """(ancestor_id, descendant_id) pairs of the category tree, every category
+    included as its own descendant. Read from Category_Closure, or without it
+    from a recursive CTE that walks the whole tree on every query."""
+    if with_closure:
+        return Category_Closure.__table__
+    tree = select(Category.category_id.label('ancestor_id'),
+                  Category.category_id.label('descendant_id')).cte('category_tree', recursive=True)
+    return tree.union_all(select(tree.c.ancestor_id, Category.category_id)
+                          .where(Category.parent_category_id == tree.c.descendant_id))
+
+def category_product_ids(query, with_closure=True):
+    """SELECT the ids of products tagged with a category whose name contains
+    `query` or with any of its subcategories."""
+    # 嵌套 IN 固定由内向外的求值顺序: 匹配的分类 -> 闭包主键查子树 -> Product_Tag 分类索引
+    tree = category_tree(with_closure)
+    categories = select(Category.category_id).where(Category.category_name.like(f'%{query}%'))
+    subtree = select(tree.c.descendant_id).where(tree.c.ancestor_id.in_(categories))
+    return select(Product_Tag.product_id).where(Product_Tag.category_id.in_(subtree))
+
+def category_counts_statement(query, with_closure=True):
+    """Categories whose name contains `query`, each with the number of
+    distinct products in its subtree."""
+    tree = category_tree(with_closure)
+    product_count = select(func.count(distinct(Product_Tag.product_id)))\
+        .join(tree, tree.c.descendant_id == Product_Tag.category_id)\
+        .where(tree.c.ancestor_id == Category.category_id)\
+        .scalar_subquery()
+    return select(*Category.serializer_columns, product_count.label('product_count'))\
+        .where(Category.category_name.like(f'%{query}%'))\
+        .order_by(Category.category_id).limit(MAX_CATEGORY_MATCHES)
+
+def search_statement(query, field, sort='relevance', use_index=False, with_ratings=True,
+                     with_closure=True):
+    """Build the search_for_product query, see `serialize_rated_product` for its rows."""
+    statement = select_rated_products(with_ratings=with_ratings)
+    if field == 'category':
+        # 分类搜索包含子分类下的商品, 不再走全文索引
+        statement = statement.where(Product.product_id.in_(
+            category_product_ids(query, with_closure)))
+        use_index = False
+    elif use_index:
+        # 整个查询作为一个短语, 双引号需转义
+        phrase = '"' + query.replace('"', '""') + '"'
+        match = f'{{{SEARCH_INDEX_COLUMNS[field]}}} : {phrase}'
+        statement = statement.join(PRODUCT_SEARCH, PRODUCT_SEARCH.c.rowid == Product.product_id)\
+            .where(text('Product_Search MATCH :match').bindparams(match=match))
+    elif field == 'name':
+        statement = statement.where(Product.product_name.like(f'%{query}%'))
+    else:
+        statement = statement.where(Product.product_description.like(f'%{query}%'))
+
+    # 按评分排序只读汇总表, 不扫描 Review; 没有评价的商品排在最后
+    if sort == 'rating' and with_ratings:
+        return statement.order_by(func.coalesce(RATING_AVERAGE, 0).desc(),
+                                  func.coalesce(Product_Rating.review_count, 0).desc(),
+                                  Product.product_id)
+    if use_index:
+        return statement.order_by(text('bm25(Product_Search)'))
+    return statement
+
+def category_page_statement(query, after_product_id=None, limit=CATEGORY_PAGE_SIZE,
+                            with_ratings=True, with_closure=True):
+    """One page (plus one row) of the products of `query`'s category subtrees, by product_id."""
+    statement = select_rated_products(with_ratings=with_ratings)\
+        .where(Product.product_id.in_(category_product_ids(query, with_closure)))
+    if after_product_id is not None:
+        statement = statement.where(Product.product_id > after_product_id)
+    return statement.order_by(Product.product_id).limit(limit + 1)
+
+def serialize_rated_product(row):
+    """Product dict of a `select_rated_products` row plus review_count and average_rating."""
+    product = Product.row_to_dict(row[:PRODUCT_WIDTH])
+    review_count, rating_sum = row[PRODUCT_WIDTH], row[PRODUCT_WIDTH + 1]
+    product['review_count'] = review_count or 0
+    product['average_rating'] = round(rating_sum / review_count, 2) if review_count else None
+    return product
+
+def serialize_product_page(row):
+    """(product dict with rating_histogram, seller_id) of a
+    `select_rated_products(Store.owner_id, histogram=True)` row."""
+    product = serialize_rated_product(row)
+    histogram = row[PRODUCT_WIDTH + 2:PRODUCT_WIDTH + 7]
+    product['rating_histogram'] = [count or 0 for count in histogram]
+    return product, int(row[-1])
+
+def parse_product_ids(product_ids):
+    """Validate a batch of product ids; returns them as a tuple without
+    duplicates, in request order. Raises ValueError."""
+    if not isinstance(product_ids, list) or not product_ids:
+        raise ValueError('product_ids must be a non-empty list')
+    if len(product_ids) > MAX_BATCH_PRODUCTS:
+        raise ValueError(f'at most {MAX_BATCH_PRODUCTS} product_ids per request')
+    if any(type(product_id) is not int for product_id in product_ids):
+        raise ValueError('product_ids must be integers')
+    return tuple(dict.fromkeys(product_ids))
+
+def product_pages_statement(product_ids, with_ratings=True):
+    """The get_product product row of every id in `product_ids`, in one IN-list query."""
+    return select_rated_products(Store.owner_id, with_ratings=with_ratings, histogram=True)\
+        .join(Store, Store.store_id == Product.store_id)\
+        .where(Product.product_id.in_(product_ids))
+
+def product_page_statement(product_id, with_ratings=True):
+    """The get_product product row: product, rating aggregate and histogram, store owner."""
+    return select_rated_products(Store.owner_id, with_ratings=with_ratings, histogram=True)\
+        .join(Store, Store.store_id == Product.store_id)\
+        .where(Product.product_id == product_id)
+
+def top_reviews_statement(product_ids, review_sort, review_limit):
+    """The first `review_limit + 1` reviews of every product in `product_ids` in
+    `review_sort` order, as get_product's (review columns..., sort_key) rows
+    grouped by product, from one windowed query."""
+    sort_key = REVIEW_SORT_KEYS[review_sort]
+    rank = func.row_number().over(partition_by=Review.product_id,
+                                  order_by=(sort_key.desc(), Review.review_id.desc()))
+    ranked = select(*Review.serializer_columns, sort_key.label('sort_key'),
+                    rank.label('review_rank'))\
+        .where(Review.product_id.in_(product_ids)).subquery('ranked_reviews')
+    return select(*(ranked.c[column.key] for column in Review.__table__.columns),
+                  ranked.c.sort_key)\
+        .where(ranked.c.review_rank <= review_limit + 1)\
+        .order_by(ranked.c.product_id, ranked.c.review_rank)
+
+def assemble_product_batch(product_ids, products, reviews, review_limit):
+    """({'products': [get_product-shaped pages in request order], 'missing': [ids]})
+    from the rows of product_pages_statement and top_reviews_statement."""
+    reviews_by_product = {}
+    for review in reviews:
+        reviews_by_product.setdefault(review.product_id, []).append(review)
+    rows = {row.product_id: row for row in products}
+    pages, missing = [], []
+    for product_id in product_ids:
+        row = rows.get(product_id)
+        if row is None:
+            missing.append(product_id)
+            continue
+        product, seller_id = serialize_product_page(row)
+        page, next_cursor = (page_reviews(reviews_by_product.get(product_id, []), review_limit)
+                             if review_limit else ([], None))
+        pages.append({'product': product, 'reviews': page, 'seller_id': seller_id,
+                      'next_review_cursor': next_cursor})
+    return {'products': pages, 'missing': missing}
+
+def suggest_statements(with_ratings=True, with_closure=True, limit=None):
+    """(products, categories) queries loading the /suggest index as (id, name, weight) rows,
+    heaviest first: products weighted by review count, categories by subtree product count."""
+    if with_ratings:
+        weight = func.coalesce(Product_Rating.review_count, 0)
+        products = select(Product.product_id, Product.product_name, weight)\
+            .outerjoin(Product_Rating, Product_Rating.product_id == Product.product_id)\
+            .order_by(weight.desc())
+    else:
+        products = select(Product.product_id, Product.product_name, func.count())\
+            .group_by(Product.product_id)
+    products = products.where(Product.status == 'active').limit(limit)
+
+    tree = category_tree(with_closure)
+    product_count = func.count(distinct(Product_Tag.product_id))
+    categories = select(Category.category_id, Category.category_name, product_count)\
+        .outerjoin(tree, tree.c.ancestor_id == Category.category_id)\
+        .outerjoin(Product_Tag, Product_Tag.category_id == tree.c.descendant_id)\
+        .group_by(Category.category_id).order_by(product_count.desc()).limit(limit)
+    return products, categories
+
+# /suggest 索引的目录版本: 其他进程的批量导入每提交一批都会更新 Import_Checkpoint
+CATALOG_VERSION = select(func.count(), func.total(Import_Checkpoint.imported),
+                         func.max(Import_Checkpoint.updated_at))
+
+# HTTP 条件请求的校验值来源, 见 database.create_row_versions
+VERSIONED_ENTITIES = ('product', 'user')
+
+def row_version_statement(entity, entity_id):
+    """Row_Version rows of the database itself and of one entity."""
+    # 两次主键查找; 行值 IN 列表或 OR 条件在 SQLite 中会退化为扫描
+    columns = (Row_Version.entity, Row_Version.version, Row_Version.updated_at)
+    return union_all(
+        select(*columns).where(Row_Version.entity == 'database', Row_Version.entity_id == 0),
+        select(*columns).where(Row_Version.entity == entity, Row_Version.entity_id == entity_id))
+
+def page_version(rows):
+    """(version, last modified unix time) from `row_version_statement` rows;
+    the version is unique per database and change of the entity's page."""
+    versions = {row.entity: row for row in rows}
+    database = versions.pop('database', None)
+    if database is None:
+        return None
+    row = next(iter(versions.values()), None)
+    if row is None:
+        return f'{database.version:x}.0', database.updated_at
+    return f'{database.version:x}.{row.version}', row.updated_at
+
+IDENTITY_COLUMNS = (User.user_id, User.username, User.user_type)
+serialize_identity = compile_serializer(IDENTITY_COLUMNS)
+
+def confirm_user_statement(username, password_hash):
+    return select(User.user_id).filter_by(username=username, password_hash=password_hash).limit(1)
+
+def identity_statement(user_id):
+    return select(*IDENTITY_COLUMNS).where(User.user_id == user_id)
+
+def profile_statement(user_id):
+    return select(*PROFILE_COLUMNS).where(User.user_id == user_id)
+
+def apply_user_update(session, user_id, changes):
+    """Apply the username/email/phone_number/address in `changes` to a user."""
+    user = session.get(User, user_id)
+    if user is None:
+        print(f"User with id {user_id} not found.")
         return False
+    user.username = changes.get('username', user.username)
+    user.email = changes.get('email', user.email)
+    user.phone_number = changes.get('phone_number', user.phone_number)
+    user.address = changes.get('address', user.address)
+    return True
+
+def store_session_secret_statement(candidate):
+    """Keep the first signing key ever stored; read it back with SESSION_SECRET."""
+    return insert(Session_Key).prefix_with('OR IGNORE').values(key_id=1, secret=candidate)
+
+SESSION_SECRET = select(Session_Key.secret).where(Session_Key.key_id == 1)
+
+def store_session_secret(session, candidate):
+    session.execute(store_session_secret_statement(candidate))
+    return session.scalar(SESSION_SECRET)
+
+def revoke_session_statements(token_id, user_id, expires_at):
+    # 已过期令牌的吊销记录不再需要, 每次吊销时顺带清理
+    return (delete(Session_Revocation).where(Session_Revocation.expires_at < time.time()),
+            insert(Session_Revocation).prefix_with('OR IGNORE').values(
+                token_id=token_id, user_id=user_id, expires_at=expires_at))
+
+def record_revocation(session, token_id, user_id, expires_at):
+    for statement in revoke_session_statements(token_id, user_id, expires_at):
+        session.execute(statement)
+    return True
+
+def revocations_statement(after_revocation_id):
+    return select(Session_Revocation.revocation_id, Session_Revocation.token_id,
+                  Session_Revocation.expires_at)\
+        .where(Session_Revocation.revocation_id > after_revocation_id)\
+        .order_by(Session_Revocation.revocation_id)
+
+def page_category(categories, products, limit):
+    """Serialize category_counts_statement rows and cut `limit + 1` category_page_statement
+    rows to one page and the product_id to continue after."""
+    next_after_product_id = products[limit - 1].product_id if len(products) > limit else None
+    categories = [dict(Category.row_to_dict(row[:-1]), product_count=row[-1]) for row in categories]
+    return categories, [serialize_rated_product(row) for row in products[:limit]], next_after_product_id
+
+
+# 可选表: (Database 属性, 表名, 创建它的 database.py 选项)
+OPTIONAL_TABLES = (
+    ('has_search_index', 'Product_Search', '--rebuild-search-index'),
+    ('has_rating_aggregates', 'Product_Rating', '--rebuild-ratings'),
+    ('has_category_closure', 'Category_Closure', '--rebuild-category-closure'),
+    ('has_row_versions', 'Row_Version', '--create-row-versions'),
+    ('has_shipping_updates', 'Shipping_Update', '--create-shipping-updates'),
+    ('has_sales_rollups', 'Sales_Merchant_Daily', '--rebuild-sales-rollups'),
+    ('has_session_store', 'Session_Revocation', '--create-session-store'),
+)
+
+def detect_optional_tables(db, has_table):
+    """Set db's OPTIONAL_TABLES flags from `has_table(name)`, warning about missing ones."""
+    for attribute, table_name, option in OPTIONAL_TABLES:
+        setattr(db, attribute, has_table(table_name))
+        if not getattr(db, attribute):
+            print(f"[WARN]{table_name} not found, run database.py {option}")
+
+
+class Database:
+    def __init__(self, db_url='data/test.db', pool_size=8, max_overflow=8,
+                 cache_entries=1024, cache_ttl=60.0, write_window=0.002, write_batch=256,
+                 suggest_entries=1_000_000, suggest_max_age=300.0, related_path=None,
+                 archive_path=None):
+        self.engine = create_engine(
+            f'sqlite:///{db_url}',
+            poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+            connect_args={'check_same_thread': False})
+        event.listen(self.engine, 'connect', configure_sqlite_connection)
+        # 已完成的旧订单归档在另一个文件中, 归档文件出现后每个连接在下次取出时 ATTACH
+        self.archive_path = archive_path or default_archive_path(db_url)
+        event.listen(self.engine, 'checkout', lambda dbapi_connection, connection_record, proxy:
+                     attach_archive(dbapi_connection, connection_record.info, self.archive_path))
+
+        # 每个线程(即每个 Flask 请求)使用独立的 session, 请求结束时由 remove_session 释放
+        self.Session = sessionmaker(bind=self.engine)
+        self.session = scoped_session(self.Session)
+        # SQLite 同一时刻只允许一个写事务, 进程内的写操作交给唯一的写线程按组提交
+        self.writer = WriteQueue(self.Session, write_window, write_batch)
+        self.cache = QueryCache(cache_entries, cache_ttl)
+        detect_optional_tables(self, inspect(self.engine).has_table)
+        self.sales_refreshed_at = float('-inf')
 
-    def add_reply(self, reply):
+        # /suggest 的进程内前缀索引, 首次使用时构建
+        self.suggester = Suggester(self._load_suggestions, suggest_entries, suggest_max_age,
+                                   self._catalog_version)
+        track_changes(self.Session, self.suggester)
+        # 离线构建的"买了又买"模型文件, 只读映射, 文件被替换后自动重新映射
+        self.related_products = RelatedProducts(related_path or model_path(db_url))
+        print("[INFO]database constructed")
+
+    def confirm_user(self, username, password_hash):
+        return self.session.scalar(confirm_user_statement(username, password_hash))
+
+    def get_identity(self, user_id):
+        """{'user_id', 'username', 'user_type'} of a user, None when missing"""
+        user = self.session.execute(identity_statement(user_id)).first()
+        return serialize_identity(user) if user else None
+
+    @queued_write('Session_Key')
+    def get_session_secret(self, session, candidate):
+        """The token signing key shared by every process, stored as `candidate` if unset"""
+        return store_session_secret(session, candidate)
+
+    @queued_write('Session_Revocation')
+    def revoke_session(self, session, token_id, user_id, expires_at):
+        if not self.has_session_store:
+            return False
+        return record_revocation(session, token_id, user_id, expires_at)
+
+    def get_revocations(self, after_revocation_id):
+        """(revocation_id, token_id, expires_at) of revocations after `after_revocation_id`"""
+        if not self.has_session_store:
+            return []
+        return self.session.execute(revocations_statement(after_revocation_id)).all()
+
+    @cached('Product', 'Product_Tag', 'Category', 'Category_Closure', 'Product_Rating')
+    def search_for_product(self, query, field, sort='relevance'):
+        """Products matching `query` in `field`, each with its review_count and
+        average_rating, ordered by relevance (full-text matches only) or rating.
+        A category matches together with all of its subcategories."""
+        if sort not in SEARCH_SORTS:
+            raise ValueError(f'unknown search sort: {sort!r}')
+        if field not in SEARCH_INDEX_COLUMNS:
+            return []
+        use_index = self.has_search_index and len(query) >= MIN_SEARCH_INDEX_QUERY
+        products = self.session.execute(search_statement(
+            query, field, sort, use_index, self.has_rating_aggregates,
+            self.has_category_closure)).all()
+        return [serialize_rated_product(product) for product in products]
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """Top `limit` product and category names with a word starting with `prefix`,
+        served from the in-process prefix index."""
+        return self.suggester.suggest(prefix, limit)
+
+    def _load_suggestions(self):
+        products, categories = suggest_statements(
+            self.has_rating_aggregates, self.has_category_closure, self.suggester.max_entries)
+        with self.Session() as session:
+            return session.execute(products).all(), session.execute(categories).all()
+
+    def _catalog_version(self):
+        # Import_Checkpoint 在第一次导入时才创建
         try:
-            review_id = reply["review_id"]
-            review = self.session.query(Review).filter_by(review_id=review_id).first()
-            if review:
-                review.reply = reply["reply"]
-                review.reply_time = datetime.now()
-                self.session.commit()
-                print(f"Reply for review {review_id} added successfully!")
-                return True
-            else:
-                print(f"Review with id {review_id} not found.")
-        except Exception as e:
-            session.rollback()
-            print(f"An unexpected error occurred: {e}")
-        return False        
+            with self.Session() as session:
+                return tuple(session.execute(CATALOG_VERSION).one())
+        except OperationalError:
+            return None
+
+    @cached('Product', 'Product_Tag', 'Category', 'Category_Closure', 'Product_Rating')
+    def get_category_products(self, query, after_product_id=None, limit=CATEGORY_PAGE_SIZE):
+        """Return (categories, products page, next_after_product_id).
+
+        `categories` are those whose name contains `query`, each with the
+        product_count of its whole subtree; `products` is one page, by
+        product_id, of the products tagged anywhere in those subtrees.
+        """
+        categories = self.session.execute(
+            category_counts_statement(query, self.has_category_closure)).all()
+        if not categories:
+            return [], [], None
+        products = self.session.execute(category_page_statement(
+            query, after_product_id, limit, self.has_rating_aggregates,
+            self.has_category_closure)).all()
+        return page_category(categories, products, limit)
+
+    def get_version(self, entity, entity_id):
+        """(version, last modified unix time) of the 'product' or 'user' page of
+        `entity_id`, read on every call; None without Row_Version."""
+        if entity not in VERSIONED_ENTITIES:
+            raise ValueError(f'unknown versioned entity: {entity!r}')
+        if not self.has_row_versions:
+            return None
+        return page_version(self.session.execute(row_version_statement(entity, entity_id)).all())
+
+    @cached('User')
+    def get_user(self, user_id, version=None):
+        """Profile of a user. `version` from get_version only keys the cache, so
+        a cached profile does not outlive a change made by another process."""
+        user = self.session.execute(profile_statement(user_id)).first()
+        return serialize_profile(user) if user else None
 
-    def delete_reply(self, review_id):
+    @queued_write('User')
+    def update_user(self, session, user_id, **kwargs):
+        return apply_user_update(session, user_id, kwargs)
+
+    def get_purchase_history(self, user_id, before_order_id=None, limit=PURCHASE_PAGE_SIZE):
+        # 按 order_id 倒序的 keyset 分页, 多取一条用于判断是否还有下一页;
+        # 会话可能在归档文件创建之前就已取得连接, 每次调用时检查
+        with_archive = archive_attached(self.session.connection(), self.archive_path)
+        order_ids, hot_ids, archived_ids, next_before_order_id = split_purchase_page(
+            self.session.execute(purchase_page_statement(
+                user_id, before_order_id, limit, with_archive)).all(), limit)
+        if not order_ids:
+            return [], [], None
+
+        # 只查询本页订单所在的库; 两个库的结果合并后仍按 order_id 倒序
+        orders, tracking = [], []
+        for ids, archived in ((hot_ids, False), (archived_ids, True)):
+            if ids:
+                orders_statement, tracking_statement = purchase_statements(ids, archived)
+                orders += self.session.execute(orders_statement).all()
+                tracking += self.session.execute(tracking_statement).all()
+        if hot_ids and archived_ids:
+            orders.sort(key=lambda row: -row[0])
+        return group_purchase_history(order_ids, orders, tracking) + (next_before_order_id,)
+
+    @cached('Product', 'Review', 'Store', 'Product_Rating')
+    def get_product(self, product_id, review_sort='newest', review_cursor=None,
+                    review_limit=REVIEW_PAGE_SIZE, version=None):
+        """Return (product, reviews page, seller_id, next review cursor).
+
+        The product with its rating aggregate and its seller come from one
+        joined query, the reviews page from a second one ordered by
+        `review_sort` and continued after the opaque `review_cursor`. Raises ValueError for an unknown sort or
+        a malformed cursor; returns (None, [], None, None) for a missing product.
+        `version` only keys the cache, like in get_user.
+        """
+        if review_sort not in REVIEW_SORT_KEYS:
+            raise ValueError(f'unknown review sort: {review_sort!r}')
+        reviews = review_page_statement(product_id, review_sort, review_cursor, review_limit)
+
+        row = self.session.execute(
+            product_page_statement(product_id, self.has_rating_aggregates)).first()
+        if row is None:
+            return None, [], None, None
+        reviews = self.session.execute(reviews).all()
+
+        reviews, next_cursor = page_reviews(reviews, review_limit)
+        product, seller_id = serialize_product_page(row)
+        return product, reviews, seller_id, next_cursor
+
+    def get_products(self, product_ids, review_sort='newest', review_limit=0):
+        """Pages of many products at once, shaped like get_product, with at most
+        `review_limit` reviews each: {'products': [...] in request order,
+        'missing': [ids not found]}. Two queries whatever the number of ids;
+        raises ValueError for malformed ids or an unknown sort."""
+        if review_sort not in REVIEW_SORT_KEYS:
+            raise ValueError(f'unknown review sort: {review_sort!r}')
+        return self._get_products(parse_product_ids(product_ids), review_sort, review_limit)
+
+    @cached('Product', 'Review', 'Store', 'Product_Rating')
+    def _get_products(self, product_ids, review_sort, review_limit):
+        products = self.session.execute(
+            product_pages_statement(product_ids, self.has_rating_aggregates)).all()
+        reviews = []
+        if review_limit and products:
+            reviews = self.session.execute(
+                top_reviews_statement(product_ids, review_sort, review_limit)).all()
+        return assemble_product_batch(product_ids, products, reviews, review_limit)
+
+    def get_review_owners(self, review_id):
+        """(user_id, owner_id) of a review, see review_owners_statement; None when missing"""
+        return self.session.execute(review_owners_statement(review_id)).first()
+
+    @queued_write('Review', 'Product_Rating')
+    def add_review(self, session, review):
+        return insert_review(session, review)
+
+    @queued_write('Review', 'Product_Rating')
+    def delete_review(self, session, review_id):
+        return remove_review(session, review_id)
+
+    @queued_write('Review')
+    def add_reply(self, session, reply):
+        return set_review_reply(session, reply['review_id'], reply['reply'])
+
+    @queued_write('Review')
+    def delete_reply(self, session, review_id):
+        return set_review_reply(session, review_id, None)
+
+    def checkout(self, buyer_id, items, payment_method=None):
+        """Place a pending order for `items` and reserve its stock.
+
+        Returns {'order_id', 'total_amount'}, or None when the order could
+        not be written. Raises ValueError for malformed items and
+        CheckoutError when a line cannot be reserved, in which case no
+        stock is taken for any line.
+        """
+        lines = parse_checkout(buyer_id, items, payment_method)
+        result = self._place_order(buyer_id, lines, payment_method)
+        # 库存变化不让缓存的搜索/分类/商品页整体失效: 商品页的缓存键含行版本, 库存一变即换新;
+        # 列表中的库存与其他进程的写入一样最多滞后缓存 TTL, 扣减本身带条件, 不会因此超卖.
+        # 没有 Row_Version 时商品页只能随 Product 一起失效
+        if not self.has_row_versions:
+            self.cache.bump('Product')
+        if isinstance(result, CheckoutError):
+            raise result
+        return result or None
+
+    @queued_write('Order_Table', 'Order_Item')
+    def _place_order(self, session, buyer_id, lines, payment_method):
+        return place_order(session, buyer_id, lines, payment_method)
+
+    def refresh_sales_rollups(self):
+        """Fold the orders placed or (un)canceled since the last refresh into the rollups."""
+        # 队列中的写操作不得修改 session 以外的状态, 刷新提交成功后才记录时间
+        refreshed = self._refresh_sales_rollups()
+        if refreshed:
+            self.sales_refreshed_at = time.monotonic()
+        return refreshed
+
+    @queued_write('Sales_Daily', 'Sales_Store_Daily', 'Sales_Merchant_Daily')
+    def _refresh_sales_rollups(self, session):
+        if not self.has_sales_rollups:
+            return False
+        return refresh_rollups(session)
+
+    def get_merchant_sales(self, merchant_id, first=None, last=None, group_by='day',
+                           limit=SALES_LIMIT, store_id=None):
+        """Revenue, units and orders of a merchant's stores between the 'YYYY-MM-DD'
+        days `first` and `last`, grouped by day, store or product (see analytics.py);
+        None without the rollups. Raises ValueError for a malformed range."""
+        query = parse_sales_query(first, last, group_by, limit)
+        if not self.has_sales_rollups:
+            return None
+        if time.monotonic() - self.sales_refreshed_at > SALES_REFRESH_INTERVAL:
+            self.refresh_sales_rollups()
+        return self._get_merchant_sales(merchant_id, *query, store_id)
+
+    @cached('Sales_Daily', 'Sales_Store_Daily', 'Sales_Merchant_Daily', 'Store')
+    def _get_merchant_sales(self, merchant_id, first_day, last_day, group_by, limit, store_id):
+        rows = self.session.execute(merchant_sales_statement(
+            merchant_id, first_day, last_day, group_by, store_id))
+        store_rows = order_rows = None
+        if group_by == 'product':
+            store_rows = self.session.execute(merchant_sales_statement(
+                merchant_id, first_day, last_day, 'store', store_id))
+        if store_id is None:
+            order_rows = self.session.execute(merchant_orders_statement(
+                merchant_id, first_day, last_day))
+        return assemble_merchant_sales(merchant_id, first_day, last_day, group_by, limit, store_id,
+                                       rows, store_rows, order_rows,
+                                       self.session.scalar(select(SALES_ROLLUP_CURSOR)))
+
+    def import_products(self, path, fmt=None, job=None, restart=False, chunk_size=CHUNK_SIZE,
+                        max_errors=MAX_ERRORS, rejects=None):
+        """Stream products from a CSV/JSONL file, resuming from the job's checkpoint;
+        see bulk.py. Raises ValueError for an unusable file, bulk.ImportAborted
+        for too many rejected records."""
+        connection = self.engine.raw_connection()
         try:
-            review = self.session.query(Review).filter_by(review_id=review_id).first()
-            if review:
-                review.reply = None
-                review.reply_time = None
-                self.session.commit()
-                print(f"Reply for review {review_id} deleted successfully!")
-                return True
+            importer = ProductImporter(connection.driver_connection, chunk_size, max_errors, rejects)
+            return importer.run(path, fmt, job, restart)
+        finally:
+            connection.close()
+            self.cache.bump('Product', 'Product_Tag', 'Product_Search', 'Row_Version')
+            self.suggester.invalidate()
+
+    def export_orders(self, out, fmt='jsonl', first_order_id=None, last_order_id=None,
+                      batch_size=EXPORT_BATCH_SIZE):
+        """Write the orders in the id range with their items, archived ones included,
+        to text stream `out`, fetching `batch_size` rows at a time. Returns {'orders', 'items'}."""
+        exporter = OrderExporter(out, fmt)
+        with self.engine.connect() as conn:
+            rows = conn.execution_options(stream_results=True, yield_per=batch_size).execute(
+                order_export_statement(first_order_id, last_order_id,
+                                       conn.info.get(ARCHIVE_SCHEMA, False)))
+            return exporter.write(rows)
+
+    def get_related_products(self, product_id, limit=RELATED_LIMIT):
+        """Products most often bought together with `product_id`, served from the
+        memory-mapped model file; None when no model has been built."""
+        return self.related_products.related(product_id, limit)
+
+    def build_related_products(self, path=None, neighbours=NEIGHBOURS, min_count=MIN_COUNT,
+                               max_pairs=MAX_PAIRS, partitions=PARTITIONS, max_basket=MAX_BASKET,
+                               order_batch=ORDER_BATCH):
+        """Rebuild the co-purchase model from Order_Item, archived orders included, into
+        `path` (the served model file by default), reading `order_batch` order ids per
+        query; see recommend.py. Returns the build statistics."""
+        with self.engine.connect() as conn:
+            max_product_id = conn.scalar(select(func.max(Product.product_id))) or 0
+            active = np.zeros(max_product_id + 1, bool)
+            active[np.fromiter(conn.scalars(ACTIVE_PRODUCT_IDS), np.int64)] = True
+            with_archive = conn.info.get(ARCHIVE_SCHEMA, False)
+            item_tables = [Order_Item.__table__]
+            if with_archive:
+                item_tables.append(Archived_Order_Item)
+            # min 与 max 分开查询, 才能各自只读索引的一端
+            first_ids = [conn.scalar(select(func.min(item.c.order_id))) for item in item_tables]
+            last_ids = [conn.scalar(select(func.max(item.c.order_id))) for item in item_tables]
+            first_order_id = min((i for i in first_ids if i is not None), default=1)
+            last_order_id = max((i for i in last_ids if i is not None), default=0)
+
+            def batches():
+                for first in range(first_order_id, last_order_id + 1, order_batch):
+                    rows = conn.execute(basket_statement(first, first + order_batch - 1,
+                                                         with_archive)).all()
+                    items = np.array([tuple(row) for row in rows], np.int64).reshape(-1, 2)
+                    # 构建期间新上架的商品不在本次模型内
+                    items = items[items[:, 1] <= max_product_id]
+                    yield items[:, 0], items[:, 1]
+
+            builder = RelatedProductsBuilder(active, neighbours, min_count, max_pairs, partitions,
+                                             max_basket)
+            return builder.build(batches(), path or self.related_products.path, last_order_id)
+
+    def archive_orders(self, created_before, batch_size=ARCHIVE_BATCH_SIZE):
+        """Move the completed and canceled orders created before `created_before`
+        into the archive file, creating it first; see archive.py. Returns the
+        archival statistics."""
+        if self.has_sales_rollups:
+            self.refresh_sales_rollups()
+        # 只归档已计入销售汇总的订单, 汇总的增量刷新只读取热库中的新订单
+        with self.Session() as session:
+            if self.has_sales_rollups:
+                last_order_id = session.scalar(select(SALES_ROLLUP_CURSOR))
             else:
-                print(f"Review with id {review_id} not found.")
-        except Exception as e:
-            session.rollback()
-            print(f"An unexpected error occurred: {e}")
-        return False
+                last_order_id = session.scalar(select(func.max(Order_Table.order_id)))
+        create_archive(self.archive_path)
+        connection = self.engine.raw_connection()
+        try:
+            return OrderArchiver(connection.driver_connection, batch_size).run(
+                created_before, last_order_id or 0)
+        finally:
+            connection.close()
+
+    def add_shipping_events(self, events, merchant_id=None):
+        """Append a carrier's batch of track events, for `merchant_id`'s shipments
+        only when given; see append_shipping_events. Raises ValueError for a
+        malformed batch, returns None when it could not be written."""
+        result = self._append_shipping_events(parse_shipping_events(events), merchant_id)
+        return result or None
+
+    @queued_write('Shipping', 'Shipping_Track')
+    def _append_shipping_events(self, session, events, merchant_id):
+        return append_shipping_events(session, events, self.has_shipping_updates, merchant_id)
+
+    def get_shipping_updates(self, after_update_id=None, limit=1000):
+        """(update_id, buyer_id, event) of shipping changes after `after_update_id`,
+        or of the last `limit` changes when None; [] without Shipping_Update."""
+        if not self.has_shipping_updates:
+            return []
+        return serialize_shipping_updates(
+            self.session.execute(shipping_updates_statement(after_update_id, limit)).all())
+
+    def cache_stats(self):
+        return self.cache.stats()
 
     def excute_sql(self, sql):
         self.session.execute(sql)
+        self.cache.clear()
+        self.suggester.invalidate()
+
+    def remove_session(self, exception=None):
+        self.session.remove()
+
+    def close(self):
+        """Drain the write queue and release every connection."""
+        self.writer.close()
+        self.session.remove()
+        self.engine.dispose()
 
     def __del__(self):
-        self.session.close()
+        self.session.remove()
 
 if __name__ == '__main__':
     db = Database("../data/e_commerce.db")
@@ -0,0 +1,175 @@
+"""Query-plan regression check for the Database methods.
+
+Runs every scenario below against a database, captures the SQL each
+Database method emits and fails when EXPLAIN QUERY PLAN reports a full
+SCAN of a table the scenario does not explicitly allow.
+
+    python -m minishop.database.query_plan            # fresh temporary database
+    python -m minishop.database.query_plan --db data/e_commerce.db
+
+Writes are executed too, so an existing database is copied first.
+New Database methods should add a scenario here.
+"""
+import argparse
+import io
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import event
+
+from minishop.database.archive import attached_schemas
+from minishop.database.database import create_table
+from minishop.database.entities import ARCHIVE_SCHEMA
+from minishop.database.orm import CheckoutError, Database, encode_cursor
+
+PURCHASE_PAGES = ('purchase_pages', 'hot_page', 'archived_page')
+
+# (method, args, kwargs, tables allowed to be scanned)
+SCENARIOS = [
+    ('confirm_user', ('Jack', 'password'), {}, ()),
+    ('search_for_product', ('羽毛球拍', 'name'), {}, ()),
+    ('search_for_product', ('新疆无籽', 'description'), {}, ()),
+    # 分类名 LIKE 匹配扫描 Category(行数很少), 子树经闭包表与 Product_Tag 索引展开
+    ('search_for_product', ('休闲运动', 'category'), {}, ('Category',)),
+    ('search_for_product', ('羽毛球', 'name'), {'sort': 'rating'}, ()),
+    ('search_for_product', ('休闲运动', 'category'), {'sort': 'rating'}, ('Category',)),
+    # 短于 trigram 最小长度的查询退回 LIKE, 全表扫描是预期行为
+    ('search_for_product', ('球', 'name'), {}, ('Product',)),
+    ('search_for_product', ('食品', 'category'), {}, ('Category',)),
+    ('get_category_products', ('运动',), {}, ('Category',)),
+    ('get_category_products', ('运动',), {'after_product_id': 1, 'limit': 1}, ('Category',)),
+    # 导入任务表每个任务一行, 汇总时整表读取是预期行为
+    ('_catalog_version', (), {}, ('Import_Checkpoint',)),
+    ('get_version', ('user', 6), {}, ()),
+    ('get_version', ('product', 1), {}, ()),
+    ('get_identity', (6,), {}, ()),
+    ('get_revocations', (0,), {}, ()),
+    ('revoke_session', ('query-plan-token', 6, 0.0), {}, ()),
+    ('get_user', (6,), {}, ()),
+    ('get_purchase_history', (7,), {}, ()),
+    ('get_purchase_history', (7,), {'before_order_id': 3, 'limit': 1}, ()),
+    ('get_product', (1,), {}, ()),
+    ('get_product', (1,), {'review_sort': 'rating'}, ()),
+    ('get_product', (1,), {'review_cursor': encode_cursor('2025-04-05 17:55:12', 2)}, ()),
+    ('get_product', (1,), {'review_sort': 'rating', 'review_cursor': encode_cursor(1, 2)}, ()),
+    ('get_products', ([3, 1, 99, 2],), {}, ()),
+    # 窗口函数的结果只包含所请求商品的评价, 在其上扫描是预期行为
+    ('get_products', ([1, 2],), {'review_limit': 2}, ('ranked_reviews',)),
+    ('get_products', ([1, 2],), {'review_sort': 'rating', 'review_limit': 2}, ('ranked_reviews',)),
+    ('update_user', (6,), {'address': '北京市'}, ()),
+    ('add_review', ({'user_id': 6, 'product_id': 1, 'comment': 'ok', 'rating': 5},), {}, ()),
+    ('get_review_owners', (1,), {}, ()),
+    ('add_reply', ({'review_id': 1, 'reply': 'thanks'},), {}, ()),
+    ('delete_reply', (1,), {}, ()),
+    ('delete_review', (1,), {}, ()),
+    ('add_shipping_events', ([{'tracking_number': '1234567890', 'status': 'picked_up', 'location': '北京'},
+                              {'tracking_number': '0000000000', 'status': 'sorting', 'location': '上海'}],),
+     {}, ()),
+    ('add_shipping_events', ([{'tracking_number': '1234567890', 'status': 'in_transit', 'location': '天津'}], 1),
+     {}, ()),
+    # 待修正订单队列本身很小, 逐行读取是预期行为
+    ('refresh_sales_rollups', (), {}, ('Sales_Rollup_Dirty',)),
+    ('get_merchant_sales', (1, '2025-04-01', '2025-04-30'), {}, ()),
+    ('get_merchant_sales', (1, '2025-04-01', '2025-04-30'), {'group_by': 'product', 'store_id': 1}, ()),
+    # 模型构建需要全部在售商品的 id, 读取整个 Product 是预期行为; 模型写到临时目录中数据库旁
+    ('build_related_products', (), {'order_batch': 2}, ('Product',)),
+    ('export_orders', (io.StringIO(),), {'first_order_id': 2, 'last_order_id': 3}, ()),
+    ('get_shipping_updates', (), {}, ()),
+    ('get_shipping_updates', (0,), {'limit': 10}, ()),
+    ('checkout', (6, [{'product_id': 1, 'quantity': 1}, {'product_id': 3, 'quantity': 2}]), {}, ()),
+    # 库存不足时归还已扣减的库存
+    ('checkout', (6, [{'product_id': 1, 'quantity': 1}, {'product_id': 3, 'quantity': 999}]), {}, ()),
+    # 归档本身经原始连接执行, 这里只检查之后同时读取两个库的历史订单;
+    # 两个库各取一页再合并, 扫描的中间结果最多 limit + 1 行
+    ('archive_orders', (datetime(2100, 1, 1),), {}, ('Sales_Rollup_Dirty',)),
+    ('get_purchase_history', (6,), {}, PURCHASE_PAGES),
+    ('get_purchase_history', (7,), {'before_order_id': 3, 'limit': 1}, PURCHASE_PAGES),
+    ('export_orders', (io.StringIO(),), {'first_order_id': 2, 'last_order_id': 3}, ()),
+    ('build_related_products', (), {'order_batch': 2}, ('Product',)),
+]
+
+SCAN = re.compile(r'^SCAN (\S+)')
+SKIPPED_STATEMENTS = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+
+def capture_statements(db, method, args, kwargs):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.lstrip().upper().startswith(SKIPPED_STATEMENTS):
+            if executemany:
+                parameters = parameters[0]
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        getattr(db, method)(*args, **kwargs)
+    except CheckoutError:
+        pass  # 预期内的下单失败, 它执行过的 SQL 同样要检查
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        db.remove_session()
+    return statements
+
+
+def full_scans(conn, statement, parameters, allowed):
+    plan = conn.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = SCAN.match(detail)
+        if match is None or 'VIRTUAL TABLE' in detail or match.group(1) == 'CONSTANT':
+            continue
+        if match.group(1).startswith('(subquery-'):
+            continue  # 子查询的中间结果, 其来源表的访问方式另有一行
+        if match.group(1) not in allowed:
+            scans.append(detail)
+    return scans
+
+
+def check(db_path):
+    db = Database(db_path, cache_entries=0)
+    conn = sqlite3.connect(db_path)
+    failures = 0
+    for method, args, kwargs, allowed in SCENARIOS:
+        for statement, parameters in capture_statements(db, method, args, kwargs):
+            if ARCHIVE_SCHEMA not in attached_schemas(conn) and os.path.exists(db.archive_path):
+                conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (db.archive_path,))
+            scans = full_scans(conn, statement, parameters, allowed)
+            if scans:
+                failures += 1
+                print(f'[FAIL]{method}{args} {kwargs}: {"; ".join(scans)}')
+                print('    ' + ' '.join(statement.split()))
+    conn.close()
+    print(f'[INFO]{len(SCENARIOS)} scenarios checked, {failures} statements with full scans')
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default=None,
+                        help='database to check (copied first), a fresh one by default')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(workdir, 'query_plan.db')
+        if args.db is None:
+            conn = sqlite3.connect(db_path)
+            create_table(conn)
+            conn.close()
+        else:
+            shutil.copyfile(args.db, db_path)
+        ok = check(db_path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Offline "customers also bought" model and its memory-mapped reader.
+
+    python -m minishop.database.recommend --db data/e_commerce.db
+    python -m minishop.database.recommend --db data/e_commerce.db --output data/related.reco \\
+        --neighbours 20 --min-count 2 --max-pairs 4000000
+
+The build streams Order_Item in order_id ranges, expands every order that
+was not canceled into its (product, other product) pairs with NumPy and
+counts them. At most `max_pairs` pairs are held at once: a full buffer is
+reduced to distinct pairs with counts and appended to one of `partitions`
+spill files by product id, and each partition is then summed on its own
+(in several passes over the file when it is still larger than
+`max_pairs`). The score of a pair is the cosine of the two products'
+order sets, count / sqrt(orders(a) * orders(b)), so best sellers do not
+crowd out every list; pairs seen in fewer than `min_count` orders and
+inactive neighbours are dropped, and the best `neighbours` are kept.
+
+The model file is a fixed header followed by three little-endian arrays
+in CSR layout: int64 offsets per product id, int32 neighbour ids and
+float32 scores, so the neighbours of product p are
+neighbours[offsets[p]:offsets[p + 1]]. It is written next to its final
+path and renamed over it, and RelatedProducts maps it read-only: pages
+are shared by every worker and a lookup is two array slices. Readers
+stat the file at most every `check_interval` seconds and map a rebuilt
+one without restarting; requests already holding the old mapping finish
+on it.
+"""
+import argparse
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'MSRECO01'
+# magic, neighbours per product, products (offsets - 1), neighbour entries, built_at, last_order_id
+HEADER = struct.Struct('<8sIxxxxQQdq')
+NEIGHBOURS = 20
+MIN_COUNT = 2
+MAX_PAIRS = 4_000_000
+PARTITIONS = 64
+ORDER_BATCH = 100_000
+# 超过该件数的订单(批发/刷单)会产生平方级的商品对且几乎没有推荐价值, 不参与统计
+MAX_BASKET = 50
+RELATED_LIMIT = 10
+MAX_RELATED_LIMIT = 50
+CHECK_INTERVAL = 1.0
+
+PAIR_DTYPE = np.dtype([('key', '<i8'), ('count', '<i4')])
+
+
+def model_path(db_path):
+    """Default model file of a database file: data/e_commerce.db -> data/e_commerce.reco"""
+    return os.path.splitext(db_path)[0] + '.reco'
+
+
+def baskets(order_ids, max_basket=MAX_BASKET):
+    """(starts, sizes) of the orders in rows sorted by order_id, and the
+    per-row mask of orders with at most `max_basket` products."""
+    starts = np.flatnonzero(np.r_[True, order_ids[1:] != order_ids[:-1]])
+    sizes = np.diff(np.r_[starts, len(order_ids)])
+    return starts, sizes, np.repeat(sizes <= max_basket, sizes)
+
+
+def basket_pairs(product_ids, starts, sizes, max_basket=MAX_BASKET, max_pairs=MAX_PAIRS):
+    """(sources, targets) chunks of at most about `max_pairs` ordered pairs of
+    distinct products bought in the same order."""
+    for size in np.unique(sizes[(sizes > 1) & (sizes <= max_basket)]).tolist():
+        # 同样件数的订单排成矩阵, 一次取出全部商品对, 不逐单循环
+        left, right = np.nonzero(~np.eye(size, dtype=bool))
+        rows = starts[sizes == size]
+        step = max(1, max_pairs // len(left))
+        for first in range(0, len(rows), step):
+            matrix = product_ids[rows[first:first + step, None] + np.arange(size)]
+            yield matrix[:, left].ravel(), matrix[:, right].ravel()
+
+
+def reduce_pairs(keys, counts=None):
+    """Distinct keys (source << 32 | target) and their summed counts, sorted by key."""
+    if counts is None:
+        return np.unique(keys, return_counts=True)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, np.bincount(inverse, weights=counts, minlength=len(unique)).astype(np.int64)
+
+
+def top_neighbours(keys, counts, order_counts, active, neighbours, min_count):
+    """(sources, targets, scores) of the best `neighbours` targets of every source,
+    sorted by source then descending score."""
+    sources, targets = keys >> 32, keys & 0xFFFFFFFF
+    keep = (counts >= min_count) & active[targets]
+    sources, targets, counts = sources[keep], targets[keep], counts[keep]
+    scores = (counts / np.sqrt(order_counts[sources] * order_counts[targets])).astype(np.float32)
+    order = np.lexsort((targets, -scores, sources))
+    sources, targets, scores = sources[order], targets[order], scores[order]
+    starts = np.flatnonzero(np.r_[True, sources[1:] != sources[:-1]]) if len(sources) else sources
+    rank = np.arange(len(sources)) - np.repeat(starts, np.diff(np.r_[starts, len(sources)]))
+    keep = rank < neighbours
+    return sources[keep], targets[keep], scores[keep]
+
+
+class RelatedProductsBuilder:
+    """Count co-purchases from `batches`, an iterable of (order_ids, product_ids)
+    int64 arrays sorted by order_id with whole orders per batch, and write the model."""
+
+    def __init__(self, active, neighbours=NEIGHBOURS, min_count=MIN_COUNT, max_pairs=MAX_PAIRS,
+                 partitions=PARTITIONS, max_basket=MAX_BASKET):
+        self.active = active
+        self.neighbours = neighbours
+        self.min_count = min_count
+        self.max_pairs = max_pairs
+        self.partitions = partitions
+        self.max_basket = max_basket
+        self.order_counts = np.zeros(len(active), np.int64)
+        self.buffer = []
+        self.buffered = 0
+        self.pairs = 0
+        self.spilled = 0
+        self.items = 0
+
+    def _spill(self, spill_dir):
+        if not self.buffer:
+            return
+        keys, counts = reduce_pairs(np.concatenate(self.buffer))
+        self.buffer, self.buffered = [], 0
+        records = np.empty(len(keys), PAIR_DTYPE)
+        records['key'], records['count'] = keys, counts
+        partition = (keys >> 32) % self.partitions
+        for index in np.unique(partition).tolist():
+            with open(os.path.join(spill_dir, f'{index}.pairs'), 'ab') as f:
+                records[partition == index].tofile(f)
+        self.spilled += len(records)
+
+    def _add(self, sources, targets, spill_dir):
+        if self.buffered + len(sources) > self.max_pairs:
+            self._spill(spill_dir)
+        self.buffer.append((sources << 32) | targets)
+        self.buffered += len(sources)
+        self.pairs += len(sources)
+
+    def _partition(self, path):
+        """Top neighbours of the sources in one spill file, in `max_pairs` sized passes."""
+        records = os.path.getsize(path) // PAIR_DTYPE.itemsize
+        passes = max(1, math.ceil(records / self.max_pairs))
+        results = []
+        for current in range(passes):
+            keys, counts = [], []
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = np.fromfile(f, PAIR_DTYPE, self.max_pairs)
+                    if len(chunk) == 0:
+                        break
+                    if passes > 1:
+                        chunk = chunk[(chunk['key'] >> 32) // self.partitions % passes == current]
+                    keys.append(chunk['key'])
+                    counts.append(chunk['count'])
+            keys, counts = reduce_pairs(np.concatenate(keys), np.concatenate(counts))
+            results.append(top_neighbours(keys, counts, self.order_counts, self.active,
+                                          self.neighbours, self.min_count))
+        return results
+
+    def build(self, batches, output, last_order_id=0):
+        """Write the model for `batches` to `output`; returns build statistics."""
+        start = time.perf_counter()
+        directory = os.path.dirname(os.path.abspath(output))
+        with tempfile.TemporaryDirectory(prefix='reco-', dir=directory) as spill_dir:
+            for order_ids, product_ids in batches:
+                self.items += len(order_ids)
+                starts, sizes, counted = baskets(order_ids, self.max_basket)
+                self.order_counts += np.bincount(product_ids[counted], minlength=len(self.active))
+                for sources, targets in basket_pairs(product_ids, starts, sizes, self.max_basket,
+                                                     self.max_pairs):
+                    self._add(sources, targets, spill_dir)
+            self._spill(spill_dir)
+            results = []
+            for index in range(self.partitions):
+                path = os.path.join(spill_dir, f'{index}.pairs')
+                if os.path.exists(path):
+                    results.extend(self._partition(path))
+        if results:
+            sources, targets, scores = (np.concatenate(column) for column in zip(*results))
+            order = np.argsort(sources, kind='stable')
+            sources, targets, scores = sources[order], targets[order], scores[order]
+        else:
+            sources = targets = np.empty(0, np.int64)
+            scores = np.empty(0, np.float32)
+        offsets = np.zeros(len(self.active) + 1, np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.active)), out=offsets[1:])
+        write_model(output, offsets, targets.astype(np.int32), scores, self.neighbours, last_order_id)
+        return {'items': self.items, 'pairs': self.pairs, 'spilled': self.spilled,
+                'products': int(np.count_nonzero(np.diff(offsets))), 'neighbours': len(targets),
+                'seconds': time.perf_counter() - start}
+
+
+def write_model(path, offsets, neighbours, scores, neighbours_per_product, last_order_id):
+    """Write the model file atomically: to a temporary file in the same directory, then rename."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(prefix='.reco-', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, neighbours_per_product, len(offsets) - 1, len(neighbours),
+                                time.time(), last_order_id))
+            f.write(offsets.astype('<i8').tobytes())
+            f.write(neighbours.astype('<i4').tobytes())
+            f.write(scores.astype('<f4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class RelatedModel:
+    """One read-only mapping of a model file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.signature = _signature(os.fstat(f.fileno()))
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.neighbours_per_product, products, entries, self.built_at, self.last_order_id = \
+            HEADER.unpack_from(self.mapping)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a related-products model')
+        offset = HEADER.size
+        self.offsets = np.frombuffer(self.mapping, '<i8', products + 1, offset)
+        offset += self.offsets.nbytes
+        self.neighbours = np.frombuffer(self.mapping, '<i4', entries, offset)
+        self.scores = np.frombuffer(self.mapping, '<f4', entries, offset + self.neighbours.nbytes)
+
+    @property
+    def products(self):
+        return len(self.offsets) - 1
+
+    def related(self, product_id, limit):
+        if not 0 <= product_id < self.products:
+            return []
+        start = int(self.offsets[product_id])
+        end = min(int(self.offsets[product_id + 1]), start + limit)
+        return [{'product_id': neighbour, 'score': round(score, 4)} for neighbour, score in
+                zip(self.neighbours[start:end].tolist(), self.scores[start:end].tolist())]
+
+
+def _signature(stat):
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class RelatedProducts:
+    """Lookups in the model file at `path`, re-mapped when the file is replaced."""
+
+    def __init__(self, path, check_interval=CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.model = None
+        self.checked_at = None
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def _claim_check(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.checked_at is not None and now - self.checked_at < self.check_interval:
+                return False
+            self.checked_at = now
+            return True
+
+    def current(self):
+        """The mapped model, None while there is no usable model file."""
+        if self._claim_check():
+            try:
+                signature = _signature(os.stat(self.path))
+            except FileNotFoundError:
+                self.model = None
+                return None
+            if self.model is None or self.model.signature != signature:
+                try:
+                    # 旧映射在仍引用它的请求结束后随对象回收释放
+                    self.model = RelatedModel(self.path)
+                    self.loads += 1
+                except (OSError, ValueError, struct.error) as e:
+                    print(f"[WARN]related-products model {self.path} not loaded: {e}")
+        return self.model
+
+    def related(self, product_id, limit=RELATED_LIMIT):
+        """[{'product_id', 'score'}] bought together with `product_id`, best first;
+        None without a model."""
+        model = self.current()
+        if model is None:
+            return None
+        return model.related(product_id, limit)
+
+    def stats(self):
+        model = self.model
+        if model is None:
+            return {'loaded': False, 'products': 0, 'neighbours': 0, 'built_at': None, 'loads': self.loads}
+        return {'loaded': True, 'products': model.products, 'neighbours': len(model.neighbours),
+                'built_at': model.built_at, 'loads': self.loads}
+
+
+def main():
+    from minishop.database.orm import Database
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default='data/e_commerce.db', help='database file name')
+    parser.add_argument('--output', type=str, default=None, help='model file, default: <db>.reco')
+    parser.add_argument('--neighbours', type=int, default=NEIGHBOURS, help='neighbours kept per product')
+    parser.add_argument('--min-count', type=int, default=MIN_COUNT,
+                        help='drop pairs bought together in fewer orders')
+    parser.add_argument('--max-pairs', type=int, default=MAX_PAIRS,
+                        help='product pairs held in memory before spilling to disk')
+    parser.add_argument('--partitions', type=int, default=PARTITIONS, help='spill files')
+    parser.add_argument('--max-basket', type=int, default=MAX_BASKET,
+                        help='ignore orders with more distinct products')
+    parser.add_argument('--order-batch', type=int, default=ORDER_BATCH, help='order ids read per query')
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    stats = db.build_related_products(args.output, args.neighbours, args.min_count, args.max_pairs,
+                                      args.partitions, args.max_basket, args.order_batch)
+    print(f"[INFO]{stats['items']} order items, {stats['pairs']} pairs ({stats['spilled']} spilled), "
+          f"{stats['neighbours']} neighbours of {stats['products']} products in {stats['seconds']:.1f}s")
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
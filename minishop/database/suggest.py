@@ -0,0 +1,323 @@
+"""In-process prefix index behind /suggest: search-as-you-type completions
+of product and category names answered without touching SQLite.
+
+Each process builds its own index on first use (or in the background
+right after start-up) from Product and Category, applies the product
+and category changes it commits itself through the ORM, and rebuilds
+from scratch after `max_age` seconds to pick up changes made elsewhere,
+or as soon as the catalog version (the bulk imports recorded in
+Import_Checkpoint, checked every VERSION_CHECK_INTERVAL seconds) moves.
+A failed build is logged and retried after BUILD_RETRY_INTERVAL seconds;
+until one succeeds /suggest answers with no completions.
+"""
+import heapq
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from minishop.database.entities import Category, Product
+
+# 只索引名称/词的前若干个字符, 补全不需要更长的键
+MAX_KEY_LENGTH = 32
+# 前缀命中的键数超过该值时, 其 top-k 结果按前缀缓存
+SCAN_LIMIT = 2048
+MAX_CACHED_PREFIXES = 4096
+END_OF_PREFIX = '\U0010ffff'
+VERSION_CHECK_INTERVAL = 5.0
+BUILD_RETRY_INTERVAL = 10.0
+
+
+def name_keys(name):
+    """Lower-cased keys of `name`: the whole name and every word after a space."""
+    name = name.casefold()
+    keys = {name[:MAX_KEY_LENGTH]}
+    for i, char in enumerate(name):
+        if char.isspace() and i + 1 < len(name) and not name[i + 1].isspace():
+            keys.add(name[i + 1:i + 1 + MAX_KEY_LENGTH])
+    return keys
+
+
+def _entry_size(name):
+    # (name, weight) 元组与名称字符串; 小整数权重为共享对象, 不计
+    return sys.getsizeof((name, 0)) + sys.getsizeof(name)
+
+
+class PrefixIndex:
+    """Sorted array of name keys with bisect lookups, ranking completions by weight.
+
+    `keys` and `ids` are parallel arrays kept in key order; `entries` maps
+    an id to its (name, weight). At most `max_entries` ids are held, so
+    building from the heaviest entries first keeps the most useful ones.
+    Safe to query while another thread adds or removes entries.
+    """
+
+    def __init__(self, max_entries=1_000_000):
+        self.max_entries = max_entries
+        self.keys = []
+        self.ids = array('q')
+        self.entries = {}
+        self.key_bytes = 0
+        self.entry_bytes = 0
+        self.top_cache = OrderedDict()
+        self.lock = threading.RLock()
+
+    def add(self, entry_id, name, weight=0):
+        """Index or re-index `entry_id`; False when the index is full."""
+        return self.update([(entry_id, name, weight)]) == 0
+
+    def remove(self, entry_id):
+        self.update(removed=[entry_id])
+
+    def update(self, entries=(), removed=()):
+        """Index or re-index (id, name, weight) `entries` and drop the `removed` ids
+        in one pass; returns how many new entries did not fit."""
+        with self.lock:
+            stale = {}
+            for entry_id in [*removed, *(entry_id for entry_id, _, _ in entries)]:
+                entry = self.entries.pop(entry_id, None)
+                if entry is not None:
+                    stale[entry_id] = entry[0]
+                    self.entry_bytes -= _entry_size(entry[0])
+            pairs, skipped = [], 0
+            for entry_id, name, weight in entries:
+                if entry_id in self.entries:
+                    continue
+                if len(self.entries) >= self.max_entries:
+                    skipped += 1
+                    continue
+                self.entries[entry_id] = (name, weight)
+                self.entry_bytes += _entry_size(name)
+                pairs.extend((key, entry_id) for key in name_keys(name))
+            # 各处修改在原数组中的位置: 插入在该位置之前, 删除跳过该位置;
+            # 按位置依次拼接原数组的切片, 整体只复制一遍
+            edits = []
+            for entry_id, name in stale.items():
+                for key in name_keys(name):
+                    lo, hi = bisect_left(self.keys, key), bisect_right(self.keys, key)
+                    for position in range(lo, hi):
+                        if self.ids[position] == entry_id:
+                            edits.append((position, 1, key, entry_id))
+                            self.key_bytes -= sys.getsizeof(key)
+                            break
+            for key, entry_id in pairs:
+                edits.append((bisect_right(self.keys, key), 0, key, entry_id))
+                self.key_bytes += sys.getsizeof(key)
+            if edits:
+                edits.sort()
+                keys, ids, start = [], array('q'), 0
+                for position, deleted, key, entry_id in edits:
+                    keys += self.keys[start:position]
+                    ids += self.ids[start:position]
+                    if deleted:
+                        start = position + 1
+                    else:
+                        start = position
+                        keys.append(key)
+                        ids.append(entry_id)
+                keys += self.keys[start:]
+                ids += self.ids[start:]
+                self.keys, self.ids = keys, ids
+            if stale or pairs:
+                self.top_cache.clear()
+            return skipped
+
+    def load(self, rows):
+        """Bulk-load (id, name, weight) rows, heaviest first, into an empty index."""
+        pairs = []
+        for entry_id, name, weight in rows:
+            if len(self.entries) >= self.max_entries:
+                break
+            self.entries[entry_id] = (name, weight)
+            self.entry_bytes += _entry_size(name)
+            pairs.extend((key, entry_id) for key in name_keys(name))
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.ids = array('q', (entry_id for _, entry_id in pairs))
+        self.key_bytes = sum(sys.getsizeof(key) for key in self.keys)
+
+    def complete(self, prefix, limit):
+        """[(id, name)] of the `limit` heaviest entries with a key starting with `prefix`."""
+        prefix = prefix.casefold()[:MAX_KEY_LENGTH]
+        with self.lock:
+            lo = bisect_left(self.keys, prefix)
+            hi = bisect_left(self.keys, prefix + END_OF_PREFIX, lo)
+            if hi - lo <= SCAN_LIMIT:
+                return self._top(self.ids[lo:hi], limit)
+            cache_key = (prefix, limit)
+            result = self.top_cache.get(cache_key)
+            if result is None:
+                result = self._top(self.ids[lo:hi], limit)
+                self.top_cache[cache_key] = result
+                if len(self.top_cache) > MAX_CACHED_PREFIXES:
+                    self.top_cache.popitem(last=False)
+            else:
+                self.top_cache.move_to_end(cache_key)
+            return result
+
+    def _top(self, ids, limit):
+        entries = self.entries
+        best = heapq.nsmallest(limit, set(ids), key=lambda i: (-entries[i][1], entries[i][0], i))
+        return [(entry_id, entries[entry_id][0]) for entry_id in best]
+
+    def memory_bytes(self):
+        """Approximate bytes held: key strings, both arrays and the entry table."""
+        return (self.key_bytes + self.entry_bytes + sys.getsizeof(self.keys)
+                + self.ids.buffer_info()[1] * self.ids.itemsize + sys.getsizeof(self.entries))
+
+
+class Suggester:
+    """Product and category PrefixIndex pair, loaded on demand and rebuilt after `max_age` seconds.
+
+    `loader()` returns (product rows, category rows) of (id, name, weight),
+    heaviest first, and `version()` a token that changes whenever products
+    are bulk-imported. Rebuilds happen off to the side and are swapped in,
+    so queries keep using the previous index meanwhile.
+    """
+
+    def __init__(self, loader, max_entries=1_000_000, max_age=300.0, version=None):
+        self.loader = loader
+        self.version = version
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.products = None
+        self.categories = None
+        self.built_at = None
+        self.built_version = None
+        self.checked_at = None
+        self.failed_at = None
+        self.build_seconds = None
+        self.build_lock = threading.Lock()
+
+    def needs_build(self):
+        if self.failed_at is not None and time.monotonic() - self.failed_at < BUILD_RETRY_INTERVAL:
+            return False
+        return self.built_at is None or time.monotonic() - self.built_at > self.max_age
+
+    def version_due(self):
+        return self.products is not None and (
+            self.checked_at is None or time.monotonic() - self.checked_at >= VERSION_CHECK_INTERVAL)
+
+    def check_version(self, version):
+        """Rebuild on the next request when `version` differs from the one the index was built from."""
+        self.checked_at = time.monotonic()
+        if version != self.built_version:
+            self.invalidate()
+
+    def build(self, product_rows, category_rows, version=None):
+        start = time.perf_counter()
+        products, categories = PrefixIndex(self.max_entries), PrefixIndex(self.max_entries)
+        products.load(product_rows)
+        categories.load(category_rows)
+        self.products, self.categories = products, categories
+        self.built_version = version
+        self.built_at = time.monotonic()
+        self.failed_at = None
+        self.build_seconds = time.perf_counter() - start
+
+    def build_failed(self, error):
+        self.failed_at = time.monotonic()
+        print(f"[WARN]suggest index build failed, retrying in {BUILD_RETRY_INTERVAL:.0f}s: {error}")
+
+    def ensure_built(self):
+        if self.version is not None and self.version_due():
+            self.check_version(self.version())
+        if not self.needs_build():
+            return
+        # 首次构建时其他请求等待; 过期重建时只由一个线程执行, 其余线程继续使用旧索引
+        if not self.build_lock.acquire(blocking=self.products is None):
+            return
+        try:
+            if self.needs_build():
+                # 版本在读取之前取得, 读取期间的导入会在下次检查时触发重建
+                version = self.version() if self.version is not None else None
+                self.build(*self.loader(), version)
+        except Exception as e:
+            self.build_failed(e)
+        finally:
+            self.build_lock.release()
+
+    def start_background_build(self):
+        threading.Thread(target=self.ensure_built, name='minishop-suggest', daemon=True).start()
+
+    def invalidate(self):
+        self.built_at = None
+
+    def suggest(self, prefix, limit):
+        self.ensure_built()
+        return self.lookup(prefix, limit)
+
+    def lookup(self, prefix, limit):
+        if self.products is None:
+            print("[WARN]suggest index is not built, no completions returned")
+            return {'products': [], 'categories': []}
+        products = [{'product_id': entry_id, 'product_name': name}
+                    for entry_id, name in self.products.complete(prefix, limit)]
+        categories = [{'category_id': entry_id, 'category_name': name}
+                      for entry_id, name in self.categories.complete(prefix, limit)]
+        return {'products': products, 'categories': categories}
+
+    def apply(self, changes):
+        """Apply ('product'|'category', id, name or None for deleted, weight) changes."""
+        if self.products is None:
+            return
+        # 同一事务内的多次修改以最后一次为准, 每个索引只合并一次
+        final = {(kind, entry_id): (name, weight) for kind, entry_id, name, weight in changes}
+        for kind, index in (('product', self.products), ('category', self.categories)):
+            entries, removed = [], []
+            for (entry_kind, entry_id), (name, weight) in final.items():
+                if entry_kind != kind:
+                    continue
+                if name is None:
+                    removed.append(entry_id)
+                else:
+                    entries.append((entry_id, name, index.entries.get(entry_id, (None, weight))[1]))
+            index.update(entries, removed)
+
+    def stats(self):
+        if self.products is None:
+            return {'built': False, 'products': 0, 'categories': 0, 'keys': 0, 'bytes': 0,
+                    'build_seconds': None}
+        return {
+            'built': True,
+            'products': len(self.products.entries),
+            'categories': len(self.categories.entries),
+            'keys': len(self.products.keys) + len(self.categories.keys),
+            'bytes': self.products.memory_bytes() + self.categories.memory_bytes(),
+            'build_seconds': self.build_seconds,
+        }
+
+
+def track_changes(session_factory, suggester):
+    """Feed Product and Category rows committed through sessions of
+    `session_factory` into `suggester`."""
+
+    def after_flush(session, flush_context):
+        changes = session.info.setdefault('suggest_changes', [])
+        for instance in session.new | session.dirty:
+            if isinstance(instance, Product):
+                name = instance.product_name if instance.status == 'active' else None
+                changes.append(('product', instance.product_id, name, 0))
+            elif isinstance(instance, Category):
+                changes.append(('category', instance.category_id, instance.category_name, 0))
+        for instance in session.deleted:
+            if isinstance(instance, Product):
+                changes.append(('product', instance.product_id, None, 0))
+            elif isinstance(instance, Category):
+                changes.append(('category', instance.category_id, None, 0))
+
+    def after_commit(session):
+        changes = session.info.pop('suggest_changes', None)
+        if changes:
+            suggester.apply(changes)
+
+    def after_rollback(session):
+        session.info.pop('suggest_changes', None)
+
+    event.listen(session_factory, 'after_flush', after_flush)
+    event.listen(session_factory, 'after_commit', after_commit)
+    event.listen(session_factory, 'after_rollback', after_rollback)
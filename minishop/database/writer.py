@@ -0,0 +1,147 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteQueue:
+    """Single writer thread that commits queued write operations in groups.
+
+    An operation is a callable taking a Session; whatever it returns is
+    handed back to the caller of `submit`, whatever it raises is re-raised
+    there. Operations arriving within `window` seconds of the first one in
+    a group (at most `max_batch` of them) run in one transaction and share
+    one commit, so the fsync cost is paid per group instead of per write.
+    If any operation in a group fails the whole transaction is rolled back
+    and each operation is replayed in a transaction of its own, so only
+    the failing ones report an error. Operations may therefore run more
+    than once and must not have side effects outside the session.
+
+    The thread is started lazily and restarted after fork, so a queue
+    built in a pre-forking master works in every worker.
+
+    `submit` takes an opaque `key` (by default whatever `key_factory`
+    returns on the submitting thread); `current_key` returns it on the
+    writer thread while the operation runs, so instrumentation can
+    attribute the operation's SQL to the request that queued it.
+    """
+
+    def __init__(self, session_factory, window=0.002, max_batch=256):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.key_factory = None
+        self.commits = 0
+        self.operations = 0
+        self.replays = 0
+
+    def submit(self, operation, key=None):
+        """Run `operation(session)` on the writer thread and wait for its result."""
+        if key is None and self.key_factory is not None:
+            key = self.key_factory()
+        future = Future()
+        self._ensure_started().put((operation, future, key))
+        return future.result()
+
+    def current_key(self):
+        """Key of the operation running on the calling thread, or None."""
+        return getattr(self.local, 'key', None)
+
+    def _call(self, operation, key, session):
+        self.local.key = key
+        try:
+            result = operation(session)
+            # 在 key 仍有效时 flush, 挂起的 INSERT/UPDATE 才归属到该操作
+            session.flush()
+            return result
+        finally:
+            self.local.key = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, args=(self.queue,),
+                                               name='minishop-writer', daemon=True)
+                self.thread.start()
+            return self.queue
+
+    def close(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                return
+            self.queue.put(None)
+            thread, self.thread = self.thread, None
+        thread.join()
+
+    def _run(self, requests):
+        while True:
+            item = requests.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        if len(batch) == 1:
+            self._commit_one(*batch[0])
+            self.operations += 1
+            return
+        session = self.session_factory()
+        try:
+            # 组提交的 COMMIT 由整组共享, 不归属到任何一个 key
+            results = [self._call(operation, key, session) for operation, _, key in batch]
+            session.commit()
+        except Exception:
+            session.rollback()
+            results = None
+        finally:
+            session.close()
+
+        if results is None:
+            # 整组回滚后逐个重放, 只让真正出错的操作失败
+            self.replays += 1
+            for operation, future, key in batch:
+                self._commit_one(operation, future, key)
+        else:
+            self.commits += 1
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+        self.operations += len(batch)
+
+    def _commit_one(self, operation, future, key):
+        session = self.session_factory()
+        try:
+            result = self._call(operation, key, session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            future.set_exception(e)
+        else:
+            self.commits += 1
+            future.set_result(result)
+        finally:
+            session.close()
+
+    def stats(self):
+        return {'commits': self.commits, 'operations': self.operations, 'replays': self.replays}
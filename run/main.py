@@ -4,7 +4,7 @@ import sys
 import subprocess
 import multiprocessing
 
-from minishop.backend.server import Server
+from minishop.backend.wsgi import serve
 
 def start_frontend():
     with open("outputs/frontend.log", "w") as f:
@@ -16,8 +16,8 @@ def start_backend():
     sys.stderr = sys.stdout
 
     db_url = 'minishop/data/e_commerce.db'
-    server = Server(os.path.abspath(db_url))
-    server.run()
+    # one worker, so the query cache and other in-process state exist once (see wsgi.py)
+    serve(os.path.abspath(db_url), workers=1)
 
 def main():
     # start backend server
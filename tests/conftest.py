@@ -0,0 +1,36 @@
+import sqlite3
+
+import pytest
+
+from minishop.database.database import create_table
+from minishop.database.orm import Database
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """A fresh database file with the sample data of create_table."""
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    create_table(conn)
+    conn.close()
+    return path
+
+
+@pytest.fixture
+def db(db_path):
+    database = Database(db_path, cache_entries=0)
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def query(db_path):
+    """Run one statement on its own connection and commit; returns the rows."""
+    def run(sql, parameters=()):
+        conn = sqlite3.connect(db_path)
+        try:
+            with conn:
+                return conn.execute(sql, parameters).fetchall()
+        finally:
+            conn.close()
+    return run
@@ -0,0 +1,73 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from minishop.database.archive import COPY_BATCH, OrderArchiver, archive_path, create_archive
+from minishop.database.entities import ARCHIVE_SCHEMA
+
+CUTOFF = datetime(2100, 1, 1)
+
+
+class ChangingArchiver(OrderArchiver):
+    """Updates `order_id` from another connection right after each batch is copied."""
+
+    def __init__(self, conn, db_path, order_id):
+        super().__init__(conn)
+        self.db_path = db_path
+        self.order_id = order_id
+
+    def _transaction(self, begin, statements, parameters):
+        super()._transaction(begin, statements, parameters)
+        if statements is COPY_BATCH:
+            other = sqlite3.connect(self.db_path)
+            with other:
+                other.execute("UPDATE Order_Table SET order_status = 'canceled' WHERE order_id = ?",
+                              (self.order_id,))
+            other.close()
+
+
+@pytest.fixture
+def archive_conn(db_path, query):
+    # 样例数据中订单 1 (用户 6) 与订单 2 (用户 7) 都可归档
+    query("UPDATE Order_Table SET order_status = 'completed' WHERE order_id IN (1, 2)")
+    path = archive_path(db_path)
+    create_archive(path)
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}', (path,))
+    yield conn
+    conn.close()
+
+
+def test_order_changed_while_copying_stays_hot(db, db_path, query, archive_conn):
+    stats = ChangingArchiver(archive_conn, db_path, order_id=1).run(CUTOFF, last_order_id=4)
+
+    assert (stats['orders'], stats['skipped']) == (1, 1)
+    hot = {order_id for order_id, in archive_conn.execute('SELECT order_id FROM main.Order_Table')}
+    archived = {order_id for order_id, in archive_conn.execute(
+        f'SELECT order_id FROM {ARCHIVE_SCHEMA}.Order_Table')}
+    assert hot == {1, 3, 4}
+    assert archived == {1, 2}
+
+    # 热库中的新值优先, 订单 1 只出现一次; 订单 2 从归档中读出
+    orders, _, _ = db.get_purchase_history(6)
+    assert [(order[0], order[1]) for order in orders] == [(1, 'canceled')]
+    orders, _, _ = db.get_purchase_history(7)
+    assert [order[0] for order in orders] == [2]
+
+    # 下次运行时订单 1 不再变化, 覆盖旧副本后移出热库
+    stats = OrderArchiver(archive_conn).run(CUTOFF, last_order_id=4)
+    assert (stats['orders'], stats['skipped']) == (1, 0)
+    assert query('SELECT order_id FROM Order_Table ORDER BY order_id') == [(3,), (4,)]
+    assert archive_conn.execute(
+        f'SELECT order_status FROM {ARCHIVE_SCHEMA}.Order_Table WHERE order_id = 1').fetchone() == ('canceled',)
+
+
+def test_history_of_a_session_held_across_archiving(db, query):
+    # 会话在归档文件创建之前已取得连接, 之后仍能读到移走的订单
+    before = db.get_purchase_history(7)
+    assert [order[0] for order in before[0]] == [2]
+
+    assert db.archive_orders(CUTOFF)['orders'] == 1
+    assert query('SELECT count(*) FROM Order_Table WHERE order_id = 2') == [(0,)]
+    assert db.get_purchase_history(7) == before
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from minishop.database.orm import CheckoutError
+
+BUYER_ID = 6
+
+
+def stock(query, product_id):
+    return query('SELECT stock FROM Product WHERE product_id = ?', (product_id,))[0][0]
+
+
+def order_count(query):
+    return query('SELECT count(*) FROM Order_Table')[0][0]
+
+
+def race(db, items, buyers=16):
+    """Run `buyers` checkouts of `items` at once; (results, CheckoutErrors)."""
+    barrier = threading.Barrier(buyers)
+    results, errors, lock = [], [], threading.Lock()
+
+    def buy():
+        barrier.wait()
+        try:
+            result = db.checkout(BUYER_ID, items)
+            with lock:
+                results.append(result)
+        except CheckoutError as e:
+            with lock:
+                errors.append(e)
+        finally:
+            db.remove_session()
+
+    threads = [threading.Thread(target=buy) for _ in range(buyers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_last_unit_is_sold_once(db, query):
+    query('UPDATE Product SET stock = 1 WHERE product_id = 1')
+    orders = order_count(query)
+
+    results, errors = race(db, [{'product_id': 1, 'quantity': 1}])
+
+    assert len(results) == 1 and results[0] is not None
+    assert len(errors) == 15
+    assert all(e.product_id == 1 and e.available == 0 for e in errors)
+    assert stock(query, 1) == 0
+    assert order_count(query) == orders + 1
+    assert query('SELECT sum(quantity) FROM Order_Item WHERE order_id = ?',
+                 (results[0]['order_id'],))[0][0] == 1
+
+
+def test_failed_line_restores_reserved_stock(db, query):
+    before = stock(query, 1), stock(query, 3)
+    orders = order_count(query)
+
+    with pytest.raises(CheckoutError) as error:
+        db.checkout(BUYER_ID, [{'product_id': 1, 'quantity': 2},
+                               {'product_id': 3, 'quantity': before[1] + 1}])
+
+    assert error.value.product_id == 3
+    assert error.value.available == before[1]
+    assert (stock(query, 1), stock(query, 3)) == before
+    assert order_count(query) == orders
+
+
+def test_failed_orders_in_a_group_restore_their_stock(db, query):
+    # 第二行只剩一件: 只有一单成功, 其余订单在同一组提交中归还第一行的库存
+    query('UPDATE Product SET stock = 100 WHERE product_id = 1')
+    query('UPDATE Product SET stock = 1 WHERE product_id = 3')
+
+    results, errors = race(db, [{'product_id': 1, 'quantity': 1}, {'product_id': 3, 'quantity': 1}])
+
+    assert len(results) == 1 and len(errors) == 15
+    assert stock(query, 1) == 99
+    assert stock(query, 3) == 0
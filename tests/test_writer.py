@@ -0,0 +1,90 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from minishop.database.writer import WriteQueue
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "writer.db"}')
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE Item (item_id INTEGER PRIMARY KEY, name TEXT UNIQUE)'))
+    yield sessionmaker(engine)
+    engine.dispose()
+
+
+def insert(name):
+    def operation(session):
+        session.execute(text('INSERT INTO Item(name) VALUES (:name)'), {'name': name})
+        return name
+    return operation
+
+
+def submit_together(writer, operations):
+    """Submit `operations` from one thread each at the same moment; results or exceptions by index."""
+    barrier = threading.Barrier(len(operations))
+    outcomes = [None] * len(operations)
+
+    def submit(i, operation):
+        barrier.wait()
+        try:
+            outcomes[i] = writer.submit(operation)
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=submit, args=(i, operation))
+               for i, operation in enumerate(operations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+def names(session_factory):
+    with session_factory() as session:
+        return sorted(session.scalars(text('SELECT name FROM Item')))
+
+
+def test_operations_share_one_commit(session_factory):
+    # 窗口足够长, 组在凑满 max_batch 时提交
+    writer = WriteQueue(session_factory, window=5.0, max_batch=8)
+    try:
+        outcomes = submit_together(writer, [insert(f'item-{i}') for i in range(8)])
+    finally:
+        writer.close()
+
+    assert sorted(outcomes) == [f'item-{i}' for i in range(8)]
+    assert names(session_factory) == [f'item-{i}' for i in range(8)]
+    assert writer.stats() == {'commits': 1, 'operations': 8, 'replays': 0}
+
+
+def test_failed_operation_is_replayed_alone(session_factory):
+    with session_factory.begin() as session:
+        session.execute(text("INSERT INTO Item(name) VALUES ('taken')"))
+    writer = WriteQueue(session_factory, window=5.0, max_batch=3)
+    try:
+        outcomes = submit_together(writer, [insert('first'), insert('taken'), insert('second')])
+    finally:
+        writer.close()
+
+    # 整组回滚后逐个重放: 只有冲突的操作失败, 其余两个各自提交
+    assert outcomes[0] == 'first' and outcomes[2] == 'second'
+    assert isinstance(outcomes[1], IntegrityError)
+    assert names(session_factory) == ['first', 'second', 'taken']
+    assert writer.stats() == {'commits': 2, 'operations': 3, 'replays': 1}
+
+
+def test_operation_sees_its_key(session_factory):
+    writer = WriteQueue(session_factory)
+    try:
+        assert writer.submit(lambda session: writer.current_key(), key='request-1') == 'request-1'
+        writer.key_factory = lambda: 'from-factory'
+        assert writer.submit(lambda session: writer.current_key()) == 'from-factory'
+    finally:
+        writer.close()
+    assert writer.current_key() is None